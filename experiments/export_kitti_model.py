@@ -0,0 +1,81 @@
+import torch
+import argparse, json
+import sys
+sys.path.insert(0,'..')
+from networks import *
+
+
+def load_checkpoint(file_name):
+    try:
+        return torch.load(file_name, map_location='cpu', weights_only=False)
+    except TypeError:
+        #Older versions of PyTorch do not have (or need) weights_only
+        return torch.load(file_name, map_location='cpu')
+
+def build_model(train_args):
+    """ Rebuilds the model trained by run_kitti_relative_rot.py """
+    dim_in = 2 if train_args.optical_flow else 6
+    if train_args.model == 'A_sym':
+        return QuatFlowNet(enforce_psd=train_args.enforce_psd, unit_frob_norm=train_args.unit_frob, dim_in=dim_in, batchnorm=train_args.batchnorm)
+    elif train_args.model == '6D':
+        return RotMat6DFlowNet(dim_in=dim_in, batchnorm=train_args.batchnorm)
+    elif train_args.model == 'quat':
+        return BasicCNN(dim_in=dim_in, dim_out=4, normalize_output=True, batchnorm=train_args.batchnorm)
+    raise ValueError("Model '{}' uses the cvxpy SDP layer and cannot be exported.".format(train_args.model))
+
+def main():
+    parser = argparse.ArgumentParser(description='Export a KITTI relative rotation model to a standalone TorchScript (or ONNX) file')
+    parser.add_argument('checkpoint', type=str, help='file saved by run_kitti_relative_rot.py --save_model')
+    parser.add_argument('--output', type=str, default=None)
+    parser.add_argument('--format', choices=['script', 'trace', 'onnx'], default='script')
+    parser.add_argument('--input_size', type=int, nargs=2, default=None, metavar=('H', 'W'),
+                        help='image size, required for trace and onnx (and used to check the exported model)')
+    parser.add_argument('--double', action='store_true', default=False)
+    args = parser.parse_args()
+    print(args)
+
+    if args.format != 'script' and args.input_size is None:
+        parser.error('--input_size is required for --format {}'.format(args.format))
+
+    checkpoint = load_checkpoint(args.checkpoint)
+    train_args = checkpoint['args']
+    tensor_type = torch.double if args.double else torch.float
+
+    model = build_model(train_args)
+    model.load_state_dict(checkpoint['model'])
+    model = model.to(dtype=tensor_type).eval()
+    export_model = QuatInferenceNet(model).eval() if train_args.model == 'A_sym' else model
+
+    example_input = None
+    if args.input_size is not None:
+        dim_in = 2 if train_args.optical_flow else 6
+        example_input = torch.randn((2, dim_in, args.input_size[0], args.input_size[1]), dtype=tensor_type)
+
+    output_file = args.output
+    if output_file is None:
+        output_file = args.checkpoint.replace('.pt', '') + ('.onnx' if args.format == 'onnx' else '_{}.pt'.format(args.format))
+
+    if args.format == 'onnx':
+        torch.onnx.export(export_model, example_input, output_file, input_names=['x'], output_names=['q'],
+                          dynamic_axes={'x': {0: 'batch'}, 'q': {0: 'batch'}})
+    else:
+        with torch.no_grad():
+            if args.format == 'script':
+                exported = torch.jit.script(export_model)
+            else:
+                exported = torch.jit.trace(export_model, example_input)
+        meta = {'model_type': train_args.model, 'seq': train_args.seq, 'optical_flow': train_args.optical_flow,
+                'kitti_data_pickle_file': checkpoint['kitti_data_pickle_file']}
+        torch.jit.save(exported, output_file, _extra_files={'meta.json': json.dumps(meta)})
+
+        if example_input is not None:
+            #The exported file only needs torch to run
+            loaded = torch.jit.load(output_file)
+            with torch.no_grad():
+                err = (loaded(example_input) - model(example_input)).abs().max().item()
+            print('Max. deviation from the training model: {:.3E}'.format(err))
+
+    print('Saved exported model to {}.'.format(output_file))
+
+if __name__=='__main__':
+    main()
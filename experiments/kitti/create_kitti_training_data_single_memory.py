@@ -3,6 +3,9 @@ import pickle, csv, glob, os
 import random
 import numpy as np
 from liegroups.numpy import SE3
+import sys
+sys.path.insert(0,'../../')
+from utils import so3_geodesic_angle
 
 KITTI_SEQS_DICT = {'00': {'date': '2011_10_03',
                           'drive': '0027',
@@ -35,6 +38,15 @@ KITTI_SEQS_DICT = {'00': {'date': '2011_10_03',
                           'drive': '0034',
                           'frames': range(0, 1201)}}
 
+def _relative_poses(T_w, idx_2, idx_1):
+    #Batched T_21 = T_w[idx_2]^-1 * T_w[idx_1] for Px4x4 pose matrices T_w
+    T_2, T_1 = T_w[idx_2], T_w[idx_1]
+    R_2t = T_2[:, :3, :3].transpose(0, 2, 1)
+    T_21 = np.tile(np.eye(4), (len(idx_1), 1, 1))
+    T_21[:, :3, :3] = R_2t @ T_1[:, :3, :3]
+    T_21[:, :3, 3] = np.einsum('pij,pj->pi', R_2t, T_1[:, :3, 3] - T_2[:, :3, 3])
+    return T_21
+
 def compute_vo_pose_errors(tm, pose_deltas, seq, eval_type='train', add_reverse=False, min_turning_angle=0.):
     """Compute delta pose errors on VO estimates """
     T_21_gts = []
@@ -42,33 +54,26 @@ def compute_vo_pose_errors(tm, pose_deltas, seq, eval_type='train', add_reverse=
     pair_pose_ids = []
     seqs = []
 
+    Twv_gt = np.array([T.as_matrix() for T in tm.Twv_gt])
+    Twv_est = np.array([T.as_matrix() for T in tm.Twv_est])
 
     for p_delta in pose_deltas:
 
-        pose_ids = range(len(tm.Twv_gt) - p_delta)
-    
-        for i, p_idx in enumerate(pose_ids):
-            T_21_gt = tm.Twv_gt[p_idx + p_delta].inv().dot(tm.Twv_gt[p_idx])
-            T_21_est = tm.Twv_est[p_idx + p_delta].inv().dot(tm.Twv_est[p_idx])
-
-            turning_angle = np.linalg.norm(T_21_gt.rot.log())*(180./np.pi)
-            if (turning_angle > min_turning_angle):
-                T_21_gts.append(T_21_gt.as_matrix())
-                T_21_ests.append(T_21_est.as_matrix())
-                pair_pose_ids.append([p_idx, p_idx + p_delta])
-                seqs.append(seq)
-
+        pose_ids = np.arange(len(tm.Twv_gt) - p_delta)
+        pairs = [(pose_ids + p_delta, pose_ids)]
         if add_reverse:
-            for i, p_idx in enumerate(pose_ids):
-                T_21_gt = tm.Twv_gt[p_idx].inv().dot(tm.Twv_gt[p_idx + p_delta])
-                T_21_est = tm.Twv_est[p_idx].inv().dot(tm.Twv_est[p_idx + p_delta])
-
-                turning_angle = np.linalg.norm(T_21_gt.rot.log())*(180./np.pi)
-                if turning_angle > min_turning_angle: #or coin_flip[i]:
-                    T_21_gts.append(T_21_gt.as_matrix())
-                    T_21_ests.append(T_21_est.as_matrix())
-                    pair_pose_ids.append([p_idx + p_delta, p_idx])
-                    seqs.append(seq)
+            pairs.append((pose_ids, pose_ids + p_delta))
+
+        for idx_2, idx_1 in pairs:
+            T_21_gt = _relative_poses(Twv_gt, idx_2, idx_1)
+            T_21_est = _relative_poses(Twv_est, idx_2, idx_1)
+
+            turning_angle = so3_geodesic_angle(T_21_gt[:, :3, :3], units='deg')
+            keep = turning_angle > min_turning_angle
+            T_21_gts.extend(T_21_gt[keep])
+            T_21_ests.extend(T_21_est[keep])
+            pair_pose_ids.extend([[i_1, i_2] for i_2, i_1 in zip(idx_2[keep].tolist(), idx_1[keep].tolist())])
+            seqs.extend([seq]*int(keep.sum()))
 
     return (T_21_gts, T_21_ests, pair_pose_ids, seqs)
 
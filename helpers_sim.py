@@ -10,6 +10,9 @@ from qcqp_layers import QuadQuatFastSolver, convert_A_to_Avec
 from tensorboardX import SummaryWriter
 import time
 import tqdm
+import threading
+import queue
+import os
 
 def train_minibatch(model, loss_fn, optimizer, x, targets, A_prior=None):
     #Ensure model gradients are active
@@ -88,14 +91,15 @@ def train_test_model(args, train_data, test_data, model, loss_fn, rotmat_targets
     device = torch.device('cuda:0') if args.cuda else torch.device('cpu')
     tensor_type = torch.double if args.double else torch.float
 
+    if args.dataset != 'static':
+        data_stream = synthetic_data_source(args, device, tensor_type)
+
     pbar = tqdm.tqdm(total=args.epochs)
     for e in range(args.epochs):
         start_time = time.time()
 
         if args.dataset != 'static':
-            beachball = (args.dataset == 'dynamic_beachball')
-            beachball_factors = args.beachball_sigma_factors
-            train_data, test_data = create_experimental_data_fast(args.N_train, args.N_test, args.matches_per_sample, max_rotation_angle=args.max_rotation_angle, sigma=args.sim_sigma, beachball=beachball, beachball_factors=beachball_factors, device=device, dtype=tensor_type)
+            train_data, test_data = next(data_stream)
 
         #Train model
         if verbose:
@@ -232,18 +236,15 @@ def train_test_models_with_plots(args, train_data, test_data, models, loss_fns,
 
     # fig.show()
     # fig.canvas.draw()
+    if args.dataset != 'static':
+        data_stream = synthetic_data_source(args, device, tensor_type)
+
     with plot:
         for e in range(args.epochs):
             start_time = time.time()
 
             if args.dataset != 'static':
-                beachball = (args.dataset == 'dynamic_beachball')
-                beachball_factors = args.beachball_sigma_factors
-                train_data, test_data = create_experimental_data_fast(args.N_train, args.N_test, args.matches_per_sample,
-                                                                    max_rotation_angle=args.max_rotation_angle,
-                                                                    sigma=args.sim_sigma, beachball=beachball,
-                                                                    beachball_factors=beachball_factors, device=device,
-                                                                    dtype=tensor_type)
+                train_data, test_data = next(data_stream)
 
             num_train_batches = args.N_train // args.batch_size_train
             train_loss = torch.zeros(len(models))
@@ -306,17 +307,38 @@ def train_test_models_with_plots(args, train_data, test_data, models, loss_fns,
 
 def build_A(x_1, x_2, sigma_2):
     N = x_1.shape[0]
-    A = np.zeros((4, 4), dtype=np.float64)
-    for i in range(N):
-        # Block diagonal indices
-        I = np.eye(4, dtype=np.float64)
-        t1 = (x_2[i].dot(x_2[i]) + x_1[i].dot(x_1[i]))*I
-        t2 = 2.*Omega_l(pure_quat(x_2[i])).dot(
-            Omega_r(pure_quat(x_1[i])))
-        A_i = (t1 + t2)/(sigma_2[i])
-        A += A_i
+    sigma_2 = np.broadcast_to(sigma_2, (N,))
+    # Block diagonal indices
+    I = np.eye(4, dtype=np.float64)
+    t1 = ((x_2*x_2).sum(axis=1) + (x_1*x_1).sum(axis=1))[:, None, None]*I
+    t2 = 2.*Omega_lr(pure_quat(x_2), pure_quat(x_1))
+    A = ((t1 + t2)/sigma_2[:, None, None]).sum(axis=0)
     return A 
 
+def _build_omega_lr_basis(N, device, dtype):
+    #basis[k,l] = Omega_l(e_k)*Omega_r(e_l) for pure unit quaternions e_k, e_l
+    E = pure_quat(torch.eye(3, dtype=dtype, device=device))
+    return Omega_lr(E.unsqueeze(1), E.unsqueeze(0))
+
+def build_A_batch(x_1, x_2, sigma_2):
+    """
+    Batched torch version of build_A.
+    Input: x_1, x_2: BxNx3 tensors, sigma_2: scalar, N or BxN tensor of variances
+    Output: Bx4x4 tensor A = sum_i ((|x_1i|^2 + |x_2i|^2)*I + 2*Omega_l(x_2i)*Omega_r(x_1i))/sigma_2i
+    Omega_l and Omega_r are linear in their arguments, so the sum only needs the weighted 3x3 cross-covariance of x_2
+    and x_1. Differentiable w.r.t. all inputs.
+    """
+    if x_1.dim() < 3:
+        x_1 = x_1.unsqueeze(dim=0)
+        x_2 = x_2.unsqueeze(dim=0)
+    w = 1./torch.as_tensor(sigma_2, dtype=x_1.dtype, device=x_1.device)
+    w = w.expand(x_1.shape[0], x_1.shape[1])
+
+    basis = cached_constant('omega_lr_basis', 4, x_1.device, x_1.dtype, _build_omega_lr_basis)
+    M = torch.einsum('bn,bnk,bnl->bkl', w, x_2, x_1)
+    diag = (w*((x_1*x_1).sum(dim=2) + (x_2*x_2).sum(dim=2))).sum(dim=1)
+    return diag.view(-1, 1, 1)*cached_eye(4, x_1.device, x_1.dtype) + 2.*torch.einsum('bkl,klmn->bmn', M, basis)
+
 #Note sigma can be scalar or an N-dimensional vector of std. devs.
 def gen_sim_data(N, sigma, torch_vars=False, shuffle_points=False):
     ##Simulation
@@ -339,6 +361,22 @@ def gen_sim_data(N, sigma, torch_vars=False, shuffle_points=False):
 
     return C, x_1, x_2
 
+def gen_sim_data_batch(N_rotations, N, sigma, device=torch.device('cpu'), dtype=torch.double):
+    """
+    Batched torch version of gen_sim_data (same distributions), generated directly on the device.
+    sigma can be scalar or an N-dimensional vector of std. devs.
+    Output: Bx3x3 rotations C, BxNx3 vectors x_1 (unit length) and x_2 = C*x_1 + noise
+    """
+    C = SO3_torch.exp(torch.randn(N_rotations, 3, device=device, dtype=dtype)).as_matrix()
+    if C.dim() < 3:
+        C = C.unsqueeze(dim=0)
+    x_1 = torch.randn(N_rotations, N, 3, device=device, dtype=dtype)
+    x_1 = x_1/x_1.norm(dim=2, keepdim=True)
+    sigma = torch.as_tensor(sigma, device=device, dtype=dtype).view(-1, 1)
+    noise = sigma*torch.randn(N_rotations, N, 3, device=device, dtype=dtype)
+    x_2 = x_1.bmm(C.transpose(1, 2)) + noise
+    return C, x_1, x_2
+
 def unison_shuffled_copies(a, b):
     assert len(a) == len(b)
     p = np.random.permutation(len(a))
@@ -388,36 +426,36 @@ class SyntheticData():
         self.A_prior = A_prior
 
 
-def gen_sim_data_fast(N_rotations, N_matches_per_rotation, sigma, max_rotation_angle=None, dtype=torch.double):
+def gen_sim_data_fast(N_rotations, N_matches_per_rotation, sigma, max_rotation_angle=None, dtype=torch.double, generator=None):
     ##Simulation
     #Create a random rotation
-    axis = torch.randn(N_rotations, 3, dtype=dtype)
+    axis = torch.randn(N_rotations, 3, dtype=dtype, generator=generator)
     axis = axis / axis.norm(dim=1, keepdim=True)
     if max_rotation_angle:
         max_angle = max_rotation_angle*np.pi/180.
     else:
         max_angle = np.pi
     
-    angle = max_angle*torch.rand(N_rotations, 1)
+    angle = max_angle*torch.rand(N_rotations, 1, generator=generator)
 
     C = SO3_torch.exp(angle*axis).as_matrix()
     if N_rotations == 1:
         C = C.unsqueeze(dim=0)
     #Create two sets of vectors (normalized to unit l2 norm)
-    x_1 = torch.randn(N_rotations, 3, N_matches_per_rotation, dtype=dtype)
+    x_1 = torch.randn(N_rotations, 3, N_matches_per_rotation, dtype=dtype, generator=generator)
     x_1 = x_1/x_1.norm(dim=1,keepdim=True)   
     #Rotate and add noise
-    noise = sigma*torch.randn_like(x_1)
+    noise = sigma*torch.randn(x_1.shape, dtype=dtype, generator=generator)
     x_2 = C.bmm(x_1) + noise
     
     return C, x_1, x_2
 
-def gen_sim_data_beachball(N_rotations, N_matches_per_rotation, sigma, factors, dtype=torch.double):
+def gen_sim_data_beachball(N_rotations, N_matches_per_rotation, sigma, factors, dtype=torch.double, generator=None):
     ##Simulation
     #Create a random rotation
-    C = SO3_torch.exp(torch.randn(N_rotations, 3, dtype=dtype)).as_matrix()
+    C = SO3_torch.exp(torch.randn(N_rotations, 3, dtype=dtype, generator=generator)).as_matrix()
     #Create two sets of vectors (normalized to unit l2 norm)
-    x_1 = torch.randn(3, N_rotations*N_matches_per_rotation, dtype=dtype)
+    x_1 = torch.randn(3, N_rotations*N_matches_per_rotation, dtype=dtype, generator=generator)
     x_1 = x_1/x_1.norm(dim=0,keepdim=True)
 
     region_masks = [(x_1[0] < 0.) & (x_1[1] < 0.), 
@@ -427,7 +465,7 @@ def gen_sim_data_beachball(N_rotations, N_matches_per_rotation, sigma, factors,
 
     noise = torch.zeros_like(x_1)
     for r_i, region in enumerate(region_masks):
-        noise[:, region] = factors[r_i]*sigma*torch.randn_like(noise[:, region])
+        noise[:, region] = factors[r_i]*sigma*torch.randn(noise[:, region].shape, dtype=dtype, generator=generator)
 
     x_1 = x_1.view(3, N_rotations, N_matches_per_rotation).transpose(0,1) 
     noise = noise.view(3, N_rotations, N_matches_per_rotation).transpose(0,1) 
@@ -437,23 +475,94 @@ def gen_sim_data_beachball(N_rotations, N_matches_per_rotation, sigma, factors,
     x_2 = C.bmm(x_1) + noise
     return C, x_1, x_2
 
-def gen_sim_data_bottle(N_rotations, N_matches_per_rotation, sigma, factors, dtype=torch.double):
-    # load mustard bottle point and downsample
+class PointCloudAssetStore(object):
+    """
+    Object point clouds (e.g., YCB models) converted once into .npy files, one per uniform downsampling level
+    (every k-th point, as open3d's uniform_down_sample), and loaded memory-mapped afterwards.
+    The models are read from model_dir/<name>/<model_file> (.ply mesh or point cloud via open3d, or .xyz text).
+    The store location defaults to $ROTATION_ASSET_DIR (or ~/.cache/bingham_rotation_learning/point_clouds), the model
+    directory to $YCB_MODEL_DIR. A model directory is only needed to convert models that are not in the store yet.
+    """
+    def __init__(self, root=None, model_dir=None, model_file='textured_simple_colored.ply', downsample_levels=(1, 5, 20)):
+        if root is None:
+            root = os.environ.get('ROTATION_ASSET_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'bingham_rotation_learning', 'point_clouds'))
+        if model_dir is None:
+            model_dir = os.environ.get('YCB_MODEL_DIR')
+        self.root = root
+        self.model_dir = model_dir
+        self.model_file = model_file
+        self.downsample_levels = downsample_levels
+        self.num_conversions = 0
+        self._cache = {}
+
+    def asset_file(self, name, every_k):
+        return os.path.join(self.root, '{}_every_{}.npy'.format(name, every_k))
+
+    def read_model(self, name):
+        """ Parses the model file, returns an Nx3 array of points (vertices for meshes) """
+        if self.model_dir is None:
+            raise ValueError("Model '{}' is not in the asset store {} and no model directory is set. Pass model_dir or "
+                             "set YCB_MODEL_DIR to the YCB models directory.".format(name, self.root))
+        path = os.path.join(self.model_dir, name, self.model_file)
+        if path.endswith('.xyz'):
+            return np.loadtxt(path, usecols=(0, 1, 2))
+        import open3d as o3d
+        points = np.asarray(o3d.io.read_point_cloud(path).points)
+        if points.shape[0] == 0:
+            points = np.asarray(o3d.io.read_triangle_mesh(path).vertices)
+        if points.shape[0] == 0:
+            raise ValueError('No points found in {}.'.format(path))
+        return points
+
+    def convert(self, name):
+        """ Writes all downsampling levels of the model to the store """
+        points = self.read_model(name)
+        os.makedirs(self.root, exist_ok=True)
+        for every_k in self.downsample_levels:
+            file_name = self.asset_file(name, every_k)
+            tmp_file = file_name + '.tmp.npy'
+            np.save(tmp_file, np.ascontiguousarray(points[::every_k], dtype=np.float64))
+            os.replace(tmp_file, file_name)
+        self.num_conversions += 1
+
+    def load(self, name, every_k=20):
+        """ Returns the (read-only, memory-mapped) Nx3 points of the model, converting it on first use """
+        key = (name, every_k)
+        if key not in self._cache:
+            file_name = self.asset_file(name, every_k)
+            if not os.path.exists(file_name):
+                if every_k not in self.downsample_levels:
+                    self.downsample_levels = tuple(self.downsample_levels) + (every_k,)
+                self.convert(name)
+            self._cache[key] = np.load(file_name, mmap_mode='r')
+        return self._cache[key]
+
+    def sample(self, name, N, every_k=20):
+        """ Returns N random points (without replacement) of the model as an Nx3 array """
+        points = self.load(name, every_k)
+        inds = np.random.permutation(points.shape[0])[:N]
+        return np.array(points[inds])
+
+_DEFAULT_ASSET_STORE = None
+
+def default_asset_store():
+    global _DEFAULT_ASSET_STORE
+    if _DEFAULT_ASSET_STORE is None:
+        _DEFAULT_ASSET_STORE = PointCloudAssetStore()
+    return _DEFAULT_ASSET_STORE
+
+def gen_sim_data_bottle(N_rotations, N_matches_per_rotation, sigma, factors, dtype=torch.double, asset_store=None, model_name='006_mustard_bottle'):
+    # sample mustard bottle (or any other model of the asset store) points
 
     C = SO3_torch.exp(torch.randn(N_rotations, 3, dtype=dtype)).as_matrix()
 
-    import open3d as o3d
-    path = "/hri/localdisk2/datasets/YCB_Video_Dataset/models/006_mustard_bottle/textured_simple_colored.ply"
-    pcd = o3d.io.read_point_cloud(path)
-    pcd = pcd.uniform_down_sample(20)
-    points = np.asarray(pcd.points)
-
-    # random choice N_matches_per_rotation from points
-    inds = np.random.permutation(points.shape[0])[:N_matches_per_rotation]
-    points = points[inds]
+    if asset_store is None:
+        asset_store = default_asset_store()
+    # random choice N_matches_per_rotation from points (downsampled to every 20th point)
+    points = asset_store.sample(model_name, N_matches_per_rotation, every_k=20)
     points = points.T
 
-    x_1 = torch.from_numpy(points).double()
+    x_1 = torch.from_numpy(points).to(dtype)
     x_1 = x_1[None, ...].repeat(N_rotations, 1, 1) 
 
     noise = torch.randn_like(x_1)/1e5
@@ -461,17 +570,191 @@ def gen_sim_data_bottle(N_rotations, N_matches_per_rotation, sigma, factors, dty
     return C, x_1, x_2
 
 
-def create_experimental_data_fast(N_train=2000, N_test=50, N_matches_per_sample=100, sigma=0.01, beachball=False, max_rotation_angle=None, beachball_factors=None, device=torch.device('cpu'), dtype=torch.double):
+class SyntheticDataStream(object):
+    """
+    Iterable over freshly simulated (train_data, test_data) pairs (see create_experimental_data_fast), one per epoch.
+    The epochs are simulated ahead of training by num_workers background threads, at most queue_depth epochs ahead
+    per worker. Epoch e is simulated with its own generator seeded with seed + e, so the data depends on neither
+    num_workers nor timing. If seed is None, it is drawn from the global torch RNG (i.e., it follows torch.manual_seed).
+    """
+    def __init__(self, num_epochs, data_kwargs, queue_depth=2, num_workers=1, seed=None):
+        self.num_epochs = num_epochs
+        self.data_kwargs = data_kwargs
+        self.num_workers = max(1, min(num_workers, num_epochs))
+        self.seed = torch.randint(2**62, (1,)).item() if seed is None else seed
+        self.queues = [queue.Queue(maxsize=queue_depth) for _ in range(self.num_workers)]
+        self.stop = threading.Event()
+        self.workers = [threading.Thread(target=self._worker, args=(k,), daemon=True) for k in range(self.num_workers)]
+        for w in self.workers:
+            w.start()
+
+    @classmethod
+    def from_args(cls, args, device, dtype, queue_depth=2, num_workers=1, seed=None):
+        """ Stream of the dynamic datasets ('dynamic', 'dynamic_beachball') of the synthetic experiments """
+        data_kwargs = {'N_train': args.N_train, 'N_test': args.N_test, 'N_matches_per_sample': args.matches_per_sample,
+                       'sigma': args.sim_sigma, 'max_rotation_angle': args.max_rotation_angle,
+                       'beachball': args.dataset == 'dynamic_beachball', 'beachball_factors': args.beachball_sigma_factors,
+                       'device': device, 'dtype': dtype}
+        return cls(args.epochs, data_kwargs, queue_depth=queue_depth, num_workers=num_workers, seed=seed)
+
+    def _put(self, k, item):
+        while not self.stop.is_set():
+            try:
+                self.queues[k].put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _worker(self, k):
+        for e in range(k, self.num_epochs, self.num_workers):
+            try:
+                generator = torch.Generator().manual_seed(self.seed + e)
+                item = create_experimental_data_fast(generator=generator, **self.data_kwargs)
+            except Exception as err:
+                item = err
+            if not self._put(k, item) or isinstance(item, Exception):
+                return
+
+    def __len__(self):
+        return self.num_epochs
+
+    def __iter__(self):
+        for e in range(self.num_epochs):
+            item = self.queues[e % self.num_workers].get()
+            if isinstance(item, Exception):
+                self.close()
+                raise item
+            yield item
+        self.close()
+
+    def close(self):
+        self.stop.set()
+        for w in self.workers:
+            w.join()
+        self.workers = []
+
+
+class SyntheticDataGenerator(object):
+    """
+    Simulates the dynamic datasets of create_experimental_data_fast (same distributions) into persistent,
+    preallocated buffers on the target device. generate() refills the buffers in place with the device RNG and
+    returns the same two SyntheticData objects every time, so the data of the previous call is overwritten.
+    """
+    def __init__(self, N_train, N_test, N_matches_per_sample, sigma=0.01, beachball=False, max_rotation_angle=None,
+                 beachball_factors=None, device=torch.device('cpu'), dtype=torch.double, seed=None):
+        self.sigma = sigma
+        self.beachball = beachball
+        self.beachball_factors = beachball_factors
+        self.max_angle = max_rotation_angle*np.pi/180. if max_rotation_angle else np.pi
+        self.generator = torch.Generator(device=device)
+        self.generator.manual_seed(torch.randint(2**62, (1,)).item() if seed is None else seed)
+
+        self.data = []
+        self.workspaces = []
+        for N in [N_train, N_test]:
+            self.data.append(SyntheticData(torch.empty(N, 2, N_matches_per_sample, 3, device=device, dtype=dtype),
+                                           torch.empty(N, 4, device=device, dtype=dtype), None))
+            ws = {'phi': torch.empty(N, 3, device=device, dtype=dtype),
+                  'angle': torch.empty(N, 1, device=device, dtype=dtype),
+                  'sin': torch.empty(N, 1, device=device, dtype=dtype),
+                  'diag': torch.empty(N, 1, device=device, dtype=dtype),
+                  'C': torch.empty(N, 3, 3, device=device, dtype=dtype),
+                  'noise': torch.empty(N, N_matches_per_sample, 3, device=device, dtype=dtype),
+                  'norm': torch.empty(N, N_matches_per_sample, 1, device=device, dtype=dtype)}
+            if beachball:
+                ws['scale'] = torch.empty(N, N_matches_per_sample, device=device, dtype=dtype)
+                ws['mask_x'], ws['mask_y'], ws['mask'] = [torch.empty(N, N_matches_per_sample, device=device, dtype=torch.bool)
+                                                          for _ in range(3)]
+            self.workspaces.append(ws)
+
+    @classmethod
+    def from_args(cls, args, device, dtype, seed=None):
+        """ Generator of the dynamic datasets ('dynamic', 'dynamic_beachball') of the synthetic experiments """
+        return cls(args.N_train, args.N_test, args.matches_per_sample, sigma=args.sim_sigma,
+                   beachball=(args.dataset == 'dynamic_beachball'), max_rotation_angle=args.max_rotation_angle,
+                   beachball_factors=args.beachball_sigma_factors, device=device, dtype=dtype, seed=seed)
+
+    def _fill(self, data, ws):
+        g = self.generator
+        phi, angle, C = ws['phi'], ws['angle'], ws['C']
+
+        #Rotations: random axis, angle uniform in [0, max_angle] (gen_sim_data_fast) or |phi| (gen_sim_data_beachball)
+        phi.normal_(generator=g)
+        torch.norm(phi, dim=1, keepdim=True, out=angle)
+        phi.div_(angle)
+        if not self.beachball:
+            angle.uniform_(0., self.max_angle, generator=g)
+        angle.mul_(0.5)
+        torch.sin(angle, out=ws['sin'])
+        torch.mul(phi, ws['sin'], out=data.q[:, :3])
+        torch.cos(angle, out=data.q[:, 3:])
+
+        #C = (2w^2 - 1)*I + 2*v*v^T + 2*w*[v]^ (see quat_to_rotmat)
+        v, w = data.q[:, :3], data.q[:, 3]
+        torch.bmm(v.unsqueeze(2), v.unsqueeze(1), out=C)
+        C.mul_(2.)
+        torch.mul(data.q[:, 3:], data.q[:, 3:], out=ws['diag'])
+        C.diagonal(dim1=1, dim2=2).add_(ws['diag'].mul_(2.).sub_(1.))
+        for (i, j, k) in [(0, 1, 2), (1, 2, 0), (2, 0, 1)]:
+            C[:, i, j].addcmul_(w, v[:, k], value=-2.)
+            C[:, j, i].addcmul_(w, v[:, k], value=2.)
+
+        #Unit vectors x_1 and x_2 = C*x_1 + noise
+        x_1, x_2 = data.x[:, 0], data.x[:, 1]
+        x_1.normal_(generator=g)
+        torch.norm(x_1, dim=2, keepdim=True, out=ws['norm'])
+        x_1.div_(ws['norm'])
+
+        noise = ws['noise']
+        noise.normal_(generator=g)
+        if self.beachball:
+            mask_x, mask_y, mask, scale = ws['mask_x'], ws['mask_y'], ws['mask'], ws['scale']
+            torch.ge(x_1[:, :, 0], 0., out=mask_x)
+            torch.ge(x_1[:, :, 1], 0., out=mask_y)
+            f = self.beachball_factors
+            scale.fill_(f[0])
+            torch.logical_not(mask_y, out=mask)
+            scale.masked_fill_(mask.logical_and_(mask_x), f[1])
+            torch.logical_not(mask_x, out=mask)
+            scale.masked_fill_(mask.logical_and_(mask_y), f[2])
+            torch.logical_and(mask_x, mask_y, out=mask)
+            scale.masked_fill_(mask, f[3])
+            noise.mul_(scale.unsqueeze(2))
+        noise.mul_(self.sigma)
+        x_2.copy_(noise)
+        x_2.baddbmm_(x_1, C.transpose(1, 2))
+
+    def generate(self):
+        """ Refills and returns (train_data, test_data) """
+        for data, ws in zip(self.data, self.workspaces):
+            self._fill(data, ws)
+        return self.data[0], self.data[1]
+
+
+def synthetic_data_source(args, device, dtype):
+    """
+    Iterator over the (train_data, test_data) pairs of the dynamic synthetic datasets, one per epoch.
+    On the GPU, the data is simulated in place into persistent buffers (SyntheticDataGenerator), where the
+    kernels run asynchronously. On the CPU, the next epochs are simulated in background threads (SyntheticDataStream).
+    """
+    if torch.device(device).type == 'cuda':
+        generator = SyntheticDataGenerator.from_args(args, device, dtype)
+        return (generator.generate() for _ in range(args.epochs))
+    return iter(SyntheticDataStream.from_args(args, device, dtype))
+
+
+def create_experimental_data_fast(N_train=2000, N_test=50, N_matches_per_sample=100, sigma=0.01, beachball=False, max_rotation_angle=None, beachball_factors=None, device=torch.device('cpu'), dtype=torch.double, generator=None):
     
     if beachball:
-        C_train, x_1_train, x_2_train = gen_sim_data_beachball(N_train, N_matches_per_sample, sigma, beachball_factors)
-        C_test, x_1_test, x_2_test = gen_sim_data_beachball(N_test, N_matches_per_sample, sigma, beachball_factors)
+        C_train, x_1_train, x_2_train = gen_sim_data_beachball(N_train, N_matches_per_sample, sigma, beachball_factors, generator=generator)
+        C_test, x_1_test, x_2_test = gen_sim_data_beachball(N_test, N_matches_per_sample, sigma, beachball_factors, generator=generator)
         #C_train, x_1_train, x_2_train = gen_sim_data_bottle(N_train, N_matches_per_sample, sigma, beachball_factors)
         #C_test, x_1_test, x_2_test = gen_sim_data_bottle(N_test, N_matches_per_sample, sigma, beachball_factors)
 
     else:
-        C_train, x_1_train, x_2_train = gen_sim_data_fast(N_train, N_matches_per_sample, sigma, max_rotation_angle=max_rotation_angle)
-        C_test, x_1_test, x_2_test = gen_sim_data_fast(N_test, N_matches_per_sample, sigma, max_rotation_angle=max_rotation_angle)
+        C_train, x_1_train, x_2_train = gen_sim_data_fast(N_train, N_matches_per_sample, sigma, max_rotation_angle=max_rotation_angle, generator=generator)
+        C_test, x_1_test, x_2_test = gen_sim_data_fast(N_test, N_matches_per_sample, sigma, max_rotation_angle=max_rotation_angle, generator=generator)
 
     x_train = torch.empty(N_train, 2, N_matches_per_sample, 3, dtype=dtype, device=device)
     x_train[:,0,:,:] = x_1_train.transpose(1,2)
@@ -498,60 +781,26 @@ def create_experimental_data_fast(N_train=2000, N_test=50, N_matches_per_sample=
 
 def create_experimental_data(N_train=2000, N_test=50, N_matches_per_sample=100, sigma=0.01, device=torch.device('cpu'), dtype=torch.double):
 
-    x_train = torch.empty(N_train, 2, N_matches_per_sample, 3, dtype=dtype)
-    q_train = torch.empty(N_train, 4, dtype=dtype)
-    A_prior_train = torch.empty(N_train, 4, 4, dtype=dtype)
-
-    x_test = torch.empty(N_test, 2, N_matches_per_sample, 3, dtype=dtype)
-    q_test = torch.empty(N_test, 4, dtype=dtype)
-    A_prior_test = torch.empty(N_test, 4, 4, dtype=dtype)
-
-    sigma_sim_vec = sigma*np.ones(N_matches_per_sample)
+    sigma_sim_vec = sigma*torch.ones(N_matches_per_sample, device=device, dtype=dtype)
     #sigma_sim_vec[:int(N_matches_per_sample/2)] *= 10 #Artificially scale half the noise
-    sigma_prior_vec = sigma*np.ones(N_matches_per_sample)
-    
-
-    for n in range(N_train):
-
-        C, x_1, x_2 = gen_sim_data(N_matches_per_sample, sigma_sim_vec, torch_vars=True, shuffle_points=False)
-        q = rotmat_to_quat(C, ordering='xyzw')
-        x_train[n, 0, :, :] = x_1
-        x_train[n, 1, :, :] = x_2
-        q_train[n] = q
-        A_prior_train[n] = torch.from_numpy(build_A(x_1.numpy(), x_2.numpy(), sigma_2=sigma_prior_vec**2))
+    sigma_prior_vec = sigma*torch.ones(N_matches_per_sample, device=device, dtype=dtype)
 
-    for n in range(N_test):
-        C, x_1, x_2 = gen_sim_data(N_matches_per_sample, sigma_sim_vec, torch_vars=True, shuffle_points=False)
+    data = []
+    for N in [N_train, N_test]:
+        C, x_1, x_2 = gen_sim_data_batch(N, N_matches_per_sample, sigma_sim_vec, device=device, dtype=dtype)
+        x = torch.stack([x_1, x_2], dim=1)
         q = rotmat_to_quat(C, ordering='xyzw')
-        x_test[n, 0, :, :] = x_1
-        x_test[n, 1, :, :] = x_2
-        q_test[n] = q
-        A_prior_test[n] = torch.from_numpy(build_A(x_1.numpy(), x_2.numpy(), sigma_2=sigma_prior_vec**2))
+        if q.dim() < 2:
+            q = q.unsqueeze(dim=0)
+        A_prior = build_A_batch(x_1, x_2, sigma_prior_vec**2)
+        data.append(SyntheticData(x, q, A_prior))
 
-        # A_vec = convert_A_to_Avec(A_prior_test[n]).unsqueeze(dim=0)
-        # print(q - QuadQuatFastSolver.apply(A_vec).squeeze())
-    
-
-    x_train = x_train.to(device=device)
-    q_train = q_train.to(device=device)
-    A_prior_train = A_prior_train.to(device=device)
-    x_test = x_test.to(device=device)
-    q_test = q_test.to(device=device)
-    A_prior_test = A_prior_test.to(device=device)
-
-    train_data = SyntheticData(x_train, q_train, A_prior_train)
-    test_data = SyntheticData(x_test, q_test, A_prior_test)
-    
+    train_data, test_data = data
     return train_data, test_data
 
 def compute_mean_horn_error(sim_data):
-    N = sim_data.x.shape[0]
-    err = torch.empty(N)
-    for i in range(N):
-        x = sim_data.x[i]
-        x_1 = x[0,:,:].numpy()
-        x_2 = x[1,:,:].numpy()
-        C = torch.from_numpy(solve_horn(x_1, x_2))
-        q_est = rotmat_to_quat(C, ordering='xyzw')
-        err[i] = quat_angle_diff(q_est, sim_data.q[i])
+    x = sim_data.x
+    C = solve_horn_batch(x[:, 0].double(), x[:, 1].double())
+    q_est = rotmat_to_quat(C, ordering='xyzw')
+    err = quat_angle_diff(q_est, sim_data.q.to(q_est.dtype), reduce=False)
     return err.mean()
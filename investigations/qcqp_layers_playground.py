@@ -3,18 +3,20 @@ import scipy as sp
 from liegroups.numpy import SO3
 import cvxpy as cp
 import time
+import warnings
 import torch
-# from rotation_matrix_sdp import solve_equality_QCQP_dual, rotation_matrix_constraints
+from rotation_matrix_sdp import solve_equality_QCQP_dual_batch, rotation_matrix_constraints
+from qcqp_layers import convert_Avec_to_A
+
+CONSTRAINT_MATRICES, C_VEC = rotation_matrix_constraints()
+CONSTRAINT_MATRICES = torch.from_numpy(CONSTRAINT_MATRICES)
+C_VEC = torch.from_numpy(C_VEC)
 
 
 def solve_rotation_qcqp(A, constraint_matrices, constraint_vec):
-    r_out = A.new_zeros((A.shape[0], 10))
-    nu_out = A.new_zeros((A.shape[0], 22))
-    for idx in range(A.shape[0]):
-        nu, R = solve_equality_QCQP_dual(A[idx, :, :], constraint_matrices, constraint_vec, is_torch=True)
-        r_out[idx, :] = torch.from_numpy(np.append(np.reshape(R, (9,), order='F'), 1.))
-        nu_out[idx, :] = torch.from_numpy(nu)
-    return r_out, nu_out
+    """ Solves the dual of the homogeneous rotation QCQP for a (B,10,10) batch A, see solve_equality_QCQP_dual_batch
+    Returns the solutions r, the multipliers nu and the (B,) boolean mask of the converged samples"""
+    return solve_equality_QCQP_dual_batch(A.detach(), constraint_matrices, constraint_vec)
 
 
 class HomogeneousRotationQCQPFastSolver(torch.autograd.Function):
@@ -24,16 +26,19 @@ class HomogeneousRotationQCQPFastSolver(torch.autograd.Function):
     @staticmethod
     def forward(ctx, A_vec):
         if A_vec.dim() < 2:
-            A_vec = A_vec.unsqueeze()
-        A = convert_Avec_to_A(A_vec)
-        r, nu = solve_rotation_qcqp(A, CONSTRAINT_MATRICES, C_VEC)
+            A_vec = A_vec.unsqueeze(dim=0)
+        A = convert_Avec_to_A(A_vec).view(-1, 10, 10)
+        r, nu, converged = solve_rotation_qcqp(A, CONSTRAINT_MATRICES, C_VEC)
+        if not converged.all():
+            warnings.warn('{} of {} rotation QCQP dual solves did not converge.'.format(
+                (~converged).sum().item(), converged.numel()))
         ctx.save_for_backward(A, r, nu)
         return r
 
     @staticmethod
     def backward(ctx, grad_output):
         A, r, nu = ctx.saved_tensors
-        grad_qcqp = compute_rotation_QCQP_grad_fast(A, CONSTRAINT_MATRICES, nu, r)
+        grad_qcqp = compute_rotation_QCQP_grad_fast(A, CONSTRAINT_MATRICES.to(A.dtype), nu, r)
         outgrad = torch.einsum('bkq,bk->bq', grad_qcqp, grad_output)
         return outgrad
 
@@ -64,9 +69,6 @@ def compute_rotation_QCQP_grad_fast(A, E, nu, x):
     M[:, :10, 10:] = B
     M[:, 10:, :10] = B.transpose(1, 2)
 
-    # Eig check
-    eigs, _ = torch.symeig(M)
-
     b = A.new_zeros((A.shape[0], 10+num_constraints, 55))
     # symmetric matrix indices
     idx = torch.triu_indices(10, 10)
@@ -82,7 +84,7 @@ def compute_rotation_QCQP_grad_fast(A, E, nu, x):
     b[:, :10, :] = torch.einsum('bkij,bi->bjk', I_ij, x)
 
     # This solves all gradients simultaneously!
-    X, _ = torch.solve(b, M)
+    X = torch.linalg.solve(M, b)
 
     grad = -1 * X[:, :10, :]
 
@@ -270,16 +272,6 @@ def q_from_qqT(qqT):
     return q
 
 
-def solve_rotation_qcqp(A, constraint_matrices, constraint_vec):
-    r_out = A.new_zeros((A.shape[0], 10))
-    nu_out = A.new_zeros((A.shape[0], 22))
-    for idx in range(A.shape[0]):
-        nu, R = solve_equality_QCQP_dual(A[idx, :, :], constraint_matrices, constraint_vec, is_torch=True)
-        r_out[idx, :] = torch.from_numpy(np.append(np.reshape(R, (9,), order='F'), 1))
-        nu_out[idx, :] = torch.from_numpy(nu)
-    return r_out, nu_out
-
-
 def compute_rotation_QCQP_grad(A, E, nu, x):
     """
     Input: A_vec: (B,10,10) tensor (parametrices B symmetric 4x4 matrices)
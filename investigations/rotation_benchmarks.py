@@ -0,0 +1,195 @@
+"""
+Forward/backward latency and throughput of the rotation representations (network heads and differentiable solvers),
+swept over batch size, dtype and number of threads. Results are written as JSON together with environment metadata.
+
+Usage: python rotation_benchmarks.py --cases quat sixdim quat_qcqp --batch_sizes 100 1000 --output results.json
+"""
+import torch
+import numpy as np
+import time
+import json
+import platform
+import subprocess
+import argparse
+import os
+import sys
+sys.path.insert(0,'..')
+from qcqp_layers import QuadQuatFastSolver, QuadQuatWarmStartSolver, solve_wahba_fast, convert_Avec_to_Avec_psd
+from utils import sixdim_to_rotmat
+
+def _quat_head(batch_size, dtype):
+    x = torch.randn(batch_size, 4, dtype=dtype)
+    return x, lambda x: x / x.norm(dim=1, keepdim=True)
+
+def _sixdim_head(batch_size, dtype):
+    return torch.randn(batch_size, 6, dtype=dtype), sixdim_to_rotmat
+
+def _quat_qcqp(batch_size, dtype):
+    return torch.randn(batch_size, 10, dtype=dtype), QuadQuatFastSolver.apply
+
+def _rotmat_qcqp(batch_size, dtype):
+    from qcqp_layers_playground import HomogeneousRotationQCQPFastSolver
+    A_vec = convert_Avec_to_Avec_psd(torch.randn(batch_size, 55, dtype=dtype))
+    return A_vec, HomogeneousRotationQCQPFastSolver.apply
+
+def _rotmat_sdp(batch_size, dtype):
+    from sdp_layers import RotMatSDPSolver
+    A_vec = convert_Avec_to_Avec_psd(torch.randn(batch_size, 55, dtype=dtype))
+    return A_vec, RotMatSDPSolver(solver='ipm')
+
+def _wahba_stream(batch_size, dtype, solver):
+    #Alternates between two nearby PSD matrices, as consecutive frames of batch_size streams
+    L = torch.randn(batch_size, 4, 4, dtype=dtype)
+    dA = 1e-3*torch.randn(batch_size, 4, 4, dtype=dtype)
+    frames = [L.bmm(L.transpose(1, 2)), L.bmm(L.transpose(1, 2)) + dA + dA.transpose(1, 2)]
+    state = {'frame': 0}
+    def solve_next(A):
+        state['frame'] += 1
+        return solver(frames[state['frame'] % 2])
+    return frames[0], solve_next
+
+def _wahba_fast(batch_size, dtype):
+    return _wahba_stream(batch_size, dtype, lambda A: solve_wahba_fast(A)[0])
+
+def _wahba_warm_start(batch_size, dtype):
+    #min_batch_size=1 times the warm start itself, also for the small batches it would hand to solve_wahba_fast
+    return _wahba_stream(batch_size, dtype, QuadQuatWarmStartSolver(min_batch_size=1))
+
+#name -> builder(batch_size, dtype) returning (input, differentiable function of the input)
+BENCHMARK_CASES = {
+    'quat': _quat_head,
+    'sixdim': _sixdim_head,
+    'quat_qcqp': _quat_qcqp,
+    'rotmat_qcqp': _rotmat_qcqp,
+    'rotmat_sdp': _rotmat_sdp,
+    'wahba_fast': _wahba_fast,
+    'wahba_warm_start': _wahba_warm_start,
+}
+
+#Inference-only cases (per-frame latency of streaming solvers), only timed forward
+INFERENCE_CASES = {'wahba_fast', 'wahba_warm_start'}
+
+_DTYPES = {'float': torch.float, 'double': torch.double}
+
+
+def environment_metadata():
+    """Describes the machine and software stack that produced a set of timings."""
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                         stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'git_commit': commit,
+        'python': platform.python_version(),
+        'torch': torch.__version__,
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'machine': platform.machine(),
+        'processor': platform.processor(),
+        'cpu_count': os.cpu_count(),
+        'default_num_threads': torch.get_num_threads(),
+        'mkl': torch.backends.mkl.is_available(),
+        'openmp': torch.backends.openmp.is_available(),
+        'cuda_device': torch.cuda.get_device_name(0) if torch.cuda.is_available() else None,
+    }
+
+def time_case(fn, x, num_repeats=5, backward=True):
+    """Returns the per-repeat forward and forward+backward wall times (sec) of fn(x), after one warm-up call."""
+    x = x.clone().requires_grad_(backward)
+    grad_output = None
+    fwd_times, fwd_bwd_times = [], []
+    for i in range(num_repeats + 1):
+        x.grad = None
+        start = time.perf_counter()
+        out = fn(x)
+        fwd_time = time.perf_counter() - start
+        if backward:
+            if grad_output is None:
+                grad_output = torch.randn_like(out)
+            out.backward(grad_output)
+        fwd_bwd_time = time.perf_counter() - start
+        if i > 0:
+            fwd_times.append(fwd_time)
+            fwd_bwd_times.append(fwd_bwd_time)
+    return fwd_times, fwd_bwd_times
+
+def _summary(times, batch_size):
+    return {
+        'min_sec': min(times),
+        'median_sec': float(np.median(times)),
+        'throughput_per_sec': batch_size / min(times),
+    }
+
+def run_benchmarks(cases=None, batch_sizes=(100, 1000), dtypes=('float', 'double'), num_threads=None,
+                   num_repeats=5, backward=True, seed=0, verbose=True):
+    """
+    Times every combination of case, batch size, dtype and thread count. INFERENCE_CASES are only timed forward.
+    Returns a list of result records (dicts). Cases that raise are recorded with an 'error' entry instead of timings,
+    so that the remaining cases still run. Every case is expected to run in both precisions: an error is a failure.
+    """
+    cases = list(BENCHMARK_CASES) if cases is None else cases
+    num_threads = [torch.get_num_threads()] if num_threads is None else num_threads
+    default_threads = torch.get_num_threads()
+    results = []
+    try:
+        for threads in num_threads:
+            torch.set_num_threads(threads)
+            for name in cases:
+                for dtype in dtypes:
+                    for batch_size in batch_sizes:
+                        torch.manual_seed(seed)
+                        record = {'case': name, 'batch_size': batch_size, 'dtype': dtype, 'num_threads': threads}
+                        case_backward = backward and name not in INFERENCE_CASES
+                        try:
+                            x, fn = BENCHMARK_CASES[name](batch_size, _DTYPES[dtype])
+                            fwd_times, fwd_bwd_times = time_case(fn, x, num_repeats, case_backward)
+                            record['forward'] = _summary(fwd_times, batch_size)
+                            if case_backward:
+                                record['forward_backward'] = _summary(fwd_bwd_times, batch_size)
+                            if hasattr(fn, 'num_fallback'):
+                                record['fallback_rate'] = fn.num_fallback / max(fn.num_solves, 1)
+                        except Exception as e:
+                            record['error'] = '{}: {}'.format(type(e).__name__, e)
+                        if verbose:
+                            print(_format_record(record))
+                        results.append(record)
+    finally:
+        torch.set_num_threads(default_threads)
+    return results
+
+def _format_record(record):
+    out_str = '{} | {} | B = {} | {} thread(s)'.format(record['case'], record['dtype'], record['batch_size'],
+                                                      record['num_threads'])
+    if 'error' in record:
+        return out_str + ' | failed ({})'.format(record['error'])
+    for key in ['forward', 'forward_backward']:
+        if key in record:
+            out_str += ' | {}: {:.3E} sec ({:.2E}/sec)'.format(key, record[key]['min_sec'],
+                                                               record[key]['throughput_per_sec'])
+    return out_str
+
+def save_results(results, output_file, config=None):
+    with open(output_file, 'w') as f:
+        json.dump({'metadata': environment_metadata(), 'config': config, 'results': results}, f, indent=2)
+
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser(description='Rotation representation throughput benchmarks.')
+    parser.add_argument('--cases', nargs='+', choices=list(BENCHMARK_CASES), default=list(BENCHMARK_CASES))
+    parser.add_argument('--batch_sizes', nargs='+', type=int, default=[1, 100, 1000, 10000])
+    parser.add_argument('--dtypes', nargs='+', choices=list(_DTYPES), default=['float', 'double'])
+    parser.add_argument('--threads', nargs='+', type=int, default=None)
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--forward_only', action='store_true', default=False)
+    parser.add_argument('--output', type=str, default='rotation_benchmarks.json')
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.cases, args.batch_sizes, args.dtypes, args.threads, args.repeats,
+                             backward=not args.forward_only)
+    save_results(results, args.output, config=vars(args))
+    print('Saved {} results to {}.'.format(len(results), args.output))
+    num_errors = sum('error' in record for record in results)
+    if num_errors > 0:
+        sys.exit('{} of {} benchmark runs failed.'.format(num_errors, len(results)))
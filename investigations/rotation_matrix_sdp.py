@@ -1,6 +1,7 @@
 import numpy as np
 import cvxpy as cp
 import time, tqdm
+import torch
 from torch import from_numpy
 
 def rotation_matrix_constraints(redundant=True, right_handed=True, homogeneous=True):
@@ -135,6 +136,208 @@ def solve_equality_QCQP_dual(cost_matrix, constraint_matrices, c_vec, is_torch=F
     return nu.value, R
 
 
+def solve_equality_QCQP_dual_batch(cost_matrices, constraint_matrices, c_vec, max_iter=100, tol=1e-10):
+    """
+    Batched, torch-native version of solve_equality_QCQP_dual for (B,N,N) cost matrices.
+    A combination E(u) of the constraint matrices is the identity, so nu - lambda_min(A + E(nu))*u is dual feasible
+    for any nu. This removes the LMI and the dual becomes the unconstrained maximization of the concave function
+    f(nu) = -c^T nu + (c^T u)*lambda_min(A + E(nu)), which is solved with Levenberg-Marquardt damped Newton steps.
+    f is smooth at the optimum when lambda_min is simple, i.e., when the relaxation is tight (rank-1 solution).
+
+    :param cost_matrices: (B,N,N) tensor
+    :param constraint_matrices: (M,N,N) tensor or array
+    :param c_vec: (M,) tensor or array
+    :return: (B,N) tensor of solutions [vec(R) (column major), 1], (B,M) tensor of multipliers nu (in the dtype of A),
+             (B,) boolean mask of the samples that converged within max_iter iterations
+    """
+    A = cost_matrices
+    if A.dim() < 3:
+        A = A.unsqueeze(dim=0)
+    # The dual function can only be maximized to O(sqrt(eps)) in nu, so lower precision inputs are solved in float64
+    dtype = A.dtype
+    A = A.double()
+    E = torch.as_tensor(constraint_matrices).to(dtype=A.dtype, device=A.device)
+    c = torch.as_tensor(c_vec).to(dtype=A.dtype, device=A.device)
+    M, N = E.shape[0], E.shape[1]
+
+    I = torch.eye(N, dtype=A.dtype, device=A.device)
+    u = torch.linalg.pinv(E.view(M, -1).t()).mv(I.view(-1))
+    if (torch.einsum('i,imn->mn', u, E) - I).abs().max() > 1e-8:
+        raise ValueError('The identity is not a combination of the constraint matrices.')
+    c_u = c.dot(u)
+
+    # Solve with unit norm costs and scale nu back
+    A_scale = A.norm(dim=[1,2]).view(-1, 1, 1)
+    A = A / A_scale
+
+    def dual_objective(A, nu):
+        nus, vecs = torch.linalg.eigh(A + torch.einsum('bi,imn->bmn', nu, E))
+        return -nu.mv(c) + c_u*nus[:, 0], nus, vecs
+
+    nu = A.new_zeros((A.shape[0], M))
+    f, nus, vecs = dual_objective(A, nu)
+    damping = A.new_full((A.shape[0],), 1e-2)
+    active = torch.arange(A.shape[0], device=A.device)
+
+    for _ in range(max_iter):
+        A_a, nu_a, f_a, nus_a, vecs_a, damping_a = A[active], nu[active], f[active], nus[active], vecs[active], damping[active]
+
+        # W[b,i,k] = v_0^T E_i v_k, the gradient and Hessian of lambda_min follow from first/second order perturbation theory
+        W = torch.einsum('bm,imn,bnk->bik', vecs_a[:, :, 0], E, vecs_a)
+        grad = -c + c_u*W[:, :, 0]
+        W_k = W[:, :, 1:] / (nus_a[:, 1:] - nus_a[:, :1]).clamp(min=1e-14).sqrt().unsqueeze(1)
+        neg_hess = 2.*c_u*W_k.bmm(W_k.transpose(1, 2))
+        step = torch.linalg.solve(neg_hess + damping_a.view(-1, 1, 1)*torch.eye(M, dtype=A.dtype, device=A.device),
+                                  grad.unsqueeze(2)).squeeze(2)
+
+        f_new, nus_new, vecs_new = dual_objective(A_a, nu_a + step)
+        accept = f_new > f_a
+        # Stop when the gradient vanishes or when the predicted increase is below the precision of f
+        done = (grad.norm(dim=1) < tol) | (~accept & ((grad*step).sum(dim=1) < 1e-13))
+        accept = accept & ~done
+
+        nu[active] = torch.where(accept.unsqueeze(1), nu_a + step, nu_a)
+        f[active] = torch.where(accept, f_new, f_a)
+        nus[active] = torch.where(accept.unsqueeze(1), nus_new, nus_a)
+        vecs[active] = torch.where(accept.view(-1, 1, 1), vecs_new, vecs_a)
+        damping[active] = torch.where(accept, damping_a/3., damping_a*4.).clamp(1e-12, 1e12)
+
+        active = active[~done]
+        if active.numel() == 0:
+            break
+
+    converged = torch.ones(A.shape[0], dtype=torch.bool, device=A.device)
+    converged[active] = False
+
+    # Shift along u so that A + E(nu) is PSD and singular, its null vector is the primal solution
+    nu = (nu - nus[:, :1]*u)*A_scale.view(-1, 1)
+    r = vecs[:, :, 0] / vecs[:, -1:, 0]
+    return r.to(dtype), nu.to(dtype), converged
+
+def independent_constraints(constraint_matrices, tol=1e-10):
+    """ Returns the indices of a maximal linearly independent subset of the (M,N,N) constraint matrices (greedy, in order) """
+    if torch.is_tensor(constraint_matrices):
+        constraint_matrices = constraint_matrices.cpu().numpy()
+    E = np.asarray(constraint_matrices).reshape(len(constraint_matrices), -1)
+    rows = []
+    for idx in range(E.shape[0]):
+        if np.linalg.matrix_rank(E[rows + [idx]], tol) > len(rows):
+            rows.append(idx)
+    return rows
+
+def _sdp_max_step(X, dX):
+    """ Largest alpha (possibly inf) such that X + alpha*dX stays PSD, zero if X is not numerically PD """
+    d, V = torch.linalg.eigh(X)
+    bad = d[:, 0] <= 0.
+    X_isqrt = V / d.clamp(min=1e-300).sqrt().unsqueeze(1)
+    S = X_isqrt.transpose(1, 2).bmm(dX).bmm(X_isqrt)
+    bad = bad | ~torch.isfinite(S).all(dim=2).all(dim=1)
+    S = S.masked_fill(bad.view(-1, 1, 1), 0.)
+    lam_min = torch.linalg.eigvalsh(0.5*(S + S.transpose(1, 2)))[:, 0]
+    alpha = torch.where(lam_min < 0., -1./lam_min, torch.full_like(lam_min, float('inf')))
+    return alpha.masked_fill(bad, 0.)
+
+def _sdp_converged(C, E, b, X, y, Z, tol):
+    """
+    (B,) mask of the samples of solve_equality_SDP_batch whose iterates X, y, Z (for unit norm costs C and the
+    independent constraints E, b) are primal feasible, dual feasible and complementary, each to 1e3*tol
+    """
+    r_p = b - torch.einsum('imn,bmn->bi', E, X)
+    R_d = C - torch.einsum('bi,imn->bmn', y, E) - Z
+    return (r_p.norm(dim=1) < 1e3*tol) & (R_d.norm(dim=[1,2]) < 1e3*tol) & ((X*Z).sum(dim=[1,2]) < 1e3*tol)
+
+def solve_equality_SDP_batch(cost_matrices, constraint_matrices, c_vec, max_iter=50, tol=1e-9):
+    """
+    Batched, torch-native version of solve_equality_SDP: min tr(A X) s.t. X >= 0, tr(E_i X) = c_i for (B,N,N) costs A.
+    Primal-dual interior-point method (HKM direction, Mehrotra predictor-corrector). All problems share the same
+    constraints, so each Newton step is a handful of batched matrix operations; converged problems drop out of the batch.
+    Linearly dependent (redundant) constraints are dropped internally, their multipliers are zero.
+
+    :param cost_matrices: (B,N,N) tensor
+    :param constraint_matrices: (M,N,N) tensor or array
+    :param c_vec: (M,) tensor or array
+    :return: (B,N,N) tensor of solutions X, (B,M) tensor of multipliers nu (Z = A + sum_i nu_i E_i >= 0, X Z = 0),
+             (B,) boolean mask of the samples that converged within max_iter iterations
+    """
+    A = cost_matrices
+    if A.dim() < 3:
+        A = A.unsqueeze(dim=0)
+    rows = independent_constraints(constraint_matrices)
+    E = torch.as_tensor(constraint_matrices).to(dtype=A.dtype, device=A.device)
+    b = torch.as_tensor(c_vec).to(dtype=A.dtype, device=A.device)[rows]
+    E_ind = E[rows]
+    B, N = A.shape[0], A.shape[1]
+
+    def constraint_op(X):
+        return torch.einsum('imn,bmn->bi', E_ind, X)
+
+    def constraint_adj(y):
+        return torch.einsum('bi,imn->bmn', y, E_ind)
+
+    # Solve with unit norm costs and scale the dual variables back
+    A_scale = A.norm(dim=[1,2]).view(-1, 1, 1)
+    C = A / A_scale
+    I = torch.eye(N, dtype=A.dtype, device=A.device)
+    X = I.repeat(B, 1, 1)
+    Z = I.repeat(B, 1, 1)
+    y = A.new_zeros((B, len(rows)))
+    active = torch.arange(B, device=A.device)
+
+    for _ in range(max_iter):
+        X_a, Z_a, y_a, C_a = X[active], Z[active], y[active], C[active]
+        r_p = b - constraint_op(X_a)
+        R_d = C_a - constraint_adj(y_a) - Z_a
+        mu = (X_a*Z_a).sum(dim=[1,2]) / N
+        d_z, V_z = torch.linalg.eigh(Z_a)
+        done = (r_p.norm(dim=1) < tol) & (R_d.norm(dim=[1,2]) < tol) & (N*mu < tol)
+        done = done | (d_z[:, 0] <= 0.)
+        Z_inv = (V_z / d_z.clamp(min=1e-300).unsqueeze(1)).bmm(V_z.transpose(1, 2))
+
+        # Schur complement M_ij = tr(E_i X E_j Z^-1), shared by the predictor and corrector steps
+        G = torch.einsum('bmn,jnk->bjmk', X_a, E_ind).matmul(Z_inv.unsqueeze(1))
+        M = torch.einsum('imn,bjmn->bij', E_ind, G)
+        M = 0.5*(M + M.transpose(1, 2))
+        XRZ = X_a.bmm(R_d).bmm(Z_inv)
+
+        def newton_direction(sigma, corr):
+            R = (sigma*mu).view(-1, 1, 1)*Z_inv - X_a - XRZ - corr
+            dy = torch.linalg.solve(M, (r_p - constraint_op(R)).unsqueeze(2))
+            dy = dy.squeeze(2)
+            dX = R + torch.einsum('bj,bjmk->bmk', dy, G)
+            return 0.5*(dX + dX.transpose(1, 2)), dy, R_d - constraint_adj(dy)
+
+        dX_aff, _, dZ_aff = newton_direction(torch.zeros_like(mu), 0.)
+        alpha_p = _sdp_max_step(X_a, dX_aff).clamp(max=1.)
+        alpha_d = _sdp_max_step(Z_a, dZ_aff).clamp(max=1.)
+        mu_aff = ((X_a + alpha_p.view(-1, 1, 1)*dX_aff)*(Z_a + alpha_d.view(-1, 1, 1)*dZ_aff)).sum(dim=[1,2]) / N
+        sigma = (mu_aff / mu).clamp(0., 1.)**3
+
+        dX, dy, dZ = newton_direction(sigma, dX_aff.bmm(dZ_aff).bmm(Z_inv))
+        alpha_p = (0.98*_sdp_max_step(X_a, dX)).clamp(max=1.)
+        alpha_d = (0.98*_sdp_max_step(Z_a, dZ)).clamp(max=1.)
+        # Samples that cannot make progress anymore (numerically singular iterates) are stopped as well
+        stalled = (alpha_p == 0.) | (alpha_d == 0.)
+        stop = done | stalled
+        alpha_p = alpha_p.masked_fill(stop, 0.)
+        alpha_d = alpha_d.masked_fill(stop, 0.)
+
+        # Directions of stopped samples can be non-finite
+        X[active] = X_a + alpha_p.view(-1, 1, 1)*dX.masked_fill(stop.view(-1, 1, 1), 0.)
+        Z[active] = Z_a + alpha_d.view(-1, 1, 1)*dZ.masked_fill(stop.view(-1, 1, 1), 0.)
+        y[active] = y_a + alpha_d.view(-1, 1)*dy.masked_fill(stop.view(-1, 1), 0.)
+
+        active = active[~stop]
+        if active.numel() == 0:
+            break
+
+    # Iterates of stalled samples are kept, they count as converged if they are (nearly) feasible and optimal
+    converged = _sdp_converged(C, E_ind, b, X, y, Z, tol)
+
+    nu = A.new_zeros((B, E.shape[0]))
+    nu[:, rows] = -y*A_scale.view(-1, 1)
+    return X, nu, converged
+
+
 def check_KKT(cost_matrix, constraint_matrices, x, nu, trunc=0):
     grad = cost_matrix.dot(x)
     if trunc == 0:
@@ -146,6 +349,27 @@ def check_KKT(cost_matrix, constraint_matrices, x, nu, trunc=0):
     # gradient should be zero
     return grad
 
+def check_KKT_batch(cost_matrices, constraint_matrices, c_vec, x, nu, tol=1e-6, gap_tol=1e-6):
+    """
+    Batched optimality certificate for the QCQP min x^T A x s.t. x^T E_i x = c_i and its SDP relaxation.
+    x is certified if it is feasible, stationary (Z x = 0 for Z = A + sum_i nu_i E_i) and Z is PSD. If the second
+    smallest eigenvalue of Z is also positive, x x^T is the unique solution of the SDP (the relaxation is tight).
+    Tolerances are relative to the Frobenius norm of A.
+
+    :param cost_matrices: (B,N,N) tensor
+    :param constraint_matrices: (M,N,N) tensor
+    :param c_vec: (M,) tensor
+    :param x: (B,N) tensor of candidate solutions
+    :param nu: (B,M) tensor of candidate multipliers
+    :return: (B,) boolean mask of the certified samples
+    """
+    A_scale = cost_matrices.norm(dim=[1,2])
+    Z = cost_matrices + torch.einsum('bi,imn->bmn', nu, constraint_matrices)
+    primal_res = (torch.einsum('bm,imn,bn->bi', x, constraint_matrices, x) - c_vec).abs().max(dim=1)[0]
+    stationarity_res = Z.bmm(x.unsqueeze(2)).squeeze(2).norm(dim=1) / (A_scale*x.norm(dim=1))
+    Z_eigs = torch.linalg.eigvalsh(Z)
+    return (primal_res < tol) & (stationarity_res < tol) & (Z_eigs[:, 0] > -tol*A_scale) & (Z_eigs[:, 1] > gap_tol*A_scale)
+
 
 if __name__=='__main__':
 
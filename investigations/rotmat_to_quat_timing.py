@@ -0,0 +1,106 @@
+import torch
+import time
+import sys
+sys.path.insert(0,'..')
+from quaternions import rotmat_to_quat, quat_to_rotmat
+
+
+def rotmat_to_quat_masked(mat, ordering='xyzw'):
+    """ Previous implementation of quaternions.rotmat_to_quat (four masked branches), kept as a reference """
+    if mat.dim() < 3:
+        R = mat.unsqueeze(dim=0)
+    else:
+        R = mat
+
+    R = R.transpose(1,2)
+    q = R.new_empty((R.shape[0], 4))
+
+    cond1_mask = R[:, 2, 2] < 0.
+    cond1a_mask = R[:, 0, 0] > R[:, 1, 1]
+    cond1b_mask = R[:, 0, 0] < -R[:, 1, 1]
+
+    if ordering=='xyzw':
+        v_ind = torch.arange(0,3)
+        w_ind = 3
+    else:
+        v_ind = torch.arange(1,4)
+        w_ind = 0    
+
+    mask = cond1_mask & cond1a_mask
+    if mask.any():
+        t = 1 + R[mask, 0, 0] - R[mask, 1, 1] - R[mask, 2, 2]
+        q[mask, w_ind] =  R[mask, 1, 2]- R[mask, 2, 1]
+        q[mask, v_ind[0]] = t
+        q[mask, v_ind[1]] = R[mask, 0, 1] + R[mask, 1, 0]
+        q[mask, v_ind[2]] = R[mask, 2, 0] + R[mask, 0, 2]
+        q[mask, :] *= 0.5 / torch.sqrt(t.unsqueeze(dim=1))
+
+    mask = cond1_mask & cond1a_mask.logical_not()
+    if mask.any():
+        t = 1 - R[mask,0, 0] + R[mask,1, 1] - R[mask,2, 2]
+        q[mask, w_ind] =  R[mask,2, 0]-R[mask,0, 2]
+        q[mask, v_ind[0]] = R[mask,0, 1]+R[mask,1, 0]
+        q[mask, v_ind[1]] = t
+        q[mask, v_ind[2]] = R[mask,1, 2]+R[mask,2, 1]
+        q[mask, :] *= 0.5 / torch.sqrt(t.unsqueeze(dim=1))
+
+    mask = cond1_mask.logical_not() & cond1b_mask
+    if mask.any():
+        t = 1 - R[mask,0, 0] - R[mask,1, 1] + R[mask,2, 2]
+        q[mask, w_ind] =  R[mask,0, 1]-R[mask,1, 0]
+        q[mask, v_ind[0]] = R[mask,2, 0]+R[mask,0, 2]
+        q[mask, v_ind[1]] = R[mask,1, 2]+R[mask,2, 1]
+        q[mask, v_ind[2]] = t
+        q[mask, :] *= 0.5 / torch.sqrt(t.unsqueeze(dim=1))
+
+    mask = cond1_mask.logical_not() & cond1b_mask.logical_not()
+    if mask.any():
+        t = 1 + R[mask, 0, 0] + R[mask,1, 1] + R[mask,2, 2]
+        q[mask, w_ind] = t
+        q[mask, v_ind[0]] = R[mask,1, 2]-R[mask,2, 1]
+        q[mask, v_ind[1]] = R[mask,2, 0]-R[mask,0, 2]
+        q[mask, v_ind[2]] = R[mask,0, 1]-R[mask,1, 0]
+        q[mask, :] *= 0.5 / torch.sqrt(t.unsqueeze(dim=1))
+    
+    return q.squeeze()
+
+def random_rotmats(num_samples, dtype, device):
+    q = torch.randn((num_samples, 4), dtype=dtype, device=device)
+    return quat_to_rotmat(q / q.norm(dim=1, keepdim=True))
+
+def time_conversion(C, convert, num_repeats=3):
+    times = []
+    for _ in range(num_repeats):
+        if C.is_cuda:
+            torch.cuda.synchronize()
+        start = time.time()
+        convert(C)
+        if C.is_cuda:
+            torch.cuda.synchronize()
+        times.append(time.time() - start)
+    return min(times)
+
+if __name__=='__main__':
+    torch.set_grad_enabled(False)
+    devices = [torch.device('cpu')] + ([torch.device('cuda:0')] if torch.cuda.is_available() else [])
+    conversions = {
+        'masked': rotmat_to_quat_masked,
+        'branch-free': rotmat_to_quat
+    }
+
+    print('Max. abs. difference between the conversions (10^5 samples):')
+    for dtype in [torch.float, torch.double]:
+        C = random_rotmats(10**5, dtype, devices[0])
+        print('{}: {:.3E}'.format(dtype, (rotmat_to_quat_masked(C) - rotmat_to_quat(C)).abs().max().item()))
+
+    print('Throughput ({} thread(s)):'.format(torch.get_num_threads()))
+    for device in devices:
+        for dtype in [torch.float, torch.double]:
+            for num_samples in [10**6, 10**7]:
+                C = random_rotmats(num_samples, dtype, device)
+                out_str = '{} | {} | B = {:.0E}'.format(device, dtype, num_samples)
+                for name, convert in conversions.items():
+                    t = time_conversion(C, convert)
+                    out_str += ' | {}: {:.3f} sec ({:.2E} matrices/sec)'.format(name, t, num_samples/t)
+                print(out_str)
+                del C
@@ -1,9 +1,12 @@
 import cvxpy as cp
 import torch
+import torch.multiprocessing as mp
 from cvxpylayers.torch import CvxpyLayer
-from rotation_matrix_sdp import rotation_matrix_constraints
+from rotation_matrix_sdp import rotation_matrix_constraints, solve_equality_SDP_batch, solve_equality_QCQP_dual_batch, check_KKT_batch
 from qcqp_layers import *
 import time
+import warnings
+import weakref
 from utils import allclose
 from quaternions import *
 
@@ -60,16 +63,321 @@ def A_from_16_vec(vec):
 
 
 
+def build_rotmat_sdp_problem():
+    """ Returns the rotation matrix SDP, min tr(A X) s.t. X >= 0, tr(E_i X) = c_i, with its variable X and parameter A"""
+    X = cp.Variable((10, 10), PSD=True)
+    constraint_matrices, c_vec = rotation_matrix_constraints()
+    constraints = [cp.trace(constraint_matrices[idx, :, :] @ X) == c_vec[idx]
+                for idx in range(constraint_matrices.shape[0])]
+    A = cp.Parameter((10, 10), symmetric=True)
+    prob = cp.Problem(cp.Minimize(cp.trace(A @ X)), constraints)
+    return prob, X, A
+
+def _sdp_worker(tasks, results):
+    """
+    Worker process of SDPLayerPool. Keeps its own compiled CvxpyLayer and the autograd graphs of the forward
+    solves that still need a backward pass. Tensors are passed through shared memory by torch.multiprocessing.
+    """
+    torch.set_num_threads(1)
+    prob, X, A = build_rotmat_sdp_problem()
+    sdp_layer = CvxpyLayer(prob, parameters=[A], variables=[X])
+    graphs = {}
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        cmd, call_id, tensor = task
+        try:
+            if cmd == 'forward' or cmd == 'forward_no_grad':
+                keep_graph = cmd == 'forward'
+                A_chunk = tensor.clone().requires_grad_(keep_graph)
+                with torch.set_grad_enabled(keep_graph):
+                    X_chunk, = sdp_layer(A_chunk)
+                if keep_graph:
+                    graphs[call_id] = (A_chunk, X_chunk)
+                results.put(X_chunk.detach())
+            elif cmd == 'backward':
+                if call_id not in graphs:
+                    raise RuntimeError('no pending graph for call {} (backward can only run once per forward).'.format(call_id))
+                A_chunk, X_chunk = graphs.pop(call_id)
+                grad_A, = torch.autograd.grad(X_chunk, A_chunk, tensor)
+                results.put(grad_A)
+            elif cmd == 'release':
+                # Sent when the autograd graph of a forward call is freed, no reply
+                graphs.pop(call_id, None)
+        except Exception as e:
+            results.put(RuntimeError('SDP worker failed: {}'.format(e)))
+
+class SDPLayerPool(object):
+    """
+    Pool of worker processes that solve (and differentiate) chunks of a batch of rotation matrix SDPs in parallel.
+    Each worker compiles the SDP once and keeps its chunk's diffcp derivative until the matching backward call,
+    or until the graph of the forward call is freed without a backward pass (see release).
+    """
+    def __init__(self, num_workers):
+        ctx = mp.get_context('spawn')
+        self.num_workers = num_workers
+        self.tasks = [ctx.Queue() for _ in range(num_workers)]
+        self.results = [ctx.Queue() for _ in range(num_workers)]
+        self.workers = [ctx.Process(target=_sdp_worker, args=(self.tasks[k], self.results[k]), daemon=True)
+                        for k in range(num_workers)]
+        for w in self.workers:
+            w.start()
+        self.num_calls = 0
+
+    def _gather(self, num_chunks):
+        out = [self.results[k].get() for k in range(num_chunks)]
+        for o in out:
+            if isinstance(o, Exception):
+                raise o
+        return out
+
+    def forward(self, A, keep_graph):
+        """ Solves the (B,10,10) batch A, returns X, a call id (for backward) and the chunk sizes """
+        self.num_calls += 1
+        chunks = A.detach().cpu().chunk(min(self.num_workers, A.shape[0]))
+        cmd = 'forward' if keep_graph else 'forward_no_grad'
+        for k, A_chunk in enumerate(chunks):
+            self.tasks[k].put((cmd, self.num_calls, A_chunk))
+        X = torch.cat(self._gather(len(chunks)), dim=0).to(device=A.device, dtype=A.dtype)
+        return X, self.num_calls, [c.shape[0] for c in chunks]
+
+    def backward(self, call_id, chunk_sizes, grad_X):
+        grad_chunks = grad_X.detach().cpu().split(chunk_sizes)
+        for k, grad_chunk in enumerate(grad_chunks):
+            self.tasks[k].put(('backward', call_id, grad_chunk.contiguous()))
+        return torch.cat(self._gather(len(grad_chunks)), dim=0).to(device=grad_X.device, dtype=grad_X.dtype)
+
+    def release(self, call_id, num_chunks):
+        """ Frees the worker-side graphs of a forward call (no-op if they were already used by backward) """
+        for k in range(min(num_chunks, len(self.workers))):
+            self.tasks[k].put(('release', call_id, None))
+
+    def close(self):
+        for k, w in enumerate(self.workers):
+            if w.is_alive():
+                self.tasks[k].put(None)
+        for w in self.workers:
+            w.join()
+        self.workers = []
+
+class _PooledSDPFunction(torch.autograd.Function):
+    @staticmethod
+    def forward(ctx, A, pool):
+        X, call_id, chunk_sizes = pool.forward(A, keep_graph=ctx.needs_input_grad[0])
+        ctx.pool, ctx.call_id, ctx.chunk_sizes = pool, call_id, chunk_sizes
+        if ctx.needs_input_grad[0]:
+            weakref.finalize(ctx, pool.release, call_id, len(chunk_sizes))
+        return X
+
+    @staticmethod
+    def backward(ctx, grad_X):
+        return ctx.pool.backward(ctx.call_id, ctx.chunk_sizes, grad_X), None
+
+def rotmat_sdp_vjp(A, X, nu, constraint_matrices, grad_X):
+    """
+    Vector-Jacobian product of the SDP solution X(A) by implicit differentiation of the KKT conditions
+    Z x = 0, x^T E_i x = c_i (Z = A + sum_i nu_i E_i), assuming a tight relaxation, i.e., X = x x^T.
+    Perturbations of x are restricted to the tangent space of the constraints (the null space of B^T, B = [E_i x]),
+    which also handles the redundant constraints.
+    Input: (B,10,10) tensors A, X, grad_X, (B,M) tensor nu, (M,10,10) tensor constraint_matrices
+    Output: (B,10,10) tensor grad_A
+    """
+    E = constraint_matrices
+    Z = A + torch.einsum('bi,imn->bmn', nu, E)
+    x = X[:, :, -1] / X[:, -1:, -1].sqrt()
+    g = (grad_X + grad_X.transpose(1, 2)).bmm(x.unsqueeze(2))
+
+    B_x = torch.einsum('imn,bn->bmi', E, x)
+    _, V = torch.linalg.eigh(B_x.bmm(B_x.transpose(1, 2)))
+    U = V[:, :, :3]
+    w = torch.linalg.solve(U.transpose(1, 2).bmm(Z).bmm(U), U.transpose(1, 2).bmm(g))
+    w = U.bmm(w)
+    grad_A = -w.bmm(x.unsqueeze(1))
+    return 0.5*(grad_A + grad_A.transpose(1, 2))
+
+class RotMatSDPFastSolver(torch.autograd.Function):
+    """
+    Differentiable batched rotation matrix SDP solved with the torch interior-point method solve_equality_SDP_batch
+    Input: (B,10,10) cost matrices A
+    Output: (B,10,10) SDP solutions X, (B,) boolean mask of the samples on which the interior-point method converged
+    The backward pass uses rotmat_sdp_vjp and assumes that the relaxation is tight.
+    The interior-point method always runs in double precision, X is returned in the dtype of A.
+    """
+    @staticmethod
+    def forward(ctx, A, constraint_matrices, c_vec, max_iter=50):
+        X, nu, converged = solve_equality_SDP_batch(A.detach().double(), constraint_matrices.double(), c_vec.double(),
+                                                    max_iter=max_iter)
+        X, nu = X.to(A.dtype), nu.to(A.dtype)
+        ctx.save_for_backward(A, X, nu, constraint_matrices)
+        ctx.mark_non_differentiable(converged)
+        return X, converged
+
+    @staticmethod
+    def backward(ctx, grad_X, grad_converged):
+        A, X, nu, constraint_matrices = ctx.saved_tensors
+        return rotmat_sdp_vjp(A, X, nu, constraint_matrices, grad_X), None, None, None
+
+def rotmat_sdp_multipliers(A, X, constraint_matrices, rcond=1e-8):
+    """
+    Minimum norm Lagrange multipliers nu with (A + sum_i nu_i E_i) x = 0 for the rank-1 SDP solution X = x x^T.
+    The multipliers are not unique (the constraints are redundant), but all of them give the same gradient in
+    rotmat_sdp_vjp since they agree on the tangent space of the constraints.
+    Input: (B,10,10) tensors A, X, (M,10,10) tensor constraint_matrices
+    Output: (B,M) tensor nu
+    """
+    x = X[:, :, -1] / X[:, -1:, -1].sqrt()
+    B_x = torch.einsum('imn,bn->bmi', constraint_matrices, x)
+    return -torch.pinverse(B_x, rcond=rcond).bmm(A.bmm(x.unsqueeze(2))).squeeze(2)
+
+def is_rank_one(X, tol=1e-4):
+    """ (B,) mask of the PSD matrices X that are rank 1 up to tol, i.e., lambda_2(X) <= tol*lambda_max(X) """
+    eigs = torch.linalg.eigvalsh(X)
+    return eigs[:, -2] <= tol*eigs[:, -1]
+
+class _KKTSDPSolution(torch.autograd.Function):
+    """ Passes through a rank-1 SDP solution X = x x^T of A (with multipliers nu), with the KKT backward of rotmat_sdp_vjp """
+    @staticmethod
+    def forward(ctx, A, X, nu, constraint_matrices):
+        ctx.save_for_backward(A, X, nu, constraint_matrices)
+        return X.clone()
+
+    @staticmethod
+    def backward(ctx, grad_X):
+        A, X, nu, constraint_matrices = ctx.saved_tensors
+        return rotmat_sdp_vjp(A, X, nu, constraint_matrices, grad_X), None, None, None
+
 class RotMatSDPSolver(torch.nn.Module):
-    def __init__(self):
+    """
+    Differentiable rotation matrix SDP layer
+    Input: Bx55 (symmetric 10x10 A) or Bx16 (see A_from_16_vec) tensor 'A_vec'
+    Output: Bx3x3 rotation matrices
+    The CvxpyLayer is compiled once. If num_workers > 1, batches are split across a pool of worker processes
+    (see SDPLayerPool) that is started on the first call.
+    solver='ipm' solves the whole batch with the torch interior-point method instead (see RotMatSDPFastSolver).
+    Samples on which it does not converge within ipm_max_iter iterations are re-solved with cvxpylayers and counted
+    in num_ipm_failed.
+    If fast_path is True, the batch is first solved with the dual QCQP solver and every sample whose solution is
+    certified optimal (see check_KKT_batch) skips the SDP. num_solves and num_fallback count the samples
+    and the ones that needed the SDP.
+    If kkt_backward is True, the gradients come from implicit differentiation of the KKT conditions (see rotmat_sdp_vjp)
+    and cvxpylayers/diffcp is only used to solve the forward problem.
+    rotmat_sdp_vjp assumes a tight relaxation, so the KKT backward (and the interior-point backward) is only used for
+    SDP solutions that are rank 1 up to rank_tol (see is_rank_one). The other samples are solved and differentiated
+    with cvxpylayers/diffcp and counted in num_diffcp.
+    """
+    def __init__(self, num_workers=0, solver='cvxpylayers', fast_path=True, cert_tol=1e-6, kkt_backward=True,
+                 ipm_max_iter=50, rank_tol=1e-4):
         super(RotMatSDPSolver, self).__init__()
         
-        self.X = cp.Variable((10, 10), PSD=True)
+        self.prob, self.X, self.A = build_rotmat_sdp_problem()
         self.constraint_matrices, self.c_vec = rotation_matrix_constraints()
-        self.constraints = [cp.trace(self.constraint_matrices[idx, :, :] @ self.X) == self.c_vec[idx]
-                    for idx in range(self.constraint_matrices.shape[0])]
-        self.A = cp.Parameter((10, 10), symmetric=True)
-        self.prob = cp.Problem(cp.Minimize(cp.trace(self.A @ self.X)), self.constraints)
+        self.constraint_tensor = torch.from_numpy(self.constraint_matrices)
+        self.c_tensor = torch.from_numpy(self.c_vec).double()
+        self.constraints = self.prob.constraints
+        self.sdp_layer = CvxpyLayer(self.prob, parameters=[self.A], variables=[self.X])
+        self.num_workers = num_workers
+        self.pool = None
+        if solver not in ['cvxpylayers', 'ipm']:
+            raise ValueError("Unknown SDP solver '{}'.".format(solver))
+        self.solver = solver
+        self.ipm_max_iter = ipm_max_iter
+        self.fast_path = fast_path
+        self.kkt_backward = kkt_backward
+        self.cert_tol = cert_tol
+        self.rank_tol = rank_tol
+        self.num_solves = 0
+        self.num_fallback = 0
+        self.num_ipm_failed = 0
+        self.num_diffcp = 0
+
+    def constraint_tensors(self, A):
+        """ Returns the (22,10,10) constraint matrices and the (22,) vector c with the dtype and device of A """
+        return self.constraint_tensor.to(dtype=A.dtype, device=A.device), self.c_tensor.to(dtype=A.dtype, device=A.device)
+
+    def solve_sdp(self, A):
+        """ Returns the (B,10,10) SDP solutions X for the (B,10,10) cost matrices A """
+        if self.solver == 'ipm':
+            E, c = self.constraint_tensors(A)
+            X, converged = RotMatSDPFastSolver.apply(A, E, c, self.ipm_max_iter)
+            if not converged.all():
+                self.num_ipm_failed += (~converged).sum().item()
+                warnings.warn('{} of {} interior-point SDP solves did not converge, re-solving them with '
+                              'cvxpylayers.'.format((~converged).sum().item(), A.shape[0]))
+            ok = converged
+            if A.requires_grad and torch.is_grad_enabled():
+                ok = ok & is_rank_one(X.detach(), self.rank_tol)
+            ok_idx = ok.nonzero().squeeze(1)
+            redo_idx = (~ok).nonzero().squeeze(1)
+            if redo_idx.numel() == 0:
+                return X
+            X = torch.cat([X[ok_idx], self.solve_sdp_cvxpylayers(A[redo_idx])], dim=0)
+            return X[torch.cat([ok_idx, redo_idx]).argsort()]
+        return self.solve_sdp_cvxpylayers(A)
+
+    def solve_sdp_cvxpylayers(self, A):
+        """ Solves with cvxpylayers, differentiated with rotmat_sdp_vjp (kkt_backward, rank-1 solutions) or diffcp """
+        E, c = self.constraint_tensors(A)
+        if not self.kkt_backward:
+            self.num_diffcp += A.shape[0]
+            return self.solve_sdp_layer(A)
+        with torch.no_grad():
+            X = self.solve_sdp_layer(A.detach().double())
+            nu = rotmat_sdp_multipliers(A.detach().double(), X, E.double())
+        if not (A.requires_grad and torch.is_grad_enabled()):
+            return X.to(A.dtype)
+        tight = is_rank_one(X, self.rank_tol)
+        tight_idx = tight.nonzero().squeeze(1)
+        loose_idx = (~tight).nonzero().squeeze(1)
+        X_kkt = _KKTSDPSolution.apply(A[tight_idx], X[tight_idx].to(A.dtype), nu[tight_idx].to(A.dtype), E)
+        if loose_idx.numel() == 0:
+            return X_kkt
+        self.num_diffcp += loose_idx.numel()
+        X = torch.cat([X_kkt, self.solve_sdp_layer(A[loose_idx])], dim=0)
+        return X[torch.cat([tight_idx, loose_idx]).argsort()]
+
+    def solve_sdp_layer(self, A):
+        """
+        Solves with cvxpylayers (in the worker pool if num_workers > 1), differentiable with diffcp.
+        cvxpylayers solves in double precision, X is returned as a (B,10,10) tensor in the dtype of A.
+        """
+        if self.num_workers > 1 and A.shape[0] > 1:
+            if self.pool is None:
+                self.pool = SDPLayerPool(self.num_workers)
+            if not torch.is_grad_enabled():
+                return self.pool.forward(A, keep_graph=False)[0]
+            return _PooledSDPFunction.apply(A, self.pool)
+        X, = self.sdp_layer(A)
+        return X.view(-1, 10, 10).to(A.dtype)
+
+    def solve(self, A):
+        """ Like solve_sdp, but samples with a certified solution of the QCQP (tight relaxation) skip the SDP """
+        self.num_solves += A.shape[0]
+        if not self.fast_path:
+            self.num_fallback += A.shape[0]
+            return self.solve_sdp(A)
+
+        #The certificate is computed in double precision, float32 is not accurate enough for cert_tol
+        E, c = self.constraint_tensors(A.double())
+        with torch.no_grad():
+            r, nu, converged = solve_equality_QCQP_dual_batch(A.detach().double(), E, c)
+            certified = converged & check_KKT_batch(A.detach().double(), E, c, r, nu, tol=self.cert_tol,
+                                                    gap_tol=self.cert_tol)
+        r, nu, E = r.to(A.dtype), nu.to(A.dtype), E.to(A.dtype)
+        fast_idx = certified.nonzero().squeeze(1)
+        fallback_idx = (~certified).nonzero().squeeze(1)
+        self.num_fallback += fallback_idx.numel()
+
+        X = _KKTSDPSolution.apply(A[fast_idx], r[fast_idx].unsqueeze(2)*r[fast_idx].unsqueeze(1), nu[fast_idx], E)
+        if fallback_idx.numel() == 0:
+            return X
+        X = torch.cat([X, self.solve_sdp(A[fallback_idx])], dim=0)
+        return X[torch.cat([fast_idx, fallback_idx]).argsort()]
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool = None
 
     def forward(self, A_vec):
         
@@ -79,11 +387,9 @@ class RotMatSDPSolver(torch.nn.Module):
         if A_vec.shape[1] == 16:
             A = A_from_16_vec(A_vec)
         else:
-            A = convert_Avec_to_A(A_vec)
+            A = convert_Avec_to_A(A_vec).view(-1, 10, 10)
         
-        sdp_solver = CvxpyLayer(self.prob, parameters=[self.A], variables=[self.X])
-        X, = sdp_solver(A)
-        del(sdp_solver)
+        X = self.solve(A)
         x = x_from_xxT(X)
 
 
@@ -95,25 +401,32 @@ class RotMatSDPSolver(torch.nn.Module):
         return rotmat.squeeze()
 
 
-def test_16_vec():
+def test_16_vec(num_workers=0, num_batches=2):
     num_samples = 1000
-    A_vec = torch.randn((num_samples, 16), dtype=torch.double, requires_grad=True)
-    sdp_rot_solver = RotMatSDPSolver()
-    start = time.time()
-    rotmat = sdp_rot_solver(A_vec)
-    rotmat.sum().backward()
-
-    print(torch.isnan(A_vec.grad).any())
-    print('Solved {} SDPs (16 parameters) in {:.3F} sec using cvxpylayers.'.format(num_samples, time.time() - start))
-
-def compare_solver_time():
+    sdp_rot_solver = RotMatSDPSolver(num_workers=num_workers)
+    #The first batch also starts the worker pool
+    for _ in range(num_batches):
+        A_vec = torch.randn((num_samples, 16), dtype=torch.double, requires_grad=True)
+        start = time.time()
+        rotmat = sdp_rot_solver(A_vec)
+        rotmat.sum().backward()
+
+        print(torch.isnan(A_vec.grad).any())
+        print('Solved {} SDPs (16 parameters) in {:.3F} sec using cvxpylayers ({} workers).'.format(num_samples, time.time() - start, num_workers))
+    sdp_rot_solver.close()
+    return rotmat
+
+def compare_solver_time(num_workers=0):
+    #Quick comparison against cvxpylayers; see rotation_benchmarks.py for the full latency/throughput sweep
+    from qcqp_layers_playground import HomogeneousRotationQCQPFastSolver
     num_samples = 1000
-    sdp_rot_solver = RotMatSDPSolver()
+    sdp_rot_solver = RotMatSDPSolver(num_workers=num_workers)
     A_vec = torch.randn((num_samples, 55), dtype=torch.double, requires_grad=True)
     start = time.time()
     rotmat = sdp_rot_solver(A_vec)
     rotmat.sum().backward()
-    print('Solved {} SDPs in {:.3F} sec using cvxpylayers.'.format(num_samples, time.time() - start))
+    print('Solved {} SDPs in {:.3F} sec using cvxpylayers ({} workers).'.format(num_samples, time.time() - start, num_workers))
+    sdp_rot_solver.close()
 
 
     start = time.time()
@@ -131,7 +444,7 @@ def compare_solver_time():
     print('Solved {} Quat QCQPs in {:.3F} sec.'.format(num_samples, time.time() - start))
 
 if __name__ == '__main__':
-    test_16_vec()
+    rotmat = test_16_vec(num_workers=2)
     #compare_solver_time()
     # num_samples = 1000
     # sdp_rot_solver = RotMatSDPSolver()
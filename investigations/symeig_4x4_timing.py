@@ -0,0 +1,48 @@
+import torch
+import time
+import sys
+sys.path.insert(0,'..')
+from qcqp_layers import batch_symeig_4x4
+
+
+def random_sym_4x4(num_samples, dtype):
+    A = torch.randn((num_samples, 4, 4), dtype=dtype)
+    return 0.5 * (A.transpose(1, 2) + A)
+
+def smallest_eigvec_error(A, solver):
+    nus, qs = solver(A)
+    nus_ref, qs_ref = torch.linalg.eigh(A)
+    q, q_ref = qs[:, :, 0], qs_ref[:, :, 0]
+    q_diff = torch.min((q - q_ref).norm(dim=1), (q + q_ref).norm(dim=1))
+    return (nus[:, 0] - nus_ref[:, 0]).abs().max().item(), q_diff.max().item()
+
+def time_solver(A, solver, num_repeats=3):
+    times = []
+    for _ in range(num_repeats):
+        start = time.time()
+        solver(A)
+        times.append(time.time() - start)
+    return min(times)
+
+if __name__=='__main__':
+    torch.set_grad_enabled(False)
+    solvers = {
+        'eigh': torch.linalg.eigh,
+        'jacobi': batch_symeig_4x4
+    }
+
+    print('Accuracy (max abs. error w.r.t. torch.linalg.eigh of the smallest eigenpair, 10^4 samples):')
+    for dtype in [torch.float, torch.double]:
+        A = random_sym_4x4(10**4, dtype)
+        nu_err, q_err = smallest_eigvec_error(A, batch_symeig_4x4)
+        print('{}: eigenvalue {:.3E} | eigenvector {:.3E}'.format(dtype, nu_err, q_err))
+
+    print('Throughput ({} thread(s)):'.format(torch.get_num_threads()))
+    for dtype in [torch.float, torch.double]:
+        for num_samples in [10**4, 10**5, 10**6]:
+            A = random_sym_4x4(num_samples, dtype)
+            out_str = '{} | B = {:.0E}'.format(dtype, num_samples)
+            for name, solver in solvers.items():
+                t = time_solver(A, solver)
+                out_str += ' | {}: {:.3f} sec ({:.2E} matrices/sec)'.format(name, t, num_samples/t)
+            print(out_str)
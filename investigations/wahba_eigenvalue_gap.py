@@ -1,7 +1,7 @@
 import numpy as np
+import torch
 from matplotlib import pyplot as plt
-from utils import normalized
-from helpers_sim import build_A, gen_sim_data
+from helpers_sim import build_A_batch, gen_sim_data_fast
 # from gen_plots import _plot_curve_with_bounds # Required cv2
 
 
@@ -43,15 +43,12 @@ if __name__=='__main__':
 
     gap_data = np.zeros((3, len(sigma_vec), N_runs))
     for idx in range(len(sigma_vec)):
-        sigma = sigma_vec[idx]*np.ones(N)
-        for jdx in range(N_runs):
-            _, x_1, x_2 = gen_sim_data(N, sigma)
-            A = build_A(x_1, x_2, sigma**2)
-            # A = A/np.linalg.norm(A, ord='fro')
-            eigvalues = np.linalg.eigvalsh(A)
-            gap_data[0, idx, jdx] = eigvalues[1] - eigvalues[0]
-            gap_data[1, idx, jdx] = eigvalues[2] - eigvalues[0]
-            gap_data[2, idx, jdx] = eigvalues[3] - eigvalues[0]
+        sigma = sigma_vec[idx]
+        _, x_1, x_2 = gen_sim_data_fast(N_runs, N, sigma)
+        A = build_A_batch(x_1.transpose(1, 2), x_2.transpose(1, 2), sigma**2)
+        # A = A/A.norm(dim=[1,2], keepdim=True)
+        eigvalues = np.linalg.eigvalsh(A.numpy())
+        gap_data[:, idx, :] = (eigvalues[:, 1:] - eigvalues[:, :1]).T
 
     _gen_eigenvalue_gap_plot(sigma_vec, gap_data, '../plots/eigenvalue_gap_vs_noise.pdf',
                              'std. deviation $\sigma$ (m)',
@@ -61,20 +58,18 @@ if __name__=='__main__':
     outlier_rate_vec = np.linspace(0.0, 0.7, 8)
     gap_data_outlier = np.zeros((3, len(sigma_vec), N_runs))
     for idx in range(len(outlier_rate_vec)):
-        sigma = 0.01*np.ones(N)
+        sigma = 0.01
         n_outliers = int(N*outlier_rate_vec[idx])
-        for jdx in range(N_runs):
-            _, x_1, x_2 = gen_sim_data(N, sigma)
-            perm = np.random.permutation(N)
-            outlier_inds = perm[0:n_outliers]
-            x_2[outlier_inds, :] = np.random.rand(n_outliers, 3)
-            x_2[outlier_inds, :] = normalized(x_2[outlier_inds, :], axis=1)
-            A = build_A(x_1, x_2, sigma**2)
-            # A = A/np.linalg.norm(A, ord='fro')
-            eigvalues = np.linalg.eigvalsh(A)
-            gap_data_outlier[0, idx, jdx] = eigvalues[1] - eigvalues[0]
-            gap_data_outlier[1, idx, jdx] = eigvalues[2] - eigvalues[0]
-            gap_data_outlier[2, idx, jdx] = eigvalues[3] - eigvalues[0]
+        _, x_1, x_2 = gen_sim_data_fast(N_runs, N, sigma)
+        x_1, x_2 = x_1.transpose(1, 2), x_2.transpose(1, 2)
+        #Replace a random subset of n_outliers matches per run
+        outlier_inds = torch.rand(N_runs, N).argsort(dim=1)[:, :n_outliers]
+        outliers = torch.rand(N_runs, n_outliers, 3, dtype=x_2.dtype)
+        x_2 = x_2.scatter(1, outlier_inds.unsqueeze(2).expand(-1, -1, 3), outliers/outliers.norm(dim=2, keepdim=True))
+        A = build_A_batch(x_1, x_2, sigma**2)
+        # A = A/A.norm(dim=[1,2], keepdim=True)
+        eigvalues = np.linalg.eigvalsh(A.numpy())
+        gap_data_outlier[:, idx, :] = (eigvalues[:, 1:] - eigvalues[:, :1]).T
 
     _gen_eigenvalue_gap_plot(outlier_rate_vec*100, gap_data_outlier, '../plots/eigenvalue_gap_vs_outlier_rate.pdf',
                              'outlier rate (\%)',
@@ -419,8 +419,8 @@ class FLADataset(tud.Dataset):
         pose_idx1 = self.find_pose(self.image_timestamps[id1])
         pose_idx2 = self.find_pose(self.image_timestamps[id2])
 
-        R_1 = quat_to_rotmat(self.pose_qxyzw[pose_idx1, :], ordering='xyzw')
-        R_2 = quat_to_rotmat(self.pose_qxyzw[pose_idx2, :], ordering='xyzw')
+        R_1 = quat_to_rotmat(self.pose_qxyzw[pose_idx1, :], ordering='xyzw', validate=True)
+        R_2 = quat_to_rotmat(self.pose_qxyzw[pose_idx2, :], ordering='xyzw', validate=True)
 
         R = R_1.mm(R_2.transpose(0,1))
         if self.transform:
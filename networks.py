@@ -17,31 +17,27 @@ class RotMat6DDirect(torch.nn.Module):
         return C
 
 class QuatNet(torch.nn.Module):
-    def __init__(self, enforce_psd=True, unit_frob_norm=False, batchnorm=False):
+    def __init__(self, enforce_psd=True, unit_frob_norm=False, batchnorm=False, gap_tol=None, eig_solver='eigh'):
         super(QuatNet, self).__init__()
         self.A_net = PointNet(dim_out=10, normalize_output=False, batchnorm=batchnorm)
         self.enforce_psd = enforce_psd
         self.unit_frob_norm = unit_frob_norm
-        self.qcqp_solver = QuadQuatFastSolver.apply
+        self.qcqp_solver = QuadQuatFusedSolver.apply
+        self.gap_tol = gap_tol
+        self.eig_solver = eig_solver
     
     def output_A(self, x):
         A_vec = self.A_net(x)
-        if self.enforce_psd:
-            A_vec = convert_Avec_to_Avec_psd(A_vec)
-        if self.unit_frob_norm:
-            A_vec = normalize_Avec(A_vec)
-        
-        return convert_Avec_to_A(A_vec)
+        A, _, _ = convert_net_output_to_A(A_vec, self.enforce_psd, self.unit_frob_norm)
+        return A.squeeze()
 
-    def forward(self, x):
+    def forward(self, x, warm_start_solver=None):
         A_vec = self.A_net(x)
-
-        if self.enforce_psd:
-            A_vec = convert_Avec_to_Avec_psd(A_vec)
-        if self.unit_frob_norm:
-            A_vec = normalize_Avec(A_vec)
-        
-        q = self.qcqp_solver(A_vec)
+        if warm_start_solver is not None:
+            #Inference only, see QuadQuatWarmStartSolver
+            A, _, _ = convert_net_output_to_A(A_vec, self.enforce_psd, self.unit_frob_norm)
+            return warm_start_solver(A)
+        q = self.qcqp_solver(A_vec, self.enforce_psd, self.unit_frob_norm, False, self.eig_solver, self.gap_tol)
         return q
 
 
@@ -199,61 +195,71 @@ class RotMatSDPFlowNet(torch.nn.Module):
         return C
 
 class QuatFlowNet(torch.nn.Module):
-    def __init__(self, enforce_psd=True, unit_frob_norm=True, dim_in=2, batchnorm=True):
+    def __init__(self, enforce_psd=True, unit_frob_norm=True, dim_in=2, batchnorm=True, gap_tol=None, eig_solver='eigh'):
         super(QuatFlowNet, self).__init__()
         self.A_net = BasicCNN(dim_in=dim_in, dim_out=10, normalize_output=False, batchnorm=batchnorm)
         self.enforce_psd = enforce_psd
         self.unit_frob_norm = unit_frob_norm
-        self.qcqp_solver = QuadQuatFastSolver.apply
+        self.qcqp_solver = QuadQuatFusedSolver.apply
+        self.gap_tol = gap_tol
+        self.eig_solver = eig_solver
     
     def output_A(self, x):
         A_vec = self.A_net(x)
-        if self.enforce_psd:
-            A_vec = convert_Avec_to_Avec_psd(A_vec)
-        if self.unit_frob_norm:
-            A_vec = normalize_Avec(A_vec)
-        
-        return convert_Avec_to_A(A_vec)
+        A, _, _ = convert_net_output_to_A(A_vec, self.enforce_psd, self.unit_frob_norm)
+        return A.squeeze()
 
-    def forward(self, x):
+    def forward(self, x, warm_start_solver=None):
         A_vec = self.A_net(x)
-
-        if self.enforce_psd:
-            A_vec = convert_Avec_to_Avec_psd(A_vec)
-        if self.unit_frob_norm:
-            A_vec = normalize_Avec(A_vec)
-        
-        q = self.qcqp_solver(A_vec)
+        if warm_start_solver is not None:
+            #Inference only, see QuadQuatWarmStartSolver
+            A, _, _ = convert_net_output_to_A(A_vec, self.enforce_psd, self.unit_frob_norm)
+            return warm_start_solver(A)
+        q = self.qcqp_solver(A_vec, self.enforce_psd, self.unit_frob_norm, False, self.eig_solver, self.gap_tol)
         return q
 
 class QuatFlowResNet(torch.nn.Module):
-    def __init__(self, enforce_psd=True, unit_frob_norm=True):
+    def __init__(self, enforce_psd=True, unit_frob_norm=True, gap_tol=None, eig_solver='eigh'):
         super(QuatFlowResNet, self).__init__()
         self.A_net = CustomResNet(dim_out=10)
         self.enforce_psd = enforce_psd
         self.unit_frob_norm = unit_frob_norm
-        self.qcqp_solver = QuadQuatFastSolver.apply
+        self.qcqp_solver = QuadQuatFusedSolver.apply
+        self.gap_tol = gap_tol
+        self.eig_solver = eig_solver
     
     def output_A(self, x):
         A_vec = self.A_net(x)
-        if self.enforce_psd:
-            A_vec = convert_Avec_to_Avec_psd(A_vec)
-        if self.unit_frob_norm:
-            A_vec = normalize_Avec(A_vec)
-        
-        return convert_Avec_to_A(A_vec)
+        A, _, _ = convert_net_output_to_A(A_vec, self.enforce_psd, self.unit_frob_norm)
+        return A.squeeze()
 
-    def forward(self, x):
+    def forward(self, x, warm_start_solver=None):
         A_vec = self.A_net(x)
-
-        if self.enforce_psd:
-            A_vec = convert_Avec_to_Avec_psd(A_vec)
-        if self.unit_frob_norm:
-            A_vec = normalize_Avec(A_vec)
-        
-        q = self.qcqp_solver(A_vec)
+        if warm_start_solver is not None:
+            #Inference only, see QuadQuatWarmStartSolver
+            A, _, _ = convert_net_output_to_A(A_vec, self.enforce_psd, self.unit_frob_norm)
+            return warm_start_solver(A)
+        q = self.qcqp_solver(A_vec, self.enforce_psd, self.unit_frob_norm, False, self.eig_solver, self.gap_tol)
         return q
 
+class QuatInferenceNet(torch.nn.Module):
+    """
+    Inference-only version of QuatNet, QuatFlowNet or QuatFlowResNet that shares the trained A_net and replaces the
+    QCQP solver with QuadQuatInferenceHead so that it can be scripted or exported (see experiments/export_kitti_model.py)
+    """
+    def __init__(self, model):
+        super(QuatInferenceNet, self).__init__()
+        self.A_net = model.A_net
+        param = next(model.parameters())
+        self.head = QuadQuatInferenceHead(model.enforce_psd, model.unit_frob_norm).to(device=param.device, dtype=param.dtype)
+
+    @torch.jit.export
+    def output_A(self, x):
+        return self.head.output_A(self.A_net(x)).squeeze()
+
+    def forward(self, x):
+        return self.head(self.A_net(x))
+
 def conv_unit(in_planes, out_planes, kernel_size=3, stride=2,padding=1, batchnorm=True):
         if batchnorm:
             return torch.nn.Sequential(
@@ -293,7 +299,7 @@ class BasicCNN(torch.nn.Module):
         out = out.view(out.shape[0], -1)
         out = self.fc(out)
         if self.normalize_output:
-            out = out/out.norm(dim=1).view(-1, 1)
+            out = out/out.norm(p=2, dim=1).view(-1, 1)
         return out
 
 
@@ -324,7 +330,7 @@ class CustomResNet(torch.nn.Module):
     def forward(self, x):
         y = self.cnn(x)
         if self.normalize_output:
-            y = y/y.norm(dim=1).view(-1, 1)
+            y = y/y.norm(p=2, dim=1).view(-1, 1)
         return y
 
     def freeze_layers(self):
@@ -2,22 +2,57 @@ import numpy as np
 import scipy as sp
 import time
 import torch
+from utils import cached_constant, cached_triu_indices, cached_tril_indices, cached_eye, cached_sym_basis
+
+def sym_dim_from_packed(M):
+    """ Returns N such that M = N*(N+1)/2, i.e., the size of the symmetric matrices encoded by M-vectors"""
+    N = int(round((np.sqrt(8*M + 1) - 1)/2))
+    if N*(N+1)//2 != M:
+        raise ValueError("A_vec of length {} does not encode a symmetric matrix (expected N*(N+1)/2 entries).".format(M))
+    return N
+
+def _build_packed_sym_weights(N, device, dtype):
+    # Number of times each upper triangular entry appears in the full matrix
+    idx = cached_triu_indices(N, device)
+    return 2. - (idx[0] == idx[1]).to(dtype)
+
+def packed_sym_frob_norm(A_vec):
+    """ Frobenius norms of the symmetric matrices encoded by BxM vectors (M = N*(N+1)/2), computed in packed form"""
+    if A_vec.dim() < 2:
+        A_vec = A_vec.unsqueeze(dim=0)
+    N = sym_dim_from_packed(A_vec.shape[1])
+    weights = cached_constant('packed_sym_weights', N, A_vec.device, A_vec.dtype, _build_packed_sym_weights)
+    return (weights*A_vec*A_vec).sum(dim=1).sqrt()
+
+def packed_sym_matvec(A_vec, x):
+    """ Computes A x for BxN vectors x and the symmetric BxNxN matrices A encoded by BxM vectors A_vec,
+    without expanding A_vec"""
+    if A_vec.dim() < 2:
+        A_vec = A_vec.unsqueeze(dim=0)
+        x = x.unsqueeze(dim=0)
+    N = sym_dim_from_packed(A_vec.shape[1])
+    assert(x.shape[1] == N)
+    idx = cached_triu_indices(N, A_vec.device)
+    weights = cached_constant('packed_sym_weights', N, A_vec.device, A_vec.dtype, _build_packed_sym_weights)
+
+    # Entry (i,j) contributes A_ij*x_j to row i and, if off-diagonal, A_ij*x_i to row j
+    Ax = x.new_zeros(x.shape).index_add(1, idx[0], A_vec*x[:, idx[1]])
+    Ax = Ax.index_add(1, idx[1], (weights - 1.)*A_vec*x[:, idx[0]])
+    return Ax.squeeze()
 
 def normalize_Avec(A_vec):
     """ Normalizes BxM vectors such that resulting symmetric BxNxN matrices have unit Frobenius norm"""
     """ M = N*(N+1)/2"""
-    
-    A = convert_Avec_to_A(A_vec)
-    if A.dim() < 3:
-        A = A.unsqueeze(dim=0)
-    A = A / A.norm(dim=[1,2], keepdim=True)
-    return convert_A_to_Avec(A).squeeze()
+    if A_vec.dim() < 2:
+        A_vec = A_vec.unsqueeze(dim=0)
+    A_vec = A_vec / packed_sym_frob_norm(A_vec).unsqueeze(dim=1)
+    return A_vec.squeeze()
 
 def convert_A_to_Avec(A):
     """ Convert BxNXN symmetric matrices to BxM vectors encoding unique values"""
     if A.dim() < 3:
         A = A.unsqueeze(dim=0)
-    idx = torch.triu_indices(A.shape[1], A.shape[1])
+    idx = cached_triu_indices(A.shape[1], A.device)
     A_vec = A[:, idx[0], idx[1]]
     return A_vec.squeeze()
 
@@ -26,15 +61,9 @@ def convert_Avec_to_A(A_vec):
     """ M = N*(N+1)/2"""
     if A_vec.dim() < 2:
         A_vec = A_vec.unsqueeze(dim=0)
-    
-    if A_vec.shape[1] == 10:
-        A_dim = 4
-    elif A_vec.shape[1] == 55:
-        A_dim = 10
-    else:
-        raise ValueError("Arbitrary A_vec not yet implemented")
+    A_dim = sym_dim_from_packed(A_vec.shape[1])
 
-    idx = torch.triu_indices(A_dim,A_dim)
+    idx = cached_triu_indices(A_dim, A_vec.device)
     A = A_vec.new_zeros((A_vec.shape[0],A_dim,A_dim))   
     A[:, idx[0], idx[1]] = A_vec
     A[:, idx[1], idx[0]] = A_vec
@@ -42,19 +71,13 @@ def convert_Avec_to_A(A_vec):
 
 def convert_Avec_to_Avec_psd(A_vec):
     """ Convert BxM tensor (encodes symmetric NxN amatrices) to BxM tensor  
-    (encodes symmetric and PSD 4x4 matrices)"""
+    (encodes symmetric and PSD NxN matrices)"""
 
     if A_vec.dim() < 2:
-        A_vec = A_vec.unsqueeze()
-    
-    if A_vec.shape[1] == 10:
-        A_dim = 4
-    elif A_vec.shape[1] == 55:
-        A_dim = 10
-    else:
-        raise ValueError("Arbitrary A_vec not yet implementedf")
+        A_vec = A_vec.unsqueeze(dim=0)
+    A_dim = sym_dim_from_packed(A_vec.shape[1])
 
-    idx = torch.tril_indices(A_dim,A_dim)
+    idx = cached_tril_indices(A_dim, A_vec.device)
     L = A_vec.new_zeros((A_vec.shape[0],A_dim,A_dim))   
     L[:, idx[0], idx[1]] = A_vec
     A = L.bmm(L.transpose(1,2))
@@ -67,56 +90,310 @@ def A_vec_to_quat(A_vec):
     A = convert_Avec_to_A(A_vec)
     if A.dim() < 3:
         A = A.unsqueeze(dim=0)
-    _, evs = torch.symeig(A, eigenvectors=True)
+    _, evs = torch.linalg.eigh(A)
     return evs[:,:,0].squeeze()
 
 
+# #=========================4x4 EIGENSOLVERS=========================
+
+def _jacobi_4x4(A, num_sweeps):
+    # type: (Tensor, int) -> Tuple[Tensor, Tensor]
+    """ Runs num_sweeps cyclic Jacobi sweeps on a Bx4x4 symmetric tensor.
+    Every unique entry of A (and of the accumulated rotation V) is kept as its own B-vector so that
+    each Givens rotation is a handful of elementwise ops on contiguous memory.
+    Written in the TorchScript subset so that it can also be used by QuadQuatInferenceHead."""
+
+    a = [A[:, i // 4, i % 4] for i in range(16)]
+    one = torch.ones_like(a[0])
+    zero = torch.zeros_like(a[0])
+    v = [one if i % 5 == 0 else zero for i in range(16)]
+
+    for _ in range(num_sweeps):
+        # Rotation order of one cyclic sweep, (0,1),(2,3) and (0,2),(1,3) touch disjoint rows
+        for p, q in [(0, 1), (2, 3), (0, 2), (1, 3), (0, 3), (1, 2)]:
+            a_pq = a[4*p + q]
+            d = a[5*q] - a[5*p]
+            # t = tan(theta) of the rotation that zeroes a_pq (Numerical Recipes, eq. 11.1.8), written without branches
+            den = d.abs() + torch.sqrt(d*d + 4.*a_pq*a_pq)
+            t = torch.where(d < 0., -2.*a_pq, 2.*a_pq) / torch.where(den == 0., one, den)
+            c = torch.rsqrt(1. + t*t)
+            s = t*c
+
+            a[5*p] = a[5*p] - t*a_pq
+            a[5*q] = a[5*q] + t*a_pq
+            a[4*p + q] = zero
+            a[4*q + p] = zero
+            for r in range(4):
+                if r != p and r != q:
+                    a_rp, a_rq = a[4*r + p], a[4*r + q]
+                    a[4*r + p] = c*a_rp - s*a_rq
+                    a[4*p + r] = a[4*r + p]
+                    a[4*r + q] = s*a_rp + c*a_rq
+                    a[4*q + r] = a[4*r + q]
+            for r in range(4):
+                v_rp, v_rq = v[4*r + p], v[4*r + q]
+                v[4*r + p] = c*v_rp - s*v_rq
+                v[4*r + q] = s*v_rp + c*v_rq
+
+    evals = torch.stack([a[0], a[5], a[10], a[15]], dim=1)
+    evecs = torch.stack(v, dim=1).view(-1, 4, 4)
+    return evals, evecs
+
+def batch_symeig_4x4(A, num_sweeps=None, chunk_size=16384):
+    """
+    Vectorized eigendecomposition of Bx4x4 symmetric matrices using a fixed number of cyclic Jacobi sweeps.
+    Drop-in replacement for torch.linalg.eigh(A): returns (B,4) eigenvalues in ascending order
+    and (B,4,4) tensor with the corresponding eigenvectors as columns.
+    :param num_sweeps: number of Jacobi sweeps (convergence is quadratic, defaults to 5 for double and 4 otherwise)
+    :param chunk_size: the batch is processed in chunks of this size to keep the working set in cache
+    """
+    if A.dim() < 3:
+        A = A.unsqueeze(dim=0)
+    assert(A.shape[1] == A.shape[2] == 4)
+
+    if num_sweeps is None:
+        num_sweeps = 5 if A.dtype == torch.float64 else 4
+
+    chunks = [_jacobi_4x4(A_chunk, num_sweeps) for A_chunk in A.split(chunk_size)]
+    if len(chunks) == 1:
+        evals, evecs = chunks[0]
+    else:
+        evals = torch.cat([c[0] for c in chunks], dim=0)
+        evecs = torch.cat([c[1] for c in chunks], dim=0)
+
+    evals, order = evals.sort(dim=1)
+    evecs = evecs.gather(2, order.unsqueeze(1).expand(-1, 4, -1))
+    return evals, evecs
+
+def batch_symeig(A, eig_solver='eigh'):
+    """ Eigendecomposition of BxNxN symmetric matrices with a selectable backend (see batch_symeig_4x4)"""
+    if eig_solver == 'eigh':
+        return torch.linalg.eigh(A)
+    elif eig_solver == 'jacobi':
+        return batch_symeig_4x4(A)
+    else:
+        raise ValueError("Unknown eig_solver '{}'. Valid options are 'eigh' and 'jacobi'.".format(eig_solver))
+
+def batch_symeig_mixed(A, gap_tol, eig_solver='eigh'):
+    """
+    Eigengap-aware precision policy for batch_symeig: all samples are solved in float32 and only the samples whose
+    relative eigengap (lambda_2 - lambda_1)/|A|_F is below gap_tol are re-solved in float64.
+    The float32 eigenvectors are accurate to O(eps_32/gap), i.e., to ~1e-5 for gap_tol = 1e-2.
+    :return: (B,4) and (B,4,4) float32 eigenvalues/eigenvectors, (B,) boolean mask of the low-gap samples,
+             float64 eigenvalues/eigenvectors of the low-gap samples
+    """
+    A_lp = A.float()
+    nus, qs = batch_symeig(A_lp, eig_solver=eig_solver)
+    gap = (nus[:, 1] - nus[:, 0]) / A_lp.norm(dim=[1,2])
+    # NaN gaps (e.g., A = 0) are also re-solved
+    low_gap = ~(gap >= gap_tol)
+    nus_hp, qs_hp = batch_symeig(A[low_gap].double(), eig_solver=eig_solver)
+    return nus, qs, low_gap, nus_hp, qs_hp
+
+
 # #=========================PYTORCH (FAST) SOLVER=========================
 
 class QuadQuatFastSolver(torch.autograd.Function):
     """
     Differentiable QCQP solver
     Input: Bx10 tensor 'A_vec' which encodes symmetric 4x4 matrices, A
+           eig_solver (optional): 'eigh' or 'jacobi', see batch_symeig
+           gap_tol (optional): if set, solve and differentiate in float32 except for the samples with a relative
+                               eigengap below gap_tol, which use float64 (see batch_symeig_mixed)
     Output: q that minimizes q^T A q s.t. |q| = 1
     """
 
     @staticmethod
-    def forward(ctx, A_vec):
+    def forward(ctx, A_vec, eig_solver='eigh', gap_tol=None):
 
         A = convert_Avec_to_A(A_vec)
         if A.dim() < 3:
             A = A.unsqueeze(dim=0)
-        q, nu  = solve_wahba_fast(A)
-        ctx.save_for_backward(A, q, nu)
+        ctx.mixed_precision = gap_tol is not None
+        if ctx.mixed_precision:
+            nus, qs, low_gap, nus_hp, qs_hp = batch_symeig_mixed(A, gap_tol, eig_solver=eig_solver)
+            q, _ = wahba_from_eig_mixed(nus, qs, low_gap, nus_hp, qs_hp, A.dtype)
+            ctx.save_for_backward(nus, qs, q, low_gap, nus_hp, qs_hp)
+        else:
+            nus, qs = batch_symeig(A, eig_solver=eig_solver)
+            q, _ = wahba_from_eig(nus, qs)
+            ctx.save_for_backward(nus, qs, q)
         return q
 
     @staticmethod
     def backward(ctx, grad_output):
-        A, q, nu = ctx.saved_tensors
-        grad_qcqp = compute_grad_fast(A, nu, q)
-        outgrad = torch.einsum('bkq,bk->bq', grad_qcqp, grad_output)
-        return outgrad
+        if ctx.mixed_precision:
+            nus, qs, q, low_gap, nus_hp, qs_hp = ctx.saved_tensors
+            outgrad = compute_vjp_fast(nus, qs, q.float(), grad_output.float()).to(grad_output.dtype)
+            outgrad[low_gap] = compute_vjp_fast(nus_hp, qs_hp, q[low_gap].double(),
+                                                grad_output[low_gap].double()).to(grad_output.dtype)
+        else:
+            nus, qs, q = ctx.saved_tensors
+            outgrad = compute_vjp_fast(nus, qs, q, grad_output)
+        return outgrad, None, None
+
+def convert_net_output_to_A(A_vec, enforce_psd=True, unit_frob_norm=True):
+    """ Convert Bx10 network outputs to Bx4x4 matrices A (see QuadQuatFusedSolver)
+    Also returns the lower triangular factor L (if enforce_psd) and the Bx1x1 norms of L L^T (if unit_frob_norm)"""
+    if A_vec.dim() < 2:
+        A_vec = A_vec.unsqueeze(dim=0)
+
+    if enforce_psd:
+        idx = cached_tril_indices(4, A_vec.device)
+        L = A_vec.new_zeros((A_vec.shape[0], 4, 4))
+        L[:, idx[0], idx[1]] = A_vec
+        A = L.bmm(L.transpose(1, 2))
+    else:
+        L = None
+        A = convert_Avec_to_A(A_vec).view(-1, 4, 4)
+
+    if unit_frob_norm:
+        A_norm = A.norm(dim=[1,2], keepdim=True)
+        A = A / A_norm
+    else:
+        A_norm = None
+    return A, L, A_norm
+
+class QuadQuatFusedSolver(torch.autograd.Function):
+    """
+    Differentiable network head that fuses convert_Avec_to_Avec_psd, normalize_Avec and QuadQuatFastSolver
+    Input: Bx10 tensor 'A_vec' (raw network output)
+           enforce_psd: A = L L^T where L is lower triangular and filled with A_vec (otherwise A_vec encodes A)
+           unit_frob_norm: A is scaled to unit Frobenius norm
+           return_A: also return the Bx4x4 matrices A
+           eig_solver: 'eigh' or 'jacobi', see batch_symeig
+           gap_tol: if set, use the mixed precision policy of QuadQuatFastSolver for the eigenproblem
+    Output: q that minimizes q^T A q s.t. |q| = 1 (and A)
+    """
+
+    @staticmethod
+    def forward(ctx, A_vec, enforce_psd=True, unit_frob_norm=True, return_A=False, eig_solver='eigh', gap_tol=None):
+        A, L, A_norm = convert_net_output_to_A(A_vec, enforce_psd, unit_frob_norm)
+        if gap_tol is not None:
+            nus, qs, low_gap, nus_hp, qs_hp = batch_symeig_mixed(A, gap_tol, eig_solver=eig_solver)
+            q, _ = wahba_from_eig_mixed(nus, qs, low_gap, nus_hp, qs_hp, A.dtype)
+        else:
+            nus, qs = batch_symeig(A, eig_solver=eig_solver)
+            q, _ = wahba_from_eig(nus, qs)
+            low_gap = nus_hp = qs_hp = None
+
+        ctx.enforce_psd = enforce_psd
+        ctx.unit_frob_norm = unit_frob_norm
+        ctx.return_A = return_A
+        ctx.mixed_precision = gap_tol is not None
+        ctx.save_for_backward(nus, qs, q, L, A_norm, A if return_A else None, low_gap, nus_hp, qs_hp)
+        if return_A:
+            return q, A
+        return q
+
+    @staticmethod
+    def backward(ctx, grad_q, grad_A=None):
+        nus, qs, q, L, A_norm, A, low_gap, nus_hp, qs_hp = ctx.saved_tensors
+
+        # Symmetric gradient w.r.t. the (normalized) A that is fed to the solver
+        if ctx.mixed_precision:
+            w = spectral_pinv_apply(nus, qs, grad_q.float()).to(q.dtype)
+            w[low_gap] = spectral_pinv_apply(nus_hp, qs_hp, grad_q[low_gap].double()).to(q.dtype)
+        else:
+            w = spectral_pinv_apply(nus, qs, grad_q)
+        wq = w.unsqueeze(2)*q.unsqueeze(1)
+        grad_A_sym = -0.5*(wq + wq.transpose(1, 2))
+        if ctx.return_A and grad_A is not None:
+            grad_A_sym = grad_A_sym + 0.5*(grad_A + grad_A.transpose(1, 2))
 
-def solve_wahba_fast(A, compute_gap=False):
+        if ctx.unit_frob_norm:
+            # The q path is scale invariant (q^T A w = 0), so only an output gradient on A has a radial component
+            if ctx.return_A and grad_A is not None:
+                grad_A_sym = grad_A_sym - (grad_A_sym*A).sum(dim=[1,2], keepdim=True)*A
+            grad_A_sym = grad_A_sym / A_norm
+
+        if ctx.enforce_psd:
+            idx = cached_tril_indices(4, q.device)
+            grad_L = 2.*grad_A_sym.bmm(L)
+            outgrad = grad_L[:, idx[0], idx[1]]
+        else:
+            idx = cached_triu_indices(4, q.device)
+            scale = cached_constant('sym_vjp_scale', 4, q.device, q.dtype, _build_sym_vjp_scale)
+            outgrad = 2.*grad_A_sym[:, idx[0], idx[1]]*scale
+
+        return outgrad, None, None, None, None, None
+
+def solve_wahba_fast(A, compute_gap=False, eig_solver='eigh', gap_tol=None):
     """
     Use a fast eigenvalue solution to the dual of the 'generalized Wahba' problem to solve the primal.
     :param A: quadratic cost matrix
-    :param redundant_constraints: boolean indicating whether to use redundand constraints
-    :return: Optimal q, optimal dual var. nu, time to solve, duality gap
+    :param compute_gap: boolean indicating whether to also return the duality gap
+    :param eig_solver: 'eigh' (torch.linalg.eigh) or 'jacobi' (batch_symeig_4x4)
+    :param gap_tol: if set, solve in float32 and re-solve low-gap samples in float64 (see batch_symeig_mixed)
+    :return: Optimal q, optimal dual var. nu, duality gap (optional)
     """
     #start = time.time()
     # Returns (b,n) and (b,n,n) tensors
-    nus, qs = torch.symeig(A, eigenvectors=True)
-    nu_min, nu_argmin = torch.min(nus, 1)# , keepdim=False, out=None)
-    q_opt = qs[torch.arange(A.shape[0]), :, nu_argmin]
-    q_opt = q_opt*(torch.sign(q_opt[:, 3]).unsqueeze(1))
-    nu_opt = -1.*nu_min.unsqueeze(1)
+    if gap_tol is not None:
+        q_opt, nu_opt = wahba_from_eig_mixed(*batch_symeig_mixed(A, gap_tol, eig_solver=eig_solver), A.dtype)
+    else:
+        nus, qs = batch_symeig(A, eig_solver=eig_solver)
+        q_opt, nu_opt = wahba_from_eig(nus, qs)
     if compute_gap:
         p = torch.einsum('bn,bnm,bm->b', q_opt, A, q_opt).unsqueeze(1)
         gap = p + nu_opt
         return q_opt, nu_opt, gap
     return q_opt, nu_opt
 
+def wahba_from_eig(nus, qs):
+    """
+    Extracts the optimal q (with positive scalar part) and dual var. nu from the (B,4) eigenvalues and (B,4,4)
+    eigenvectors of A
+    """
+    nu_min, nu_argmin = torch.min(nus, 1)# , keepdim=False, out=None)
+    q_opt = qs[torch.arange(nus.shape[0]), :, nu_argmin]
+    q_opt = q_opt*(torch.sign(q_opt[:, 3]).unsqueeze(1))
+    nu_opt = -1.*nu_min.unsqueeze(1)
+    return q_opt, nu_opt
+
+def wahba_from_eig_mixed(nus, qs, low_gap, nus_hp, qs_hp, dtype):
+    """ Same as wahba_from_eig for the outputs of batch_symeig_mixed. The results are scattered back in dtype. """
+    q_opt, nu_opt = wahba_from_eig(nus, qs)
+    q_opt, nu_opt = q_opt.to(dtype), nu_opt.to(dtype)
+    q_hp, nu_hp = wahba_from_eig(nus_hp, qs_hp)
+    q_opt[low_gap] = q_hp.to(dtype)
+    nu_opt[low_gap] = nu_hp.to(dtype)
+    return q_opt, nu_opt
+
+def spectral_pinv_apply(nus, qs, v):
+    """ Returns (A - nus[:,0]*I)^+ v for (B,4) vectors v, using the eigendecomposition (nus, qs) of A """
+    qs_perp = qs[:, :, 1:]
+    coeffs = torch.einsum('bnk,bn->bk', qs_perp, v) / (nus[:, 1:] - nus[:, :1])
+    return torch.einsum('bnk,bk->bn', qs_perp, coeffs)
+
+def compute_vjp_fast(nus, qs, q, grad_output):
+    """
+    Input: nus: (B,4) tensor (eigenvalues of A in ascending order)
+           qs: (B,4,4) tensor (corresponding eigenvectors of A as columns)
+           q: (B,4) tensor (optimal unit quaternions)
+           grad_output: (B,4) tensor (gradient of the loss w.r.t. q)
+
+    Output: grad: (B,10) tensor (gradient of the loss w.r.t. A_vec)
+
+    Computes the same vector-Jacobian product as compute_grad_fast without forming the (B,4,10) Jacobian.
+    Since dq = -(A + nu*I)^+ dA q, the loss gradient w.r.t. A is -w q^T with w = (A + nu*I)^+ grad_output, where
+    the pseudo-inverse is applied spectrally using the three largest eigenpairs of A.
+    """
+    assert(nus.dim() > 1 and qs.dim() > 2 and q.dim() > 1)
+
+    w = spectral_pinv_apply(nus, qs, grad_output)
+
+    # dA/dA_vec places each off-diagonal entry at (i,j) and (j,i)
+    idx = cached_triu_indices(4, q.device)
+    scale = cached_constant('sym_vjp_scale', 4, q.device, q.dtype, _build_sym_vjp_scale)
+    grad = -1*(w[:, idx[0]]*q[:, idx[1]] + w[:, idx[1]]*q[:, idx[0]])*scale
+    return grad
+
+def _build_sym_vjp_scale(N, device, dtype):
+    # 1/2 on the diagonal entries (which only appear once in A), 1 elsewhere
+    idx = cached_triu_indices(N, device)
+    return 1. - 0.5*(idx[0] == idx[1]).to(dtype)
+
 def compute_grad_fast(A, nu, q):
     """
     Input: A_vec: (B,4,4) tensor (parametrices B symmetric 4x4 matrices)
@@ -131,9 +408,7 @@ def compute_grad_fast(A, nu, q):
     assert(A.dim() > 2 and nu.dim() > 0 and q.dim() > 1)
     
     M = A.new_zeros((A.shape[0], 5, 5))
-    I = A.new_zeros((A.shape[0], 4, 4))
-
-    I[:,0,0] = I[:,1,1] = I[:,2,2] = I[:,3,3] = 1.
+    I = cached_eye(4, A.device, A.dtype)
 
     M[:, :4, :4] = A + I*nu.view(-1,1,1)
     M[:, 4,:4] = q
@@ -141,20 +416,141 @@ def compute_grad_fast(A, nu, q):
 
     b = A.new_zeros((A.shape[0], 5, 10))
 
-    #symmetric matrix indices
-    idx = torch.triu_indices(4,4)
-
-    i = torch.arange(10)
-    I_ij = A.new_zeros((10, 4, 4))
-
-    I_ij[i, idx[0], idx[1]] = 1.
-    I_ij[i, idx[1], idx[0]] = 1.
-    
-    I_ij = I_ij.expand(A.shape[0], 10, 4, 4)
+    #symmetric matrix basis
+    I_ij = cached_sym_basis(4, A.device, A.dtype).expand(A.shape[0], 10, 4, 4)
 
     b[:, :4, :] = torch.einsum('bkij,bi->bjk',I_ij, q) 
 
     #This solves all gradients simultaneously!
     X, _ = torch.solve(b, M)
     grad = -1*X[:,:4,:]
-    return grad
\ No newline at end of file
+    return grad
+
+
+# #=========================WARM-STARTED (STREAMING) SOLVER=========================
+
+def solve_wahba_warm_start(A, q_init, num_steps=2, tol=None, gap_tol=1e-4, eig_solver='eigh'):
+    """
+    Inference-only solver for A that is close to a previously solved matrix (e.g., consecutive VO frames).
+    Takes num_steps Rayleigh quotient iteration steps from q_init (cubic convergence) and accepts the result if the
+    residual is small and the deflated matrix A + s*q*q^T - (q^T A q + gap_tol)*I is positive definite, which
+    certifies that q is the smallest eigenvector and that the eigengap is at least gap_tol. All other samples are
+    re-solved with solve_wahba_fast. Apart from the single fallback check, the warm start is a fixed sequence of
+    batched operations (num_steps 4x4 solves and one Cholesky factorization), so it only pays off for large batches:
+    for small batches the per-operation overhead dominates and solve_wahba_fast is faster.
+    :param A: (B,4,4) tensor
+    :param q_init: (B,4) tensor of unit quaternions (previous solution)
+    :param tol: convergence tolerance on the residual |A q - (q^T A q) q| relative to |A|_F (default depends on dtype)
+    :param gap_tol: minimum eigengap (relative to |A|_F) required to accept the warm-started solution
+    :return: Optimal q, optimal dual var. nu, boolean (B,) mask of the samples that used the full solve
+    """
+    if tol is None:
+        tol = 1e-10 if A.dtype == torch.float64 else 1e-6
+
+    with torch.no_grad():
+        A_scale = A.norm(dim=[1,2]).view(-1,1,1)
+        I = cached_eye(4, A.device, A.dtype)
+        q = q_init.unsqueeze(2) / q_init.norm(dim=1).view(-1,1,1)
+
+        # A singular shifted system (q is already an eigenvector) gives a non-finite step that fails the checks below
+        for _ in range(num_steps):
+            y, _ = torch.linalg.solve_ex(A - q.transpose(1,2).bmm(A.bmm(q))*I, q)
+            q = y / y.norm(dim=1, keepdim=True)
+
+        Aq = A.bmm(q)
+        mu = q.transpose(1,2).bmm(Aq)
+        residual = (Aq - mu*q).norm(dim=1, keepdim=True)
+
+        # Deflating q leaves lambda_2, lambda_3, lambda_4 and moves mu up by 2|A|_F
+        _, info = torch.linalg.cholesky_ex(A + 2.*A_scale*q.bmm(q.transpose(1,2)) - (mu + gap_tol*A_scale)*I)
+        # The negated comparison also rejects NaN residuals
+        fallback = (info > 0) | ~(residual <= tol*A_scale).view(-1)
+
+        q = q.squeeze(2)
+        q = q*torch.sign(q[:, 3:])
+        nu = -1.*mu.view(-1,1)
+
+        if fallback.any():
+            q[fallback], nu[fallback] = solve_wahba_fast(A[fallback], eig_solver=eig_solver)
+
+    return q, nu, fallback
+
+class QuadQuatWarmStartSolver(object):
+    """
+    Stateful, inference-only QCQP solver for streams of Bx4x4 matrices A (B independent sequences)
+    Each call is warm-started with the solutions of the previous call (see solve_wahba_warm_start).
+    The first call, any call with a different batch size and batches smaller than min_batch_size (where the warm start
+    is slower than the full solve, see the wahba_* cases of investigations/rotation_benchmarks.py) use the full solve.
+    """
+    def __init__(self, num_steps=2, tol=None, gap_tol=1e-4, eig_solver='eigh', min_batch_size=256):
+        self.num_steps = num_steps
+        self.min_batch_size = min_batch_size
+        self.tol = tol
+        self.gap_tol = gap_tol
+        self.eig_solver = eig_solver
+        self.reset()
+
+    def reset(self):
+        self.q_prev = None
+        self.num_solves = 0
+        self.num_fallback = 0
+
+    def __call__(self, A):
+        if A.dim() < 3:
+            A = A.unsqueeze(dim=0)
+
+        if self.q_prev is None or self.q_prev.shape[0] != A.shape[0] or A.shape[0] < self.min_batch_size:
+            with torch.no_grad():
+                q, _ = solve_wahba_fast(A, eig_solver=self.eig_solver)
+            fallback = torch.ones(A.shape[0], dtype=torch.bool, device=A.device)
+        else:
+            q, _, fallback = solve_wahba_warm_start(A, self.q_prev.to(A.dtype), num_steps=self.num_steps, tol=self.tol,
+                                                    gap_tol=self.gap_tol, eig_solver=self.eig_solver)
+        self.q_prev = q
+        self.num_solves += A.shape[0]
+        self.num_fallback += int(fallback.sum())
+        return q
+
+
+# #=========================INFERENCE (EXPORTABLE) HEAD=========================
+
+class QuadQuatInferenceHead(torch.nn.Module):
+    """
+    Inference-only version of QuadQuatFusedSolver (same inputs, same q and A) that can be scripted with
+    torch.jit.script, traced, captured by torch.compile and exported to ONNX.
+    It avoids the custom autograd.Function and torch.linalg.eigh: A is built with a constant matmul and the
+    eigenproblem is solved with a fixed number of Jacobi sweeps (see batch_symeig_4x4).
+    """
+    def __init__(self, enforce_psd=True, unit_frob_norm=True, num_sweeps=5):
+        super(QuadQuatInferenceHead, self).__init__()
+        self.enforce_psd = enforce_psd
+        self.unit_frob_norm = unit_frob_norm
+        self.num_sweeps = num_sweeps
+
+        # Maps the 10 entries of A_vec to the 16 entries of L (if enforce_psd) or of A
+        idx = torch.tril_indices(4, 4) if enforce_psd else torch.triu_indices(4, 4)
+        basis = torch.zeros(10, 16)
+        basis[torch.arange(10), 4*idx[0] + idx[1]] = 1.
+        if not enforce_psd:
+            basis[torch.arange(10), 4*idx[1] + idx[0]] = 1.
+        self.register_buffer('basis', basis)
+
+    @torch.jit.export
+    def output_A(self, A_vec):
+        # type: (Tensor) -> Tensor
+        if A_vec.dim() < 2:
+            A_vec = A_vec.unsqueeze(dim=0)
+        A = A_vec.matmul(self.basis).view(-1, 4, 4)
+        if self.enforce_psd:
+            A = A.bmm(A.transpose(1, 2))
+        if self.unit_frob_norm:
+            A = A / A.norm(p=2, dim=[1,2], keepdim=True)
+        return A
+
+    def forward(self, A_vec):
+        # type: (Tensor) -> Tensor
+        A = self.output_A(A_vec)
+        evals, evecs = _jacobi_4x4(A, self.num_sweeps)
+        idx = evals.argmin(dim=1)
+        q = evecs.gather(2, idx.view(-1, 1, 1).expand(-1, 4, 1)).squeeze(2)
+        return q*torch.sign(q[:, 3:])
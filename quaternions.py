@@ -3,70 +3,95 @@ import numpy as np
 import utils
 import math
 
-#NUMPY
+#NUMPY / PYTORCH
 ##########
+#Omega_l, Omega_r and pure_quat accept torch tensors or numpy arrays (returned as numpy float64 arrays)
+#with arbitrary leading batch dimensions: (...,4) -> (...,4,4) and (...,3) -> (...,4).
+
+def _to_tensor(q):
+    if torch.is_tensor(q):
+        return q, False
+    return torch.from_numpy(np.asarray(q, dtype=np.float64)), True
+
 def Omega_l(q):
-    Om = np.zeros((4,4)) * np.nan
-    np.fill_diagonal(Om, q[3]) 
-    
-    Om[0,1] = -q[2]
-    Om[0,2] = q[1]
-    Om[0,3] = q[0]
-
-    Om[1,0] = q[2]
-    Om[1,2] = -q[0]
-    Om[1,3] = q[1]
-
-    Om[2,0] = -q[1]
-    Om[2,1] = q[0]
-    Om[2,3] = q[2]
-    
-    Om[3,0] = -q[0]
-    Om[3,1] = -q[1]
-    Om[3,2] = -q[2]
-
-    return Om
+    """Left quaternion product matrix (xyzw), Omega_l(q_a)*q_b = q_a*q_b."""
+    q, is_numpy = _to_tensor(q)
+    x, y, z, w = q.unbind(dim=-1)
+    Om = torch.stack([w, -z, y, x,
+                      z, w, -x, y,
+                      -y, x, w, z,
+                      -x, -y, -z, w], dim=-1).view(q.shape + (4,))
+    return Om.numpy() if is_numpy else Om
 
 def Omega_r(q):
-    Om = np.zeros((4,4)) * np.nan
-    np.fill_diagonal(Om, q[3]) 
-    
-    Om[0,1] = q[2]
-    Om[0,2] = -q[1]
-    Om[0,3] = q[0]
-
-    Om[1,0] = -q[2]
-    Om[1,2] = q[0]
-    Om[1,3] = q[1]
-
-    Om[2,0] = q[1]
-    Om[2,1] = -q[0]
-    Om[2,3] = q[2]
-    
-    Om[3,0] = -q[0]
-    Om[3,1] = -q[1]
-    Om[3,2] = -q[2]
-
-    return Om
+    """Right quaternion product matrix (xyzw), Omega_r(q_b)*q_a = q_a*q_b."""
+    q, is_numpy = _to_tensor(q)
+    x, y, z, w = q.unbind(dim=-1)
+    Om = torch.stack([w, z, -y, x,
+                      -z, w, x, y,
+                      y, -x, w, z,
+                      -x, -y, -z, w], dim=-1).view(q.shape + (4,))
+    return Om.numpy() if is_numpy else Om
 
 def pure_quat(v):
-    q = np.zeros(4)
-    q[:3] = v
-    return q
+    """Pure quaternion [v, 0] (xyzw) of 3-vectors v."""
+    v, is_numpy = _to_tensor(v)
+    q = torch.cat([v, v.new_zeros(v.shape[:-1] + (1,))], dim=-1)
+    return q.numpy() if is_numpy else q
+
+def _build_omega_lr_tensor(N, device, dtype):
+    #T[k,l] = Omega_l(e_k)*Omega_r(e_l) for the unit quaternions e_k, e_l
+    E = torch.eye(4, dtype=torch.float64)
+    return torch.matmul(Omega_l(E).unsqueeze(1), Omega_r(E).unsqueeze(0)).to(device=device, dtype=dtype)
+
+def Omega_lr(q_a, q_b):
+    """Fused product Omega_l(q_a)*Omega_r(q_b) (i.e., the matrix of x -> q_a*x*q_b) of broadcastable (...,4) inputs.
+    The product is bilinear in q_a and q_b, so it is contracted directly from a cached 4x4x4x4 constant tensor
+    without forming the individual Omega matrices.
+    """
+    q_a, is_numpy = _to_tensor(q_a)
+    q_b, _ = _to_tensor(q_b)
+    T = utils.cached_constant('omega_lr', 4, q_a.device, q_a.dtype, _build_omega_lr_tensor)
+    Om = torch.einsum('...k,...l,klmn->...mn', q_a, q_b, T)
+    return Om.numpy() if is_numpy else Om
 
 #PYTORCH
 ##########
 
 #ASSUMES XYZW
 def quat_inv(q):
-    #Note, 'empty_like' is necessary to prevent in-place modification (which is not auto-diff'able)
+    #Inverse (conjugate) of unit quaternions, (...,4) tensors
     if q.dim() < 2:
-        q = q.unsqueeze()
-    q_inv = torch.empty_like(q)
-    q_inv[:, :3] = -1*q[:, :3]
-    q_inv[:, 3] = q[:, 3]
+        q = q.unsqueeze(dim=0)
+    q_inv = torch.cat([-q[..., :3], q[..., 3:]], dim=-1)
     return q_inv.squeeze()
 
+def quat_mul(q_a, q_b):
+    """Hamilton product q_a*q_b (= Omega_l(q_a)*q_b = Omega_r(q_b)*q_a) of broadcastable (...,4) tensors (xyzw)."""
+    q_a, q_b = torch.broadcast_tensors(q_a, q_b)
+    a_v, a_w = q_a[..., :3], q_a[..., 3:]
+    b_v, b_w = q_b[..., :3], q_b[..., 3:]
+    v = a_w*b_v + b_w*a_v + torch.cross(a_v, b_v, dim=-1)
+    w = a_w*b_w - (a_v*b_v).sum(dim=-1, keepdim=True)
+    return torch.cat([v, w], dim=-1)
+
+def quat_compose(q_a, q_b):
+    """Unit quaternion of the rotation C(q_a)*C(q_b), renormalized to prevent drift over long chains (xyzw)."""
+    q = quat_mul(q_a, q_b)
+    return q / q.norm(dim=-1, keepdim=True)
+
+def quat_rotate(q, points):
+    """Rotates points by unit quaternions (xyzw), i.e., C(q)*p without forming C.
+    q: Bx4 tensor, points: Bx3 or BxNx3 tensor (or broadcastable shapes), returns rotated points with the shape of points.
+    """
+    if points.dim() > q.dim():
+        q = q.unsqueeze(dim=-2)
+    q, _ = torch.broadcast_tensors(q, points[..., :1])
+    u, w = q[..., :3], q[..., 3:]
+    # p' = p + 2w(u x p) + 2u x (u x p)
+    uxp = torch.cross(u, points, dim=-1)
+    return points + 2.*(w*uxp + torch.cross(u, uxp, dim=-1))
+
 
 #Quaternion difference of two unit quaternions
 def quat_norm_diff(q_a, q_b):
@@ -95,52 +120,37 @@ def quat_norm_to_angle(q_norms, units='deg'):
     return angle
 
 
-def quat_to_rotmat(quat, ordering='xyzw'):
+def quat_to_rotmat(quat, ordering='xyzw', validate=False):
     """Form a rotation matrix from a unit length quaternion.
 
         Valid orderings are 'xyzw' and 'wxyz'.
+        The quaternions are assumed to be unit length. With validate=True, their norms are checked (this syncs with
+        the device) and non-unit quaternions are normalized with a warning.
     """
     if quat.dim() < 2:
         quat = quat.unsqueeze(dim=0)
 
-    if not utils.allclose(quat.norm(p=2, dim=1), 1.):
+    if validate and not utils.allclose(quat.norm(p=2, dim=1), 1.):
         print("Warning: Some quaternions not unit length ... normalizing.")
         quat = quat/quat.norm(p=2, dim=1, keepdim=True)
 
     if ordering == 'xyzw':
-        qx = quat[:, 0]
-        qy = quat[:, 1]
-        qz = quat[:, 2]
-        qw = quat[:, 3]
+        qx, qy, qz, qw = quat.unbind(dim=1)
     elif ordering == 'wxyz':
-        qw = quat[:, 0]
-        qx = quat[:, 1]
-        qy = quat[:, 2]
-        qz = quat[:, 3]
+        qw, qx, qy, qz = quat.unbind(dim=1)
     else:
         raise ValueError(
             "Valid orderings are 'xyzw' and 'wxyz'. Got '{}'.".format(ordering))
 
-    # Form the matrix
-    mat = quat.new_empty(quat.shape[0], 3, 3)
-
     qx2 = qx * qx
     qy2 = qy * qy
     qz2 = qz * qz
 
-    mat[:, 0, 0] = 1. - 2. * (qy2 + qz2)
-    mat[:, 0, 1] = 2. * (qx * qy - qw * qz)
-    mat[:, 0, 2] = 2. * (qw * qy + qx * qz)
+    mat = torch.stack([1. - 2. * (qy2 + qz2), 2. * (qx * qy - qw * qz), 2. * (qw * qy + qx * qz),
+                       2. * (qw * qz + qx * qy), 1. - 2. * (qx2 + qz2), 2. * (qy * qz - qw * qx),
+                       2. * (qx * qz - qw * qy), 2. * (qw * qx + qy * qz), 1. - 2. * (qx2 + qy2)], dim=1)
 
-    mat[:, 1, 0] = 2. * (qw * qz + qx * qy)
-    mat[:, 1, 1] = 1. - 2. * (qx2 + qz2)
-    mat[:, 1, 2] = 2. * (qy * qz - qw * qx)
-
-    mat[:, 2, 0] = 2. * (qx * qz - qw * qy)
-    mat[:, 2, 1] = 2. * (qw * qx + qy * qz)
-    mat[:, 2, 2] = 1. - 2. * (qx2 + qy2)
-
-    return mat.squeeze_()
+    return mat.view(-1, 3, 3).squeeze()
 
 
 #Based on https://d3cw3dd2w32x2b.cloudfront.net/wp-content/uploads/2015/01/matrix-to-quat.pdf
@@ -148,6 +158,8 @@ def rotmat_to_quat(mat, ordering='xyzw'):
     """Convert a rotation matrix to a unit length quaternion.
 
         Valid orderings are 'xyzw' and 'wxyz'.
+        All four candidates are computed in one pass and the one selected by Day's comparisons is gathered (no
+        masked branches, no host syncs).
     """
     if mat.dim() < 3:
         R = mat.unsqueeze(dim=0)
@@ -159,55 +171,31 @@ def rotmat_to_quat(mat, ordering='xyzw'):
 
     #Row first operation
     R = R.transpose(1,2)
-    q = R.new_empty((R.shape[0], 4))
-
-    cond1_mask = R[:, 2, 2] < 0.
-    cond1a_mask = R[:, 0, 0] > R[:, 1, 1]
-    cond1b_mask = R[:, 0, 0] < -R[:, 1, 1]
-
-    if ordering=='xyzw':
-        v_ind = torch.arange(0,3)
-        w_ind = 3
-    else:
-        v_ind = torch.arange(1,4)
-        w_ind = 0    
-
-    mask = cond1_mask & cond1a_mask
-    if mask.any():
-        t = 1 + R[mask, 0, 0] - R[mask, 1, 1] - R[mask, 2, 2]
-        q[mask, w_ind] =  R[mask, 1, 2]- R[mask, 2, 1]
-        q[mask, v_ind[0]] = t
-        q[mask, v_ind[1]] = R[mask, 0, 1] + R[mask, 1, 0]
-        q[mask, v_ind[2]] = R[mask, 2, 0] + R[mask, 0, 2]
-        q[mask, :] *= 0.5 / torch.sqrt(t.unsqueeze(dim=1))
-
-    mask = cond1_mask & cond1a_mask.logical_not()
-    if mask.any():
-        t = 1 - R[mask,0, 0] + R[mask,1, 1] - R[mask,2, 2]
-        q[mask, w_ind] =  R[mask,2, 0]-R[mask,0, 2]
-        q[mask, v_ind[0]] = R[mask,0, 1]+R[mask,1, 0]
-        q[mask, v_ind[1]] = t
-        q[mask, v_ind[2]] = R[mask,1, 2]+R[mask,2, 1]
-        q[mask, :] *= 0.5 / torch.sqrt(t.unsqueeze(dim=1))
-
-    mask = cond1_mask.logical_not() & cond1b_mask
-    if mask.any():
-        t = 1 - R[mask,0, 0] - R[mask,1, 1] + R[mask,2, 2]
-        q[mask, w_ind] =  R[mask,0, 1]-R[mask,1, 0]
-        q[mask, v_ind[0]] = R[mask,2, 0]+R[mask,0, 2]
-        q[mask, v_ind[1]] = R[mask,1, 2]+R[mask,2, 1]
-        q[mask, v_ind[2]] = t
-        q[mask, :] *= 0.5 / torch.sqrt(t.unsqueeze(dim=1))
-
-    mask = cond1_mask.logical_not() & cond1b_mask.logical_not()
-    if mask.any():
-        t = 1 + R[mask, 0, 0] + R[mask,1, 1] + R[mask,2, 2]
-        q[mask, w_ind] = t
-        q[mask, v_ind[0]] = R[mask,1, 2]-R[mask,2, 1]
-        q[mask, v_ind[1]] = R[mask,2, 0]-R[mask,0, 2]
-        q[mask, v_ind[2]] = R[mask,0, 1]-R[mask,1, 0]
-        q[mask, :] *= 0.5 / torch.sqrt(t.unsqueeze(dim=1))
-    
+    R00, R01, R02 = R[:, 0, 0], R[:, 0, 1], R[:, 0, 2]
+    R10, R11, R12 = R[:, 1, 0], R[:, 1, 1], R[:, 1, 2]
+    R20, R21, R22 = R[:, 2, 0], R[:, 2, 1], R[:, 2, 2]
+
+    t = torch.stack([1 + R00 - R11 - R22,
+                     1 - R00 + R11 - R22,
+                     1 - R00 - R11 + R22,
+                     1 + R00 + R11 + R22], dim=1)
+
+    #Candidates (xyzw, before scaling) in rows, their largest entry is t
+    s_01, s_20, s_12 = R01 + R10, R20 + R02, R12 + R21
+    d_12, d_20, d_01 = R12 - R21, R20 - R02, R01 - R10
+    candidates = torch.stack([
+        torch.stack([t[:, 0], s_01, s_20, d_12], dim=1),
+        torch.stack([s_01, t[:, 1], s_12, d_20], dim=1),
+        torch.stack([s_20, s_12, t[:, 2], d_01], dim=1),
+        torch.stack([d_12, d_20, d_01, t[:, 3]], dim=1)], dim=1)
+
+    #Branch 0: R22 < 0, R00 > R11 | 1: R22 < 0, R00 <= R11 | 2: R22 >= 0, R00 < -R11 | 3: R22 >= 0, R00 >= -R11
+    branch = torch.where(R22 < 0., (R00 <= R11).long(), 2 + (R00 >= -R11).long())
+    q = candidates.gather(1, branch.view(-1, 1, 1).expand(-1, 1, 4)).squeeze(1)
+    q = q * (0.5 / torch.sqrt(t.gather(1, branch.view(-1, 1))))
+
+    if ordering != 'xyzw':
+        q = q[:, [3, 0, 1, 2]]
     return q.squeeze()
 
 
@@ -6,6 +6,7 @@ from liegroups.torch import SO3
 from sdp_layers import x_from_xxT
 import math
 from losses import quat_chordal_squared_loss, rotmat_frob_squared_norm_loss
+from qcqp_layers import sym_dim_from_packed, packed_sym_frob_norm, packed_sym_matvec, convert_Avec_to_A, convert_A_to_Avec, convert_Avec_to_Avec_psd
 
 def test_180_quat():
     a = torch.randn(25,3).to(torch.float64)
@@ -65,6 +66,149 @@ def test_xxT():
     assert(allclose(x, x_from_xxT(X)))
     print('All passed.')
 
+def test_cached_constants():
+    print('Testing cached constant tensors...')
+    idx = cached_triu_indices(4)
+    assert(idx is cached_triu_indices(4))
+    assert(torch.equal(idx, torch.triu_indices(4, 4)))
+    assert(torch.equal(cached_tril_indices(10), torch.tril_indices(10, 10)))
+    assert(cached_eye(4, dtype=torch.double) is not cached_eye(4, dtype=torch.float))
+
+    I_ij = cached_sym_basis(4, dtype=torch.double)
+    A_vec = torch.randn(10, dtype=torch.double)
+    A = torch.einsum('m,mij->ij', A_vec, I_ij)
+    assert(allclose(A, A.t()))
+    assert(allclose(A[idx[0], idx[1]], A_vec))
+    print('All passed.')
+
+def test_packed_sym():
+    print('Testing packed symmetric matrix utilities...')
+    for N in [2, 3, 4, 7, 10]:
+        M = N*(N+1)//2
+        assert(sym_dim_from_packed(M) == N)
+        A_vec = torch.randn(20, M, dtype=torch.double)
+        x = torch.randn(20, N, dtype=torch.double)
+        A = convert_Avec_to_A(A_vec).view(20, N, N)
+        assert(allclose(convert_A_to_Avec(A).view(20, M), A_vec))
+        assert(allclose(packed_sym_frob_norm(A_vec), A.norm(dim=[1,2])))
+        assert(allclose(packed_sym_matvec(A_vec, x).view(20, N), A.bmm(x.unsqueeze(2)).squeeze(2)))
+        A_psd = convert_Avec_to_A(convert_Avec_to_Avec_psd(A_vec)).view(20, N, N)
+        assert((torch.linalg.eigvalsh(A_psd) > -1e-10).all())
+    try:
+        sym_dim_from_packed(12)
+        assert(False)
+    except ValueError:
+        pass
+    print('All passed.')
+
+def test_solve_horn_batch():
+    print('Testing batched Horn solver...')
+    from torch.autograd import gradcheck
+    for N in [2, 3, 50]:
+        C = SO3.exp(torch.randn(20, 3, dtype=torch.double)).as_matrix()
+        x_1 = torch.randn(20, N, 3, dtype=torch.double)
+        x_2 = x_1.bmm(C.transpose(1, 2)) + 0.01*torch.randn(20, N, 3, dtype=torch.double)
+        C_est = solve_horn_batch(x_1, x_2)
+        C_np = torch.stack([torch.from_numpy(solve_horn(x_1[i].numpy(), x_2[i].numpy())) for i in range(20)])
+        assert(allclose(C_est, C_np))
+        assert(allclose(torch.det(C_est), 1.))
+
+    #Unit weights change nothing, zero weights remove points
+    assert(allclose(solve_horn_batch(x_1, x_2, weights=2.*torch.ones(20, 50, dtype=torch.double)), C_est))
+    weights = torch.ones(20, 50, dtype=torch.double)
+    weights[:, 25:] = 0.
+    assert(allclose(solve_horn_batch(x_1, x_2, weights=weights), solve_horn_batch(x_1[:, :25], x_2[:, :25])))
+
+    x_1 = x_1[:2, :10].clone().requires_grad_()
+    assert(gradcheck(solve_horn_batch, (x_1, x_2[:2, :10]), eps=1e-6, atol=1e-5))
+    print('All passed.')
+
+def test_rotmat_to_quat_branch_free():
+    print('Testing branch-free rotmat_to_quat against quat_to_rotmat round trips...')
+    q = torch.randn(10000, 4, dtype=torch.double)
+    q = q/q.norm(dim=1, keepdim=True)
+    #Identity and 180 degree rotations about the axes
+    q = torch.cat([q, torch.tensor([[0., 0., 0., 1.], [1., 0., 0., 0.], [0., 1., 0., 0.], [0., 0., 1., 0.]], dtype=torch.double)])
+    C = quat_to_rotmat(q)
+    for ordering in ['xyzw', 'wxyz']:
+        for dtype, tol in [(torch.float, 1e-5), (torch.double, 1e-12)]:
+            q_out = rotmat_to_quat(C.to(dtype), ordering)
+            assert(q_out.dtype == dtype)
+            assert(allclose(q_out.norm(dim=1).double(), 1., tol))
+            assert(allclose(quat_to_rotmat(q_out, ordering).double(), C, tol))
+            if ordering == 'wxyz':
+                q_out = q_out[:, [1, 2, 3, 0]]
+            #Equal to the input quaternion up to sign
+            q_err = torch.min((q_out.double() - q).norm(dim=1), (q_out.double() + q).norm(dim=1))
+            assert(allclose(q_err, 0., tol))
+    assert(rotmat_to_quat(C[0]).shape == (4,))
+    print('All passed.')
+
+def test_quat_algebra():
+    print('Testing batched quaternion algebra kernels...')
+    q_a = torch.randn(1000, 4, dtype=torch.double)
+    q_a = q_a/q_a.norm(dim=1, keepdim=True)
+    q_b = torch.randn(1000, 4, dtype=torch.double)
+    q_b = q_b/q_b.norm(dim=1, keepdim=True)
+    C_a, C_b = quat_to_rotmat(q_a), quat_to_rotmat(q_b)
+
+    q_ab = quat_mul(q_a, q_b)
+    for i in range(10):
+        assert(np.allclose(q_ab[i].numpy(), Omega_l(q_a[i].numpy()).dot(q_b[i].numpy()), atol=1e-12))
+    assert(allclose(quat_to_rotmat(quat_compose(q_a, q_b)), C_a.bmm(C_b), 1e-12))
+    assert(allclose(quat_mul(q_a, quat_inv(q_a)), torch.tensor([0., 0., 0., 1.], dtype=torch.double), 1e-12))
+
+    p = torch.randn(1000, 20, 3, dtype=torch.double)
+    assert(allclose(quat_rotate(q_a, p), p.bmm(C_a.transpose(1, 2)), 1e-12))
+    assert(allclose(quat_rotate(q_a, p[:, 0]), C_a.bmm(p[:, 0].unsqueeze(2)).squeeze(2), 1e-12))
+
+    #Non-unit quaternions are only normalized on request
+    assert(allclose(quat_to_rotmat(2.*q_a, validate=True), C_a, 1e-12))
+    assert(quat_to_rotmat(q_a[0]).shape == (3, 3))
+    print('All passed.')
+
+def test_omega_operators():
+    print('Testing batched Omega_l/Omega_r operators...')
+    q_a = torch.randn(100, 5, 4, dtype=torch.double)
+    q_b = torch.randn(100, 5, 4, dtype=torch.double)
+    x = torch.randn(100, 5, 4, dtype=torch.double)
+    assert(allclose(Omega_l(q_a).matmul(q_b.unsqueeze(-1)).squeeze(-1), quat_mul(q_a, q_b), 1e-12))
+    assert(allclose(Omega_r(q_b).matmul(q_a.unsqueeze(-1)).squeeze(-1), quat_mul(q_a, q_b), 1e-12))
+    assert(allclose(Omega_lr(q_a, q_b).matmul(x.unsqueeze(-1)).squeeze(-1), quat_mul(quat_mul(q_a, x), q_b), 1e-12))
+    assert(allclose(Omega_lr(q_a[:, :1], q_b), Omega_lr(q_a[:, :1].expand(-1, 5, -1), q_b), 1e-12))
+
+    #Numpy in, numpy out
+    v = np.random.randn(3)
+    assert(np.allclose(pure_quat(v), np.append(v, 0.)))
+    assert(np.allclose(Omega_l(q_a[0, 0].numpy()), Omega_l(q_a[0, 0]).numpy()))
+    assert(isinstance(Omega_lr(q_a[0, 0].numpy(), q_b[0, 0].numpy()), np.ndarray))
+    print('All passed.')
+
+def test_so3_log_batch():
+    print('Testing batched SO(3) log map and geodesic angle...')
+    axis = torch.randn(1000, 3, dtype=torch.double)
+    axis = axis / axis.norm(dim=1, keepdim=True)
+    #Generic, near zero and near/at 180 degree angles
+    angle = torch.cat([np.pi*torch.rand(700, dtype=torch.double), 1e-8*torch.rand(100, dtype=torch.double),
+                       np.pi - 1e-6*torch.rand(100, dtype=torch.double), np.pi*torch.ones(100, dtype=torch.double)])
+    C = SO3.exp(angle.unsqueeze(1)*axis).as_matrix()
+
+    phi = so3_log_batch(C)
+    assert(allclose(SO3.exp(phi).as_matrix(), C, 1e-10))
+    assert(allclose(phi.norm(dim=1), angle, 1e-10))
+    assert(allclose(so3_geodesic_angle(C), angle, 1e-10))
+    assert(allclose(phi[:700], angle[:700].unsqueeze(1)*axis[:700], 1e-10))
+
+    #C C_2^T = exp(phi_rel) has a known angle (the acos-based SO3.log loses accuracy close to 180 degrees)
+    phi_rel = np.pi*torch.rand(1000, 1, dtype=torch.double)*axis.flip(0)
+    C_2 = SO3.exp(-phi_rel).as_matrix().bmm(C)
+    angles_ref = phi_rel.norm(dim=1)*(180./np.pi)
+    assert(allclose(so3_geodesic_angle(C, C_2, units='deg'), angles_ref, 1e-6))
+    #Numpy in, numpy out
+    assert(np.allclose(so3_diff(C[:10].numpy(), C_2[:10].numpy()), angles_ref[:10].numpy()))
+    assert(np.isscalar(so3_diff(C[0].numpy(), C_2[0].numpy())) or so3_diff(C[0].numpy(), C_2[0].numpy()).shape == ())
+    print('All passed.')
+
 if __name__=='__main__':
     # test_rotmat_quat_conversions()
     # test_rot_angles()
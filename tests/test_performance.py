@@ -0,0 +1,134 @@
+"""
+Performance regression tier (CPU only, offline). Each test times a solver or conversion and fails if its throughput
+drops more than ROTATION_PERF_TOLERANCE (default 0.3, i.e., 30%) below the baseline stored in perf_baselines.json for
+this machine class. Each of NUM_SAMPLES timing samples averages as many calls as fit in MIN_SAMPLE_SEC, and the
+throughput is taken from the median sample, which keeps the run-to-run spread well below the tolerance. The tier only runs with ROTATION_PERF_TESTS=1 and is skipped on machine classes without baselines.
+
+Machine class: '<arch>-<N>cpu' by default, or set ROTATION_PERF_MACHINE_CLASS.
+Record baselines for this machine class with: python test_performance.py --record
+"""
+import torch
+import numpy as np
+import math
+import json
+import os
+import platform
+import argparse
+import pytest
+from qcqp_layers import QuadQuatFastSolver, solve_wahba_fast, compute_grad_fast
+from quaternions import rotmat_to_quat, quat_to_rotmat
+from rotation_benchmarks import time_case, environment_metadata
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'perf_baselines.json')
+BATCH_SIZE = 10000
+NUM_THREADS = 1
+NUM_SAMPLES = 7
+MIN_SAMPLE_SEC = 0.2
+NUM_RECORD_ROUNDS = 5
+
+def machine_class():
+    return os.environ.get('ROTATION_PERF_MACHINE_CLASS', '{}-{}cpu'.format(platform.machine(), os.cpu_count()))
+
+def _random_sym_A(num_samples):
+    A = torch.randn(num_samples, 4, 4, dtype=torch.double)
+    return 0.5*(A + A.transpose(1, 2))
+
+def _compute_grad_case(num_samples):
+    A = _random_sym_A(num_samples)
+    q, nu = solve_wahba_fast(A)
+    return A, lambda A: compute_grad_fast(A, nu, q)
+
+def _rotmat_case(num_samples):
+    q = torch.randn(num_samples, 4, dtype=torch.double)
+    return quat_to_rotmat(q/q.norm(dim=1, keepdim=True)), rotmat_to_quat
+
+def _quat_case(num_samples):
+    q = torch.randn(num_samples, 4, dtype=torch.double)
+    return q/q.norm(dim=1, keepdim=True), quat_to_rotmat
+
+#name -> (builder(num_samples) returning (input, function of the input), time the backward pass as well)
+PERF_CASES = {
+    'quat_qcqp_fwd_bwd': (lambda B: (torch.randn(B, 10, dtype=torch.double), QuadQuatFastSolver.apply), True),
+    'solve_wahba_fast': (lambda B: (_random_sym_A(B), solve_wahba_fast), False),
+    'compute_grad_fast': (_compute_grad_case, False),
+    'rotmat_to_quat': (_rotmat_case, False),
+    'quat_to_rotmat': (_quat_case, False),
+}
+
+def _mean_call_time(fn, x, num_calls, backward):
+    fwd_times, fwd_bwd_times = time_case(fn, x, num_calls, backward)
+    return float(np.mean(fwd_bwd_times if backward else fwd_times))
+
+def measure_throughput(name, num_samples=BATCH_SIZE):
+    """Median-of-NUM_SAMPLES throughput (samples/sec) of a perf case on the CPU with NUM_THREADS threads."""
+    builder, backward = PERF_CASES[name]
+    default_threads = torch.get_num_threads()
+    torch.set_num_threads(NUM_THREADS)
+    try:
+        torch.manual_seed(0)
+        x, fn = builder(num_samples)
+        with torch.set_grad_enabled(backward):
+            #Calls per sample such that each sample takes at least MIN_SAMPLE_SEC
+            num_calls = max(1, math.ceil(MIN_SAMPLE_SEC/_mean_call_time(fn, x, 3, backward)))
+            call_times = [_mean_call_time(fn, x, num_calls, backward) for _ in range(NUM_SAMPLES)]
+    finally:
+        torch.set_num_threads(default_threads)
+    return num_samples/float(np.median(call_times))
+
+def load_baselines():
+    if not os.path.exists(BASELINE_FILE):
+        return {}
+    with open(BASELINE_FILE) as f:
+        return json.load(f)
+
+def check_throughput(name):
+    if os.environ.get('ROTATION_PERF_TESTS', '0') != '1':
+        pytest.skip('Performance tier disabled (set ROTATION_PERF_TESTS=1).')
+    baselines = load_baselines().get(machine_class(), {}).get('throughput_per_sec', {})
+    if name not in baselines:
+        pytest.skip('No {} baseline for machine class {}.'.format(name, machine_class()))
+    tolerance = float(os.environ.get('ROTATION_PERF_TOLERANCE', 0.3))
+    throughput = measure_throughput(name)
+    print('{}: {:.3E} samples/sec (baseline {:.3E})'.format(name, throughput, baselines[name]))
+    assert throughput >= (1. - tolerance)*baselines[name], \
+        '{} throughput dropped to {:.1f}% of the baseline.'.format(name, 100.*throughput/baselines[name])
+
+def test_perf_quat_qcqp():
+    check_throughput('quat_qcqp_fwd_bwd')
+
+def test_perf_solve_wahba_fast():
+    check_throughput('solve_wahba_fast')
+
+def test_perf_compute_grad_fast():
+    check_throughput('compute_grad_fast')
+
+def test_perf_rotmat_to_quat():
+    check_throughput('rotmat_to_quat')
+
+def test_perf_quat_to_rotmat():
+    check_throughput('quat_to_rotmat')
+
+def record_baselines():
+    """Stores the median throughput of NUM_RECORD_ROUNDS rounds over all cases, so one slow or fast round does not
+    become the baseline"""
+    baselines = load_baselines()
+    rounds = [{name: measure_throughput(name) for name in PERF_CASES} for _ in range(NUM_RECORD_ROUNDS)]
+    throughputs = {name: float(np.median([r[name] for r in rounds])) for name in PERF_CASES}
+    baselines[machine_class()] = {'metadata': environment_metadata(), 'throughput_per_sec': throughputs}
+    with open(BASELINE_FILE, 'w') as f:
+        json.dump(baselines, f, indent=2, sort_keys=True)
+    return throughputs
+
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser(description='Solver performance regression tier.')
+    parser.add_argument('--record', action='store_true', default=False,
+                        help='Measure and store the baselines of this machine class.')
+    args = parser.parse_args()
+    if args.record:
+        for name, throughput in record_baselines().items():
+            print('{}: {:.3E} samples/sec'.format(name, throughput))
+        print('Saved baselines for machine class {} to {}.'.format(machine_class(), BASELINE_FILE))
+    else:
+        for name in PERF_CASES:
+            print('{}: {:.3E} samples/sec'.format(name, measure_throughput(name)))
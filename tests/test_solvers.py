@@ -6,7 +6,9 @@ from qcqp_layers import *
 from quaternions import *
 from helpers_sim import *
 import os
+import warnings
 from sdp_layers import RotMatSDPSolver
+from rotation_matrix_sdp import rotation_matrix_constraints, solve_equality_QCQP_dual_batch, solve_equality_SDP_batch, independent_constraints, _sdp_converged
 
 os.environ['KMP_DUPLICATE_LIB_OK'] = 'True'
 
@@ -47,6 +49,42 @@ def test_rotmat_sdp_pytorch_analytic_gradient(eps=1e-6, tol=1e-4, num_samples=2)
     print('Batch...Passed.')
 
 
+def test_rotmat_sdp_worker_pool(num_samples=6, num_workers=2):
+    print('Checking pooled SDP solver against the in-process layer ({} workers)'.format(num_workers))
+    A_vec = normalize_Avec(convert_Avec_to_Avec_psd(torch.randn((num_samples, 55), dtype=torch.double)))
+    grad_output = torch.randn((num_samples, 3, 3), dtype=torch.double)
+    rotmats, grads = [], []
+    #diffcp backward in both solvers
+    for solver in [RotMatSDPSolver(fast_path=False, kkt_backward=False),
+                   RotMatSDPSolver(num_workers=num_workers, fast_path=False, kkt_backward=False)]:
+        A_vec_in = A_vec.clone().requires_grad_()
+        rotmat = solver(A_vec_in)
+        rotmat.backward(grad_output)
+        solver.close()
+        rotmats.append(rotmat)
+        grads.append(A_vec_in.grad)
+    assert(allclose(rotmats[0], rotmats[1]))
+    assert(allclose(grads[0], grads[1]))
+    print('Done')
+
+def test_rotmat_sdp_worker_pool_pending_graphs(num_samples=4, num_workers=2, num_batches=6):
+    print('Checking pooled SDP solver with {} pending forward calls'.format(num_batches))
+    A_vec = normalize_Avec(convert_Avec_to_Avec_psd(torch.randn((num_samples, 55), dtype=torch.double)))
+    solver = RotMatSDPSolver(num_workers=num_workers, fast_path=False, kkt_backward=False)
+    #Graphs of forward calls that are freed without backward are released in the workers
+    solver(A_vec.clone().requires_grad_())
+    #Gradient accumulation over several forward calls
+    A_vec_in = A_vec.clone().requires_grad_()
+    loss = sum([solver(A_vec_in*(k + 1)).sum() for k in range(num_batches)])
+    loss.backward()
+    solver.close()
+
+    A_vec_ref = A_vec.clone().requires_grad_()
+    ref_solver = RotMatSDPSolver(fast_path=False, kkt_backward=False)
+    sum([ref_solver(A_vec_ref*(k + 1)).sum() for k in range(num_batches)]).backward()
+    assert(allclose(A_vec_in.grad, A_vec_ref.grad))
+    print('Done')
+
 def test_pytorch_fast_analytic_gradient(eps=1e-6, tol=1e-4, num_samples=100):
     print('Checking PyTorch sped-up gradients (random A, batch_size: {})'.format(num_samples))
     qcqp_solver = QuadQuatFastSolver.apply
@@ -56,6 +94,127 @@ def test_pytorch_fast_analytic_gradient(eps=1e-6, tol=1e-4, num_samples=100):
     assert (grad_test == True)
     print('Batch...Passed.')
 
+def test_vjp_fast_matches_full_jacobian(num_samples=100):
+    print('Checking spectral VJP against the full KKT Jacobian')
+    A = torch.randn((num_samples, 4, 4), dtype=torch.double)
+    A = 0.5 * (A.transpose(1, 2) + A)
+    grad_output = torch.randn((num_samples, 4), dtype=torch.double)
+
+    nus, qs = torch.linalg.eigh(A)
+    q, nu = wahba_from_eig(nus, qs)
+    vjp = compute_vjp_fast(nus, qs, q, grad_output)
+    vjp_ref = torch.einsum('bkq,bk->bq', compute_grad_fast(A, nu, q), grad_output)
+    assert(allclose(vjp, vjp_ref, 1e-8))
+    print('Done')
+
+def test_fused_solver_matches_unfused(num_samples=50):
+    print('Checking fused A_vec -> q layer against the unfused chain')
+    for enforce_psd in [True, False]:
+        for unit_frob_norm in [True, False]:
+            A_vec = torch.randn((num_samples, 10), dtype=torch.double, requires_grad=True)
+
+            A_vec_ref = A_vec
+            if enforce_psd:
+                A_vec_ref = convert_Avec_to_Avec_psd(A_vec_ref)
+            if unit_frob_norm:
+                A_vec_ref = normalize_Avec(A_vec_ref)
+            q_ref = QuadQuatFastSolver.apply(A_vec_ref)
+            A_ref = convert_Avec_to_A(A_vec_ref)
+            grad_ref, = torch.autograd.grad(q_ref.sum() + A_ref.sum(), A_vec)
+
+            q, A = QuadQuatFusedSolver.apply(A_vec, enforce_psd, unit_frob_norm, True)
+            grad, = torch.autograd.grad(q.sum() + A.sum(), A_vec)
+
+            assert(allclose(q, q_ref, 1e-10))
+            assert(allclose(A, A_ref, 1e-10))
+            assert(allclose(grad, grad_ref, 1e-8))
+    print('Done')
+
+def test_fused_solver_analytic_gradient(eps=1e-6, tol=1e-4, num_samples=20):
+    print('Checking fused solver gradients (random A, batch_size: {})'.format(num_samples))
+    for enforce_psd in [True, False]:
+        for unit_frob_norm in [True, False]:
+            qcqp_solver = lambda A_vec: QuadQuatFusedSolver.apply(A_vec, enforce_psd, unit_frob_norm, True)
+            A_vec = torch.randn((num_samples, 10), dtype=torch.double, requires_grad=True)
+            grad_test = gradcheck(qcqp_solver, (A_vec,), eps=eps, atol=tol)
+            assert (grad_test == True)
+    print('Batch...Passed.')
+
+def test_inference_head_matches_fused_solver(num_samples=50):
+    print('Checking scripted inference head against the fused solver (batch_size: {})'.format(num_samples))
+    A_vec = torch.randn((num_samples, 10), dtype=torch.double)
+    for enforce_psd in [True, False]:
+        for unit_frob_norm in [True, False]:
+            head = torch.jit.script(QuadQuatInferenceHead(enforce_psd, unit_frob_norm).double())
+            q, A = QuadQuatFusedSolver.apply(A_vec, enforce_psd, unit_frob_norm, True)
+            assert(allclose(head(A_vec), q, tol=1e-10))
+            assert(allclose(head.output_A(A_vec), A))
+    print('Done')
+
+def test_mixed_precision_solver(num_samples=1000, gap_tol=1e-2):
+    print('Checking eigengap-aware mixed precision solver (batch_size: {})'.format(num_samples))
+    M = torch.randn((num_samples, 4, 4), dtype=torch.double)
+    _, V = torch.linalg.eigh(M + M.transpose(1, 2))
+    nus = torch.rand((num_samples, 4), dtype=torch.double).sort(dim=1)[0]
+    #Make every tenth sample nearly degenerate
+    nus[::10, 1] = nus[::10, 0] + 1e-5
+    A = V.bmm(torch.diag_embed(nus)).bmm(V.transpose(1, 2)).float()
+    A_vec = convert_A_to_Avec(A)
+    grad_output = torch.randn((num_samples, 4))
+
+    A_vec_double = A_vec.double().requires_grad_()
+    q_double = QuadQuatFastSolver.apply(A_vec_double)
+    q_double.backward(grad_output.double())
+
+    A_vec_mixed = A_vec.clone().requires_grad_()
+    q_mixed = QuadQuatFastSolver.apply(A_vec_mixed, 'eigh', gap_tol)
+    q_mixed.backward(grad_output)
+    assert(q_mixed.dtype == A_vec_mixed.grad.dtype == torch.float)
+    #float32 eigenvectors are accurate to O(eps/gap), where gap is the relative eigengap (at least gap_tol for the
+    #samples that stay in float32). The error at gap = gap_tol is ~1.2e-5, above a fixed 1e-5 bound.
+    eps = torch.finfo(torch.float).eps
+    nus_A = torch.linalg.eigvalsh(A.double())
+    gap = (nus_A[:, 1] - nus_A[:, 0]) / A.double().norm(dim=[1,2])
+    q_err = (q_mixed.double() - q_double).abs().max(dim=1)[0]
+    assert((q_err < 4.*eps/gap).all())
+    assert(q_err.max() < 4.*eps/gap_tol)
+    grad_err = (A_vec_mixed.grad.double() - A_vec_double.grad).norm(dim=1) / A_vec_double.grad.norm(dim=1)
+    assert(grad_err.max() < 1e-2)
+
+    q_fused = QuadQuatFusedSolver.apply(A_vec, False, False, False, 'eigh', gap_tol)
+    q_err = (q_fused.double() - q_double).abs().max(dim=1)[0]
+    assert((q_err < 4.*eps/gap).all())
+    print('Done')
+
+def test_warm_start_wahba_solver(num_samples=100, num_frames=10):
+    print('Checking warm-started solver on slowly varying A')
+    A_0 = torch.randn((num_samples, 4, 4), dtype=torch.double)
+    A_0 = A_0.bmm(A_0.transpose(1, 2))
+    dA = 0.01*torch.randn((num_samples, 4, 4), dtype=torch.double)
+    dA = dA + dA.transpose(1, 2)
+
+    solver = QuadQuatWarmStartSolver(min_batch_size=1)
+    for k in range(num_frames):
+        A = A_0 + k*dA
+        q = solver(A)
+        q_ref, _ = solve_wahba_fast(A)
+        assert(allclose(torch.min((q - q_ref).norm(dim=1), (q + q_ref).norm(dim=1)), 0., 1e-6))
+    #Only the first frame should need the full solve
+    assert(solver.num_fallback < 2*num_samples)
+    #Batches below min_batch_size always use the full solve
+    solver = QuadQuatWarmStartSolver(min_batch_size=num_samples + 1)
+    for k in range(2):
+        solver(A_0 + k*dA)
+    assert(solver.num_fallback == solver.num_solves == 2*num_samples)
+
+    #Warm-starting from the largest eigenvector must be rejected
+    nus, qs = torch.linalg.eigh(A_0)
+    q, _, fallback = solve_wahba_warm_start(A_0, qs[:, :, 3])
+    q_ref, _ = solve_wahba_fast(A_0)
+    assert(fallback.all())
+    assert(allclose(q, q_ref))
+    print('Done')
+
 def test_duality_gap_wahba_solver(num_samples=100):
     print('Checking duality gap on the fast Wahba solver')
     A = torch.randn((num_samples, 4, 4), dtype=torch.double, requires_grad=True)
@@ -64,6 +223,33 @@ def test_duality_gap_wahba_solver(num_samples=100):
     assert np.allclose(gap.detach().numpy(), 0.0)
     print('Done')
 
+def test_jacobi_symeig_4x4(num_samples=1000):
+    print('Checking accuracy of the Jacobi 4x4 eigensolver against torch.linalg.eigh')
+    for dtype, tol in [(torch.double, 1e-10), (torch.float, 1e-4)]:
+        A = torch.randn((num_samples, 4, 4), dtype=dtype)
+        A = 0.5 * (A.transpose(1, 2) + A)
+        nus, qs = torch.linalg.eigh(A)
+        nus_jac, qs_jac = batch_symeig_4x4(A)
+        assert(allclose(nus_jac, nus, tol))
+        assert(allclose(qs_jac.bmm(qs_jac.transpose(1, 2)), torch.eye(4, dtype=dtype), tol))
+
+        q_diff = torch.min((qs_jac[:,:,0] - qs[:,:,0]).norm(dim=1), (qs_jac[:,:,0] + qs[:,:,0]).norm(dim=1))
+        assert(allclose(q_diff, 0., tol))
+
+        q_opt, nu_opt = solve_wahba_fast(A, eig_solver='jacobi')
+        q_opt_ref, nu_opt_ref = solve_wahba_fast(A)
+        assert(allclose(q_opt, q_opt_ref, tol))
+        assert(allclose(nu_opt, nu_opt_ref, tol))
+    print('Done')
+
+def test_pytorch_fast_jacobi_analytic_gradient(eps=1e-6, tol=1e-4, num_samples=100):
+    print('Checking PyTorch sped-up gradients with the Jacobi eigensolver (random A, batch_size: {})'.format(num_samples))
+    qcqp_solver = lambda A_vec: QuadQuatFastSolver.apply(A_vec, 'jacobi')
+    A_vec = torch.randn((num_samples, 10), dtype=torch.double, requires_grad=True)
+    input = (A_vec,)
+    grad_test = gradcheck(qcqp_solver, input, eps=eps, atol=tol)
+    assert (grad_test == True)
+    print('Batch...Passed.')
 
 def test_compare_fast_and_slow_solvers(eps=1e-6, tol=1e-4, num_samples=5):
     print('Checking accuracy of fast solver')
@@ -134,6 +320,287 @@ def create_wahba_As(N=10):
             A[n] += torch.from_numpy(mat.T.dot(mat))
     return A, C
 
+def create_degenerate_wahba_As():
+    #All points on one axis: every rotation about it is optimal and the SDP solution has rank > 1
+    A = torch.zeros(2, 10, 10, dtype=torch.double)
+    for n, axis in enumerate([np.array([0., 0., 1.]), np.array([1., 2., 2.])/3.]):
+        mat = np.zeros((3,10))
+        mat[:,:9] = np.kron(axis, np.eye(3))
+        mat[:,9] = -axis
+        A[n] = torch.from_numpy(mat.T.dot(mat))
+    return A
+
+def test_rotmat_qcqp_dual_batch(N=20):
+    print('Checking batched rotmat QCQP dual solver with {} datasets.'.format(N))
+    A, C = create_wahba_As(N)
+    constraint_matrices, c_vec = rotation_matrix_constraints()
+    r, nu, converged = solve_equality_QCQP_dual_batch(A, constraint_matrices, c_vec)
+    assert(converged.all())
+    assert(allclose(r[:, 9], 1.))
+    assert(allclose(r[:, :9].view(-1, 3, 3).transpose(1, 2), C, tol=1e-8))
+
+    #KKT: A + sum_i nu_i E_i is PSD and r is in its null space
+    Z = A + torch.einsum('bi,imn->bmn', nu, torch.from_numpy(constraint_matrices))
+    assert(allclose(Z.bmm(r.unsqueeze(2)), 0., tol=1e-8))
+    assert((torch.linalg.eigvalsh(Z)[:, 0] > -1e-8).all())
+
+    #float32 costs are solved in float64 internally
+    r_float, nu_float, converged = solve_equality_QCQP_dual_batch(A.float(), constraint_matrices, c_vec)
+    assert(converged.all())
+    assert(r_float.dtype == nu_float.dtype == torch.float)
+    assert(allclose(r_float.double(), r, tol=1e-5))
+    print('Done')
+
+def test_rotmat_sdp_ipm(N=10, eps=1e-4, tol=1e-4):
+    print('Checking torch interior-point rotmat SDP solver with {} datasets.'.format(N))
+    A, C = create_wahba_As(N)
+    A_vec = normalize_Avec(convert_A_to_Avec(A))
+    sdp_solver = RotMatSDPSolver(solver='ipm')
+    assert(allclose(sdp_solver(A_vec), C, tol=1e-6))
+
+    #Implicit differentiation (tight relaxation) against finite differences
+    A_vec = A_vec[:2].clone().requires_grad_()
+    grad_test = gradcheck(sdp_solver, (A_vec,), eps=eps, atol=tol)
+    assert(grad_test == True)
+    print('Done')
+
+def test_sdp_ipm_convergence_check(N=10, tol=1e-9):
+    print('Checking that the interior-point SDP solver only reports dual feasible iterates as converged.')
+    A, _ = create_wahba_As(N)
+    E, c = rotation_matrix_constraints()
+    X, nu, converged = solve_equality_SDP_batch(A, E, c, tol=tol)
+    assert(converged.all())
+
+    #Iterates of the unit norm problem, see solve_equality_SDP_batch
+    rows = independent_constraints(E)
+    E_ind, b = torch.from_numpy(E)[rows], torch.from_numpy(c)[rows]
+    A_scale = A.norm(dim=[1,2])
+    C_n = A / A_scale.view(-1, 1, 1)
+    y = -nu[:, rows] / A_scale.view(-1, 1)
+    Z = C_n - torch.einsum('bi,imn->bmn', y, E_ind)
+    assert(_sdp_converged(C_n, E_ind, b, X, y, Z, tol).all())
+
+    #Perturbing y only breaks dual feasibility, X is still primal feasible and complementary to Z
+    y_bad = y + 1e-3*torch.randn_like(y)
+    assert(not _sdp_converged(C_n, E_ind, b, X, y_bad, Z, tol).any())
+    print('Done')
+
+def test_rotmat_sdp_fast_path(N=10):
+    print('Checking certificate-gated fast path of the SDP rotmat solver with {} datasets.'.format(N))
+    A, C = create_wahba_As(N)
+    A_vec = normalize_Avec(convert_A_to_Avec(A))
+    torch.manual_seed(0)
+    A_vec_rand = normalize_Avec(convert_Avec_to_Avec_psd(torch.randn((N, 55), dtype=torch.double)))
+
+    sdp_solver = RotMatSDPSolver(solver='ipm')
+    assert(allclose(sdp_solver(A_vec), C, tol=1e-6))
+    assert(sdp_solver.num_solves == N and sdp_solver.num_fallback == 0)
+
+    #Samples without a certificate take the SDP, the results are in the original order
+    A_vec = torch.cat([A_vec, A_vec_rand], dim=0).requires_grad_()
+    grad_output = torch.randn((2*N, 3, 3), dtype=torch.double)
+    rotmats, grads = [], []
+    for solver in [RotMatSDPSolver(solver='ipm'), RotMatSDPSolver(solver='ipm', fast_path=False)]:
+        rotmat = solver(A_vec)
+        grads.append(torch.autograd.grad(rotmat, A_vec, grad_output)[0])
+        rotmats.append(rotmat)
+        print('{}/{} samples used the SDP.'.format(solver.num_fallback, solver.num_solves))
+        assert(solver.num_fallback > 0)
+    assert(allclose(rotmats[0], rotmats[1], tol=1e-4))
+    assert(allclose(grads[0][:N], grads[1][:N], tol=1e-4))
+
+    #Non-tight samples (rank > 1 SDP solutions) must not use the KKT backward, compare against diffcp
+    A_vec = torch.cat([A_vec[:2].detach(), normalize_Avec(convert_A_to_Avec(create_degenerate_wahba_As()))], dim=0)
+    A_vec = A_vec.requires_grad_()
+    grad_output = torch.randn((A_vec.shape[0], 3, 3), dtype=torch.double)
+    grads = []
+    for solver in [RotMatSDPSolver(fast_path=False, kkt_backward=False), RotMatSDPSolver(), RotMatSDPSolver(solver='ipm')]:
+        grads.append(torch.autograd.grad(solver(A_vec), A_vec, grad_output)[0])
+        assert(solver.num_diffcp == (4 if solver.kkt_backward == False else 2))
+    assert(allclose(grads[1], grads[0], tol=1e-4))
+    assert(allclose(grads[2], grads[0], tol=1e-4))
+    print('Done')
+
+def test_rotmat_sdp_single_and_float(N=5):
+    print('Checking the SDP rotmat solver on a batch of one and in single precision with {} datasets.'.format(N))
+    A, C = create_wahba_As(N)
+    A_vec = normalize_Avec(convert_A_to_Avec(A))
+    for sdp_solver in [RotMatSDPSolver(), RotMatSDPSolver(solver='ipm'), RotMatSDPSolver(solver='ipm', fast_path=False)]:
+        assert(allclose(sdp_solver(A_vec[:1]), C[0], tol=1e-6))
+        A_vec_float = A_vec.float().requires_grad_()
+        rotmat = sdp_solver(A_vec_float)
+        rotmat.sum().backward()
+        assert(rotmat.dtype == torch.float and A_vec_float.grad.dtype == torch.float)
+        assert(allclose(rotmat.double(), C, tol=1e-4))
+    print('Done')
+
+def test_rotmat_sdp_layer_single_and_float(num_samples=3):
+    print('Checking the cvxpylayers SDP rotmat solver on a batch of one and in single precision.')
+    torch.manual_seed(0)
+    A_vec = normalize_Avec(convert_Avec_to_Avec_psd(torch.randn((num_samples, 55), dtype=torch.double)))
+    for kkt_backward in [True, False]:
+        sdp_solver = RotMatSDPSolver(fast_path=False, kkt_backward=kkt_backward)
+        rotmat = sdp_solver(A_vec)
+        assert(allclose(sdp_solver(A_vec[:1]), rotmat[0], tol=1e-6))
+        A_vec_float = A_vec.float().requires_grad_()
+        rotmat_float = sdp_solver(A_vec_float)
+        rotmat_float.sum().backward()
+        assert(rotmat_float.dtype == torch.float and A_vec_float.grad.dtype == torch.float)
+        assert(allclose(rotmat_float.double(), rotmat, tol=1e-4))
+    print('Done')
+
+def test_rotmat_sdp_ipm_fallback(N=4):
+    print('Checking that unconverged interior-point SDP solves fall back to cvxpylayers with {} datasets.'.format(N))
+    A, C = create_wahba_As(N)
+    A_vec = normalize_Avec(convert_A_to_Avec(A))
+    sdp_solver = RotMatSDPSolver(solver='ipm', fast_path=False, ipm_max_iter=1)
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter('always')
+        rotmat = sdp_solver(A_vec)
+    assert(sdp_solver.num_ipm_failed == N)
+    assert(any('did not converge' in str(w.message) for w in caught))
+    assert(allclose(rotmat, C, tol=1e-5))
+    print('Done')
+
+def test_rotmat_sdp_kkt_backward(N=5):
+    print('Checking KKT backward of the cvxpylayers SDP rotmat solver with {} datasets.'.format(N))
+    A, C = create_wahba_As(N)
+    grad_output = torch.randn((N, 3, 3), dtype=torch.double)
+    grads = []
+    #Reference: interior-point solver (gradient checked in test_rotmat_sdp_ipm)
+    for sdp_solver in [RotMatSDPSolver(solver='ipm', fast_path=False), RotMatSDPSolver(fast_path=False)]:
+        A_vec = convert_A_to_Avec(A).requires_grad_()
+        rotmat = sdp_solver(A_vec)
+        grads.append(torch.autograd.grad(rotmat, A_vec, grad_output)[0])
+    assert(allclose(grads[0], grads[1], tol=1e-5))
+    print('Done')
+
+def test_build_A_batch(N=20, N_points=30):
+    print('Checking batched A builder against build_A.')
+    _, x_1, x_2 = gen_sim_data_fast(N, N_points, 0.1)
+    x_1, x_2 = x_1.transpose(1, 2), x_2.transpose(1, 2)
+    sigma_2 = torch.rand(N, N_points, dtype=torch.double) + 0.1
+    A = build_A_batch(x_1, x_2, sigma_2)
+    A_loop = torch.stack([torch.from_numpy(build_A(x_1[i].numpy(), x_2[i].numpy(), sigma_2[i].numpy())) for i in range(N)])
+    assert(allclose(A, A_loop))
+    assert(allclose(build_A_batch(x_1, x_2, 0.01), build_A_batch(x_1, x_2, 0.01*torch.ones(N_points, dtype=torch.double))))
+
+    weights = (1./sigma_2[:2, :5]).requires_grad_()
+    assert(gradcheck(lambda w: build_A_batch(x_1[:2, :5], x_2[:2, :5], 1./w), (weights,)))
+    print('Done')
+
+def test_create_experimental_data(N_train=2000, N_test=10, N_points=50, sigma=0.1):
+    print('Checking batched synthetic data generation.')
+    train_data, test_data = create_experimental_data(N_train, N_test, N_points, sigma=sigma)
+    assert(train_data.x.shape == (N_train, 2, N_points, 3) and test_data.q.shape == (N_test, 4))
+    assert(allclose(train_data.x[:, 0].norm(dim=2), 1.))
+    assert(allclose(train_data.q.norm(dim=1), 1.))
+
+    #x_2 = C*x_1 + noise
+    C = quat_to_rotmat(train_data.q)
+    noise = train_data.x[:, 1] - train_data.x[:, 0].bmm(C.transpose(1, 2))
+    assert(abs(noise.std().item() - sigma) < 0.01*sigma)
+    assert(allclose(train_data.A_prior, build_A_batch(train_data.x[:, 0], train_data.x[:, 1], sigma**2)))
+    print('Done')
+
+def test_synthetic_data_stream(num_epochs=5):
+    print('Checking prefetching synthetic data stream.')
+    data_kwargs = {'N_train': 20, 'N_test': 5, 'N_matches_per_sample': 10, 'sigma': 0.01}
+    epochs = []
+    for num_workers in [1, 3]:
+        stream = SyntheticDataStream(num_epochs, data_kwargs, queue_depth=1, num_workers=num_workers, seed=7)
+        epochs.append([train_data.x for train_data, _ in stream])
+    assert(len(epochs[0]) == num_epochs)
+    #Same data regardless of the number of workers, different data in every epoch
+    assert(all(torch.equal(x_1, x_2) for x_1, x_2 in zip(epochs[0], epochs[1])))
+    assert(not torch.equal(epochs[0][0], epochs[0][1]))
+
+    #Stopping early does not hang
+    stream = SyntheticDataStream(100, data_kwargs, queue_depth=1, seed=7)
+    train_data, test_data = next(iter(stream))
+    stream.close()
+    assert(torch.equal(train_data.x, epochs[0][0]))
+    print('Done')
+
+def test_synthetic_data_generator(N_train=2000, N_points=50, sigma=0.1):
+    print('Checking in-place synthetic data generator.')
+    for beachball in [False, True]:
+        generator = SyntheticDataGenerator(N_train, 10, N_points, sigma=sigma, beachball=beachball, max_rotation_angle=90.,
+                                           beachball_factors=[1., 1., 1., 1.], seed=0)
+        train_data, _ = generator.generate()
+        x = train_data.x.clone()
+        C = quat_to_rotmat(train_data.q)
+        assert(allclose(C.bmm(C.transpose(1, 2)), torch.eye(3, dtype=torch.double)))
+        assert(allclose(torch.det(C), 1.))
+        assert(allclose(train_data.x[:, 0].norm(dim=2), 1.))
+        noise = train_data.x[:, 1] - train_data.x[:, 0].bmm(C.transpose(1, 2))
+        assert(abs(noise.std().item() - sigma) < 0.01*sigma)
+        if not beachball:
+            assert((train_data.q[:, 3] >= np.cos(np.pi/4.) - 1e-12).all())
+
+        #The buffers are refilled in place
+        train_data_next, _ = generator.generate()
+        assert(train_data_next.x is train_data.x)
+        assert(not torch.equal(train_data_next.x, x))
+    print('Done')
+
+def test_point_cloud_asset_store(N_points=1000):
+    print('Checking point cloud asset store.')
+    import tempfile
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        os.makedirs(os.path.join(tmp_dir, 'models', 'test_object'))
+        points = np.random.randn(N_points, 3)
+        np.savetxt(os.path.join(tmp_dir, 'models', 'test_object', 'points.xyz'), points)
+        store = PointCloudAssetStore(root=os.path.join(tmp_dir, 'store'), model_dir=os.path.join(tmp_dir, 'models'), model_file='points.xyz')
+
+        assert(np.allclose(store.load('test_object', every_k=20), points[::20]))
+        assert(np.allclose(store.load('test_object', every_k=1), points))
+        assert(store.num_conversions == 1)
+        #A new store reuses the converted files
+        store = PointCloudAssetStore(root=os.path.join(tmp_dir, 'store'), model_dir=os.path.join(tmp_dir, 'models'), model_file='points.xyz')
+        assert(isinstance(store.load('test_object', every_k=5), np.memmap))
+        C, x_1, x_2 = gen_sim_data_bottle(4, 30, 0., None, asset_store=store, model_name='test_object')
+        assert(store.num_conversions == 0)
+        assert(x_1.shape == (4, 3, 30))
+        assert(allclose(x_2, C.bmm(x_1), tol=1e-3))
+        #Converted models load without a model directory, new ones need one
+        store = PointCloudAssetStore(root=os.path.join(tmp_dir, 'store'), model_file='points.xyz')
+        store.model_dir = None #Regardless of $YCB_MODEL_DIR
+        assert(np.allclose(store.load('test_object', every_k=20), points[::20]))
+        try:
+            store.load('other_object')
+            assert(False)
+        except ValueError as e:
+            assert('YCB_MODEL_DIR' in str(e))
+    print('Done')
+
+def test_rotation_benchmarks():
+    print('Checking rotation representation benchmark suite.')
+    import tempfile, json
+    from rotation_benchmarks import run_benchmarks, save_results
+    cases = ['quat', 'sixdim', 'quat_qcqp', 'rotmat_qcqp', 'rotmat_sdp', 'wahba_fast', 'wahba_warm_start']
+    results = run_benchmarks(cases, batch_sizes=[1, 10], dtypes=['float', 'double'], num_repeats=2, verbose=False)
+    assert(len(results) == 28)
+    for record in results:
+        #Every case runs in both precisions, any error is a failure
+        assert('error' not in record), record['error']
+        keys = ['forward'] if record['case'].startswith('wahba') else ['forward', 'forward_backward']
+        assert(('forward_backward' in record) == (len(keys) == 2))
+        for key in keys:
+            summary = record[key]
+            assert(np.isfinite(summary['min_sec']) and summary['min_sec'] > 0.)
+            assert(summary['median_sec'] >= summary['min_sec'])
+            assert(np.isclose(summary['throughput_per_sec'], record['batch_size']/summary['min_sec']))
+        if record['case'] == 'rotmat_sdp':
+            assert(0. <= record['fallback_rate'] <= 1.)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        save_results(results, os.path.join(tmp_dir, 'results.json'))
+        with open(os.path.join(tmp_dir, 'results.json')) as f:
+            saved = json.load(f)
+    assert(saved['results'] == results)
+    assert(saved['metadata']['torch'] == torch.__version__)
+    print('Done')
+
 def test_rotmat_sdp_wahba():
     N = 10
     print('Checking accuracy of SDP rotmat solver with {} datasets.'.format(N))
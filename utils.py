@@ -1,9 +1,47 @@
 import torch
 import numpy as np
-from liegroups.numpy import SO3
 from numpy.linalg import norm
 import math
 
+#Constant index and basis tensors, built once per (name, N, device, dtype) and shared by all callers.
+#Cached tensors must never be modified in place.
+_CONSTANT_CACHE = {}
+
+def cached_constant(name, N, device, dtype, builder):
+    """Return builder(N, device, dtype), building it on the first call for each (name, N, device, dtype)."""
+    key = (name, N, torch.device(device), dtype)
+    if key not in _CONSTANT_CACHE:
+        _CONSTANT_CACHE[key] = builder(N, torch.device(device), dtype)
+    return _CONSTANT_CACHE[key]
+
+def cached_triu_indices(N, device=torch.device('cpu')):
+    """Return the 2xM (M = N*(N+1)/2) upper triangular indices of an NxN matrix."""
+    return cached_constant('triu_indices', N, device, torch.long,
+                           lambda N, device, dtype: torch.triu_indices(N, N, device=device))
+
+def cached_tril_indices(N, device=torch.device('cpu')):
+    """Return the 2xM (M = N*(N+1)/2) lower triangular indices of an NxN matrix."""
+    return cached_constant('tril_indices', N, device, torch.long,
+                           lambda N, device, dtype: torch.tril_indices(N, N, device=device))
+
+def cached_eye(N, device=torch.device('cpu'), dtype=torch.float):
+    """Return the NxN identity matrix."""
+    return cached_constant('eye', N, device, dtype,
+                           lambda N, device, dtype: torch.eye(N, device=device, dtype=dtype))
+
+def _build_sym_basis(N, device, dtype):
+    idx = cached_triu_indices(N, device)
+    i = torch.arange(idx.shape[1], device=device)
+    I_ij = torch.zeros((idx.shape[1], N, N), device=device, dtype=dtype)
+    I_ij[i, idx[0], idx[1]] = 1.
+    I_ij[i, idx[1], idx[0]] = 1.
+    return I_ij
+
+def cached_sym_basis(N, device=torch.device('cpu'), dtype=torch.float):
+    """Return the MxNxN basis of symmetric matrices, one per upper triangular entry (i,j), with ones at (i,j) and (j,i)."""
+    return cached_constant('sym_basis', N, device, dtype, _build_sym_basis)
+
+
 def allclose(mat1, mat2, tol=1e-6):
     """Check if all elements of two tensors are close within some tolerance.
 
@@ -47,7 +85,7 @@ def trace(mat):
         mat = mat.unsqueeze(dim=0)
 
     # Element-wise multiply by identity and take the sum
-    tr =  (torch.eye(mat.shape[1], dtype=mat.dtype) * mat).sum(dim=1).sum(dim=1)
+    tr =  (cached_eye(mat.shape[1], mat.device, mat.dtype) * mat).sum(dim=1).sum(dim=1)
     
     return tr.view(mat.shape[0])
 
@@ -132,15 +170,62 @@ def compute_rotation_from_two_vectors(a_1, a_2, b_1, b_2):
     
     return C
 
+def _to_tensor(C):
+    if torch.is_tensor(C):
+        return C, False
+    return torch.from_numpy(np.asarray(C, dtype=np.float64)), True
+
+def _so3_vee_skew(C):
+    #vee((C - C^T)/2) = sin(angle)*axis
+    return 0.5*torch.stack([C[..., 2, 1] - C[..., 1, 2], C[..., 0, 2] - C[..., 2, 0], C[..., 1, 0] - C[..., 0, 1]], dim=-1)
+
+def so3_log_batch(C):
+    """
+    Batched SO(3) log map, robust near 0 and 180 degrees.
+    Input: Bx3x3 (or 3x3) numpy array or torch tensor of rotation matrices
+    Output: Bx3 (or 3) axis-angle vectors phi, with |phi| in [0, pi], of the same type as C
+    """
+    C, is_numpy = _to_tensor(C)
+    w = _so3_vee_skew(C)
+    sin = w.norm(dim=-1)
+    cos = 0.5*(C[..., 0, 0] + C[..., 1, 1] + C[..., 2, 2] - 1.)
+    angle = torch.atan2(sin, cos)
+
+    #Generic case, with the series of angle/sin(angle) near 0
+    small = angle < 1e-4
+    scale = torch.where(small, 1. + angle*angle/6., angle/torch.where(small, torch.ones_like(sin), sin))
+    phi = scale.unsqueeze(-1)*w
+
+    #Near 180 degrees, sin(angle) carries no direction. Read the axis off the largest column of
+    #(C + C^T)/2 - cos*I = (1 - cos)*a*a^T and take its sign from w.
+    large = cos < -0.9
+    S = 0.5*(C + C.transpose(-2, -1)) - cos[..., None, None]*torch.eye(3, dtype=C.dtype, device=C.device)
+    col = S.diagonal(dim1=-2, dim2=-1).argmax(dim=-1)
+    a = torch.gather(S, -1, col[..., None, None].expand(S.shape[:-1] + (1,))).squeeze(-1)
+    a = a/a.norm(dim=-1, keepdim=True).clamp(min=1e-12)
+    a = torch.where((a*w).sum(dim=-1, keepdim=True) < 0., -a, a)
+    phi = torch.where(large.unsqueeze(-1), angle.unsqueeze(-1)*a, phi)
+    return phi.numpy() if is_numpy else phi
+
+def so3_geodesic_angle(C_1, C_2=None, units='rad'):
+    """
+    Batched geodesic distance angle(C_1*C_2^T) on SO(3) (or the rotation angle of C_1 if C_2 is None).
+    Computed with atan2 of the sine and cosine parts, which is well conditioned near 0 and 180 degrees.
+    Input: Bx3x3 (or 3x3) numpy arrays or torch tensors
+    Output: B (or scalar) angles of the same type as C_1
+    """
+    C_1, is_numpy = _to_tensor(C_1)
+    C = C_1 if C_2 is None else C_1.matmul(_to_tensor(C_2)[0].to(C_1).transpose(-2, -1))
+    cos = 0.5*(C[..., 0, 0] + C[..., 1, 1] + C[..., 2, 2] - 1.)
+    angle = torch.atan2(_so3_vee_skew(C).norm(dim=-1), cos)
+    if units == 'deg':
+        angle = (180./np.pi)*angle
+    elif units != 'rad':
+        raise RuntimeError('Unknown units in metric conversion.')
+    return angle.numpy() if is_numpy else angle
+
 def so3_diff(C_1, C_2, unit='deg'):
-    A = SO3.from_matrix(C_1)
-    B = SO3.from_matrix(C_2)
-    err = A.dot(B.inv()).log()
-    if unit=='deg':
-        return norm(err)*180./np.pi
-    else:
-        return norm(err)
-        
+    return so3_geodesic_angle(C_1, C_2, units='deg' if unit=='deg' else 'rad')
 
 def solve_horn(x_1, x_2):
     x_1 = normalized(x_1, axis=1)
@@ -162,19 +247,41 @@ def solve_horn(x_1, x_2):
     C = U.dot(S).dot(V)
     return C
 
-def solve_horn_batch(x_1, x_2):
-    """Assumes x_1, x_2 are BXNX3, outputs Bx3x3 matrices"""
-    
-
-    x_1_n = x_1 - x_1.mean(dim=1, keepdim=True)
-    x_2_n = x_2 - x_1.mean(dim=1, keepdim=True)
-    
-    W = (1./(x_1.shape[0]))*x_2_n.T.dot(x_1_n)
-
-    U,_,V = torch.svd(W)
-    S = np.eye(3)
-    S[2,2] = np.linalg.det(U) * np.linalg.det(V)
-    C = U.dot(S).dot(V)
+def solve_horn_batch(x_1, x_2, weights=None, normalize=True):
+    """
+    Batched, differentiable version of solve_horn (weighted Horn/Umeyama).
+    Input: x_1, x_2: BxNx3 tensors of corresponding vectors, weights: optional BxN tensor of non-negative weights
+    Output: Bx3x3 rotation matrices C that minimize sum_n w_n ||x_2n - C*x_1n||^2 (after centering)
+    As in solve_horn, the vectors are first normalized to unit length and, if N = 2, completed with their cross product.
+    """
+    if x_1.dim() < 3:
+        x_1 = x_1.unsqueeze(dim=0)
+        x_2 = x_2.unsqueeze(dim=0)
+    if weights is None:
+        weights = x_1.new_ones(x_1.shape[0], x_1.shape[1])
+    elif weights.dim() < 2:
+        weights = weights.unsqueeze(dim=0)
+
+    if normalize:
+        x_1 = x_1 / x_1.norm(dim=2, keepdim=True).clamp(min=1e-12)
+        x_2 = x_2 / x_2.norm(dim=2, keepdim=True).clamp(min=1e-12)
+
+    if x_1.shape[1] == 2:
+        x_1 = torch.cat([x_1, torch.cross(x_1[:, 0], x_1[:, 1], dim=1).unsqueeze(1)], dim=1)
+        x_2 = torch.cat([x_2, torch.cross(x_2[:, 0], x_2[:, 1], dim=1).unsqueeze(1)], dim=1)
+        weights = torch.cat([weights, weights.mean(dim=1, keepdim=True)], dim=1)
+
+    weights = (weights / weights.sum(dim=1, keepdim=True)).unsqueeze(2)
+    x_1_n = x_1 - (weights*x_1).sum(dim=1, keepdim=True)
+    x_2_n = x_2 - (weights*x_2).sum(dim=1, keepdim=True)
+
+    W = x_2_n.transpose(1, 2).bmm(weights*x_1_n)
+
+    U, _, V = torch.svd(W)
+    #Reflection correction, det(C) = 1
+    S = torch.ones_like(W[:, 0])
+    S[:, 2] = torch.det(U)*torch.det(V)
+    C = (U*S.unsqueeze(1)).bmm(V.transpose(1, 2))
     return C
 
 def matrix_diff(X,Y):